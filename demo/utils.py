@@ -1,45 +1,261 @@
-import json
+import fnmatch
+import glob
+import hashlib
+import io
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
+import boto3
 import s3fs
 from IPython.display import Image, display
-import boto3
+
+# the report format is shared with the lambda functions (the package of their
+# common layer is installed with the project, see requirements.txt)
+from face_match.reports import decode_reports
 
 s3 = s3fs.S3FileSystem()
 client = boto3.client("rekognition")
 
+# local copies of the report objects, named by ETag
+CACHE_DIR = Path.home() / ".cache" / "face-match" / "reports"
+MAX_WORKERS = 32
+# the reports compacted into Parquet files, one directory per window and
+# compaction run (see face_match.compaction), once the run's manifest is written
+COMPACTED_PREFIX = "compacted"
+MANIFEST = "_manifest.json"
+
+# columns of the frame of the matches, one row per match
+MATCH_COLUMNS = [
+    "ReportUri",
+    "Source",
+    "CustomerID",
+    "FaceId",
+    "MatchedCustomerID",
+    "MatchedImageId",
+    "MatchedFaceId",
+    "Similarity",
+]
+
+
 def display_s3(uri):
     with s3.open(uri) as f:
         display(Image(f.read()))
 
 
+def read_many(uris, max_workers=MAX_WORKERS):
+    """Bodies of the objects, read concurrently, in the order of `uris`"""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(s3.cat_file, uris))
+
+
+def report_etags(pattern):
+    """ETag of every report object matching the glob pattern, from the listing"""
+    return {
+        path: info["ETag"].strip('"')
+        for path, info in s3.glob(pattern, detail=True).items()
+        if info.get("type") != "directory"
+    }
+
+
+def _cached_body(uri, etag, cache_dir):
+    """Body of a report object, read from the local cache if its ETag is there"""
+    suffix = "".join(Path(uri).suffixes[-2:])
+    cached = Path(cache_dir) / f"{hashlib.sha1(etag.encode()).hexdigest()}{suffix}"
+    if cached.exists():
+        return cached.read_bytes()
+    body = s3.cat_file(uri)
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    # (written under another name first, so that a partial file is never read)
+    partial = cached.with_name(f"{cached.name}.{uuid.uuid4().hex}.part")
+    partial.write_bytes(body)
+    partial.replace(cached)
+    return body
+
+
+def load_reports(uris, max_workers=MAX_WORKERS, cache_dir=CACHE_DIR):
+    """Reports of the objects `uris`, read concurrently and cached locally.
+
+    `uris` is a glob pattern (e.g. "<output bucket>/output/Hans_Blix*"), a list of
+    object URIs, or a dict of URI -> ETag (e.g. from `report_etags`). The objects
+    already in the cache, with the same ETag, are not read again. Returns a dict
+    of URI -> list of reports (batch objects hold several reports).
+
+    The reports of a glob pattern include the ones compacted since, under the URI
+    of their original object.
+    """
+    reports = {}
+    if isinstance(uris, str):
+        # (the originals not deleted yet are read from their object)
+        reports = compacted_reports(uris, max_workers, cache_dir)
+        uris = report_etags(uris)
+    elif not isinstance(uris, dict):
+        uris = {uri: s3.info(uri)["ETag"].strip('"') for uri in uris}
+
+    def load(item):
+        uri, etag = item
+        return decode_reports(_cached_body(uri, etag, cache_dir), uri)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        reports.update(zip(uris, pool.map(load, uris.items())))
+    return reports
+
+
+def object_reports(uri, max_workers=MAX_WORKERS, cache_dir=CACHE_DIR):
+    """Reports of a single report object (a URI, with or without "s3://").
+
+    The compacted reports are only read (all the Parquet files of the bucket) if
+    the object is gone, moved under `archive/` by a compaction.
+    """
+    path = uri.split("://", 1)[-1]
+    try:
+        return load_reports([path], max_workers, cache_dir)[path]
+    except FileNotFoundError:
+        compacted = compacted_reports(glob.escape(path), max_workers, cache_dir)
+        if path not in compacted:
+            raise
+        return compacted[path]
+
+
+def compacted_files(bucket):
+    """Parquet files (URI -> ETag) of the last complete compaction run of every
+    window of the bucket"""
+    runs = {}
+    for path, info in s3.glob(
+        f"{bucket}/{COMPACTED_PREFIX}/*/*/*", detail=True
+    ).items():
+        window, run, name = path.rsplit("/", 3)[1:]
+        runs.setdefault((window, run), {})[name] = info
+    latest = {}
+    for (window, run), files in runs.items():
+        # (the run IDs start with their time)
+        if MANIFEST in files and run > latest.get(window, ""):
+            latest[window] = run
+    return {
+        f"{bucket}/{COMPACTED_PREFIX}/{window}/{run}/{name}": info["ETag"].strip('"')
+        for window, run in latest.items()
+        for name, info in runs[(window, run)].items()
+        if name.endswith(".parquet")
+    }
+
+
+def _without_nulls(value):
+    """A Parquet row as a report: without the fields missing from the JSON"""
+    if isinstance(value, dict):
+        return {k: _without_nulls(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_without_nulls(v) for v in value]
+    return value
+
+
+def compacted_reports(pattern, max_workers=MAX_WORKERS, cache_dir=CACHE_DIR):
+    """Compacted reports of the original objects matching a glob pattern, by
+    original URI. The Parquet files are read concurrently and cached locally."""
+    import pyarrow.parquet as pq
+
+    pattern = pattern.split("://", 1)[-1]
+    files = compacted_files(pattern.split("/", 1)[0])
+
+    def load(item):
+        uri, etag = item
+        return pq.read_table(io.BytesIO(_cached_body(uri, etag, cache_dir))).to_pylist()
+
+    reports = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for rows in pool.map(load, files.items()):
+            for row in rows:
+                uri = row["reportpath"].split("://", 1)[-1]
+                if not fnmatch.fnmatchcase(uri, pattern):
+                    continue
+                report = {
+                    "Source": row["source"],
+                    "CustomerID": row["customerid"],
+                    "Matches": row["matches"] or [],
+                    "Faces": row["faces"] or [],
+                    "DuplicateOf": row["duplicateof"],
+                }
+                reports.setdefault(uri, []).append(_without_nulls(report))
+    return reports
+
+
+def matches_frame(reports, engine="pandas"):
+    """Flatten reports to a frame with one row per match (see `MATCH_COLUMNS`).
+
+    `reports` is the output of `load_reports`. The frame is a pandas DataFrame,
+    or a pyarrow Table with `engine="arrow"`.
+    """
+    columns = {name: [] for name in MATCH_COLUMNS}
+    for uri, uri_reports in reports.items():
+        for report in uri_reports:
+            for m in report["Matches"]:
+                # (matches of users have no face)
+                face = m.get("Face", {})
+                image_id = face.get("ExternalImageId")
+                columns["ReportUri"].append(uri)
+                columns["Source"].append(report["Source"])
+                columns["CustomerID"].append(report["CustomerID"])
+                columns["FaceId"].append(m.get("SearchedFaceId"))
+                columns["MatchedCustomerID"].append(
+                    m.get("CustomerId") or image_id.rsplit("_", 1)[0]
+                )
+                columns["MatchedImageId"].append(image_id)
+                columns["MatchedFaceId"].append(face.get("FaceId"))
+                columns["Similarity"].append(float(m["Similarity"]))
+    if engine == "arrow":
+        import pyarrow as pa
+
+        return pa.table(columns)
+    import pandas as pd
+
+    return pd.DataFrame(columns, columns=MATCH_COLUMNS)
+
+
 def inspect_matches(bucket_name, report_json):
-    with s3.open(report_json) as f:
-        report = json.load(f)
+    # (the report may have been compacted since)
+    report = object_reports(report_json)[0]
     source_uri = report["Source"]
-    customer_id = report['CustomerID']
+    customer_id = report["CustomerID"]
     matches = [
         {
-            "uri": f"{bucket_name}/images/{k['CustomerId']}/{k['Face']['ExternalImageId']}",
+            "uri": "{}/images/{}/{}".format(
+                bucket_name, k["CustomerId"], k["Face"]["ExternalImageId"]
+            ),
             "Similarity": k["Similarity"],
-            "CustomerID": k["Face"]["ExternalImageId"].rsplit("_", 1)[0],
+            "CustomerID": k["CustomerId"],
         }
         for k in report["Matches"]
+        if "Face" in k
     ]
+    # matches of users (customers) have no image to show
+    user_matches = [k for k in report["Matches"] if "Face" not in k]
+    # the images are read concurrently, then displayed in order
+    source_image, *match_images = read_many([source_uri] + [m["uri"] for m in matches])
     print(f"Source Image: {source_uri}, CustomerID: {customer_id}")
-    display_s3(source_uri)
+    display(Image(source_image))
     print("Identified Matches")
-    for m in matches:
-        print("CustomerID: {CustomerID},\nSimilarity: {Similarity:.3f}\nImage: {uri}".format(**m))
-        display_s3(m["uri"])
+    for m, image in zip(matches, match_images):
+        print(
+            "CustomerID: {CustomerID},\nSimilarity: {Similarity:.3f}\n"
+            "Image: {uri}".format(**m)
+        )
+        display(Image(image))
+    for k in user_matches:
+        print("CustomerID: {CustomerId},\nSimilarity: {Similarity:.3f}".format(**k))
+
 
-        
 def count_hits(uri):
-    with s3.open(uri) as f:
-        example = json.load(f)
-        return len(example['Matches'])
-        
+    return sum(len(report["Matches"]) for report in object_reports(uri))
+
+
+def count_faces(collection_id):
+    """Number of faces in the collection, over all the pages of `list_faces`"""
+    pages = client.get_paginator("list_faces").paginate(
+        CollectionId=collection_id, PaginationConfig={"PageSize": 4096}
+    )
+    return sum(len(page["Faces"]) for page in pages)
+
 
 def reset_collection(collection_id):
     response_0 = client.delete_collection(CollectionId=collection_id)
     response_1 = client.create_collection(CollectionId=collection_id)
-    return response_0, response_1
\ No newline at end of file
+    return response_0, response_1
@@ -0,0 +1,69 @@
+import os
+import time
+
+from aws_lambda_powertools import Logger, Metrics
+from face_match import clients
+from face_match.compaction import Compactor, GlueCatalog
+from face_match.metrics import PowertoolsSink, StageMetrics
+
+logger = Logger()
+# per-stage timings and counters, in CloudWatch Embedded Metric Format
+stage_metrics = StageMetrics(
+    PowertoolsSink(
+        Metrics(
+            namespace=os.getenv("POWERTOOLS_METRICS_NAMESPACE", "FaceMatching"),
+            service=os.getenv("POWERTOOLS_SERVICE_NAME", "compact_reports"),
+        )
+    )
+)
+s3 = clients.lazy("s3")
+glue = clients.lazy("glue")
+
+bucket_out = os.getenv("BUCKET_OUT")
+prefix_out = os.getenv("PREFIX_OUT", "output")
+compacted_prefix = os.getenv("COMPACTED_PREFIX", "compacted")
+# the originals are copied under this prefix before being deleted, unless empty
+archive_prefix = os.getenv("ARCHIVE_PREFIX", "archive") or None
+# "day" or "hour" windows, compacted `COMPACTION_GRACE` seconds after they end
+window = os.getenv("COMPACTION_WINDOW", "day")
+grace = int(os.getenv("COMPACTION_GRACE", 3600))
+max_object_size = int(os.getenv("COMPACTION_MAX_OBJECT_SIZE", 1 << 20))
+database = os.getenv("GLUE_DATABASE")
+table = os.getenv("GLUE_TABLE")
+# time left for the clean-up of the last window before the timeout
+DEADLINE_MARGIN = 120
+
+
+# @logger.inject_lambda_context(log_event=True)
+def handler(event, context):
+    """Compact the reports of the closed windows, oldest first.
+
+    The windows left when the invocation is about to time out are compacted by
+    the next one.
+    """
+    deadline = None
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000
+        deadline = time.monotonic() + remaining - DEADLINE_MARGIN
+    compactor = Compactor(
+        s3,
+        bucket_out,
+        GlueCatalog(glue, database, table),
+        prefix=prefix_out,
+        compacted_prefix=compacted_prefix,
+        window=window,
+        grace=grace,
+        max_object_size=max_object_size,
+        archive_prefix=archive_prefix,
+    )
+    try:
+        with stage_metrics.timer("Compaction"):
+            stats = compactor.run(deadline=deadline)
+        for s in stats:
+            logger.info(f"Compacted window {s['window']}: {s}")
+            stage_metrics.latency("Window", s["seconds"])
+            stage_metrics.count("CompactedObjects", s["objects"])
+            stage_metrics.count("CompactedReports", s["reports"])
+    finally:
+        stage_metrics.flush()
+    return {"windows": stats}
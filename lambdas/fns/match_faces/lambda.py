@@ -1,95 +1,983 @@
+import hashlib
+import heapq
 import json
 import os
+import urllib.parse
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
-import boto3
-from aws_lambda_powertools import Logger
-from tenacity import retry, stop_after_attempt, wait_exponential
+from aws_lambda_powertools import Logger, Metrics
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as EndpointError
+from face_match import clients, match_store
+from face_match.identity_graph import (
+    DynamoDBGraphStore,
+    IdentityGraph,
+    InMemoryGraphStore,
+)
+from face_match.metrics import PowertoolsSink, StageMetrics
+from face_match.profiling import Profiler
+from face_match.reports import (
+    batch_key,
+    decode_reports,
+    encode_batch,
+    encode_report,
+    report_key,
+)
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from ledger import DynamoDBLedgerStore, IngestionLedger, InMemoryLedgerStore
+from near_duplicates import DynamoDBHashStore, HashIndex, dhash
+from normalize import ImageNormalizer, crop_faces
+from rate_limit import (
+    DynamoDBBucketStore,
+    InMemoryBucketStore,
+    RateLimiter,
+    is_throttling,
+)
+from users import KnownUsers, customer_id_of_user, user_id_of
 
 logger = Logger()
-reko = boto3.client("rekognition")
-s3 = boto3.resource("s3")
+# per-stage timings and counters, in CloudWatch Embedded Metric Format
+stage_metrics = StageMetrics(
+    PowertoolsSink(
+        Metrics(
+            namespace=os.getenv("POWERTOOLS_METRICS_NAMESPACE", "FaceMatching"),
+            service=os.getenv("POWERTOOLS_SERVICE_NAME", "match_faces"),
+        )
+    )
+)
+cold_start = True
+# the clients are created on first use, and shared by the record workers
+reko = clients.lazy("rekognition")
+s3 = clients.lazy("s3")
 collection_id = os.getenv("COLLECTION_NAME")
-max_faces_index = os.getenv("MAX_FACE_INDEX", 1)
-max_faces_match = os.getenv("MAX_FACE_MATCH", 100)
-threshold = os.getenv("FACE_MATCHING_THRESHOLD", 50)
+# with N > 1 shards, the faces are spread across the collections
+# <COLLECTION_NAME>-0 ... <COLLECTION_NAME>-<N-1>, as created by the stack
+collection_shards = int(os.getenv("COLLECTION_SHARDS", 1))
+shards = (
+    [f"{collection_id}-{i}" for i in range(collection_shards)]
+    if collection_shards > 1
+    else [collection_id]
+)
+# the API expects numbers, while the environment only holds strings
+max_faces_index = int(os.getenv("MAX_FACE_INDEX", 1))
+max_faces_match = int(os.getenv("MAX_FACE_MATCH", 100))
+threshold = float(os.getenv("FACE_MATCHING_THRESHOLD", 50))
+# "faces": the matches are faces, "users": the faces of every customer are
+# associated with a Rekognition user, and the matches are users (customers)
+search_mode = os.getenv("SEARCH_MODE", "faces")
+max_users_match = int(os.getenv("MAX_USER_MATCH", 100))
+# faces below this similarity to the faces of their user are not associated
+user_association_threshold = float(os.getenv("USER_ASSOCIATION_THRESHOLD", 75))
+# concurrent searches for the faces of a single image
+max_face_searches = int(os.getenv("MAX_FACE_SEARCH_WORKERS", 4))
+# images under these prefixes are screened (searched without being indexed)
+screening_prefixes = tuple(
+    p for p in os.getenv("SCREENING_PREFIXES", "").split(",") if p
+)
+# screened images are enrolled: "never", "no_match" (when no other customer
+# matched) or "always"
+screening_enroll = os.getenv("SCREENING_ENROLL_POLICY", "never")
 bucket_out = os.getenv("BUCKET_OUT")
 prefix_out = os.getenv("PREFIX_OUT", "output")
+max_workers = int(os.getenv("MAX_WORKERS", 10))
+# every record worker can have a search per face (or shard) in flight
+clients.configure(pool_size=max_workers * max(max_face_searches, 1))
+# "object": one report object per image, "batch": one object per invocation
+output_mode = os.getenv("OUTPUT_MODE", "object")
+compress_output = os.getenv("OUTPUT_COMPRESSION", "") == "gzip"
+# partitioned Parquet copy of the matches, disabled if no prefix is set
+match_store_prefix = os.getenv("MATCH_STORE_PREFIX")
+match_store_buckets = int(os.getenv("MATCH_STORE_BUCKETS", 16))
+# the reports of several images are written together by `write_outputs`
+batched_outputs = output_mode == "batch" or bool(match_store_prefix)
+rate_limit_table = os.getenv("RATE_LIMIT_TABLE")
+ledger_table = os.getenv("LEDGER_TABLE")
+# near-duplicate uploads reuse the faces of the first one, disabled if not set
+near_duplicate_distance = os.getenv("NEAR_DUPLICATE_DISTANCE")
+image_hash_table = os.getenv("IMAGE_HASH_TABLE")
+identity_graph_table = os.getenv("IDENTITY_GRAPH_TABLE")
+# images wider or higher than this are downscaled before being sent to
+# Rekognition, disabled if not set
+normalize_max_dimension = os.getenv("NORMALIZE_MAX_DIMENSION")
+# matches that link two customer IDs in the identity graph
+identity_graph_threshold = float(os.getenv("IDENTITY_GRAPH_THRESHOLD", 90))
+
+# Without a table the TPS budgets are per instance, not shared. With one, every
+# round trip to the table leases `RATE_LIMIT_LEASE_BLOCK` tokens
+rate_limiter = RateLimiter(
+    (
+        DynamoDBBucketStore(
+            rate_limit_table, block=int(os.getenv("RATE_LIMIT_LEASE_BLOCK", 1))
+        )
+        if rate_limit_table
+        else InMemoryBucketStore()
+    ),
+    rates={
+        "IndexFaces": float(os.getenv("INDEX_FACES_TPS", 50)),
+        "SearchFaces": float(os.getenv("SEARCH_FACES_TPS", 50)),
+        "SearchFacesByImage": float(os.getenv("SEARCH_FACES_BY_IMAGE_TPS", 50)),
+        "AssociateFaces": float(os.getenv("ASSOCIATE_FACES_TPS", 50)),
+        "SearchUsers": float(os.getenv("SEARCH_USERS_TPS", 50)),
+        "SearchUsersByImage": float(os.getenv("SEARCH_USERS_BY_IMAGE_TPS", 50)),
+    },
+    namespace=f"{collection_id}/",
+)
+
+# Images already indexed (e.g. redelivered messages) are not indexed again.
+# Without a table the ledger only knows the images seen by this instance
+ledger = IngestionLedger(
+    DynamoDBLedgerStore(ledger_table) if ledger_table else InMemoryLedgerStore()
+)
+
+# Perceptual hashes of the images indexed, the `NEAR_DUPLICATE_CACHE_SIZE` most
+# recent ones also in memory. Without a table the index only knows the images
+# seen by this instance
+hash_index = None
+if near_duplicate_distance:
+    hash_index = HashIndex(
+        (
+            DynamoDBHashStore(image_hash_table, int(near_duplicate_distance))
+            if image_hash_table
+            else None
+        ),
+        max_distance=int(near_duplicate_distance),
+        cache_size=int(os.getenv("NEAR_DUPLICATE_CACHE_SIZE", 100000)),
+    )
+
+# Large uploads are downscaled by a pool of `NORMALIZE_WORKERS` threads
+normalizer = None
+if normalize_max_dimension:
+    normalizer = ImageNormalizer(
+        lambda **kwargs: s3.get_object(**kwargs),
+        int(normalize_max_dimension),
+        workers=int(os.getenv("NORMALIZE_WORKERS", 2)),
+        quality=int(os.getenv("NORMALIZE_QUALITY", 90)),
+    )
+
+# Clusters of the customer IDs that share a face. Without a table the graph only
+# knows the matches of this instance
+identity_graph = IdentityGraph(
+    DynamoDBGraphStore(identity_graph_table)
+    if identity_graph_table
+    else InMemoryGraphStore()
+)
+
+# The users created (or found to exist) by this instance, by collection
+known_users = KnownUsers()
+
+# Invocations profiled on demand (`PROFILING_MODE`, or a `Profile` message
+# attribute), written to the output bucket unless `PROFILING_BUCKET` is set
+profiling_bucket = os.getenv("PROFILING_BUCKET") or bucket_out
+profiler = Profiler.from_env(
+    lambda key, body: s3.put_object(Bucket=profiling_bucket, Key=key, Body=body),
+    "match_faces",
+)
+
+# Result of the processing of an image: the report, and what's needed to mark it
+# as done in the ledger once the report is written
+Ingested = namedtuple("Ingested", ["ledger_key", "face_ids", "report"])
+
+
+# Throttled calls are retried with a randomised backoff, so that the concurrent
+# instances don't retry in lockstep. The Rekognition client makes a single
+# attempt (see face_match.clients), so its transient errors are retried here too
+def count_throttle(exception):
+    throttled = is_throttling(exception)
+    if throttled:
+        stage_metrics.count("Throttles")
+    return throttled
+
+
+def is_transient(exception):
+    if isinstance(exception, (EndpointError, HTTPClientError)):
+        return True
+    return (
+        isinstance(exception, ClientError)
+        and exception.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        >= 500
+    )
+
+
+retry_throttled = retry(
+    retry=retry_if_exception(lambda e: count_throttle(e) or is_transient(e)),
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(multiplier=0.2, max=10),
+    before_sleep=lambda retry_state: stage_metrics.count("Retries"),
+    reraise=True,
+)
+
 
 # @logger.inject_lambda_context(log_event=True)
 def handler(event, context):
+    """Process the SQS messages of the batch concurrently.
+
+    Failures are isolated per message: the IDs of the messages that could not be
+    processed are returned in the `batchItemFailures` format, so that SQS only
+    redelivers those and not the whole batch.
+
+    In "batch" output mode the reports of all the successful messages are written
+    in a single object at the end of the invocation, as are their rows in the
+    match store (when enabled).
+
+    The timings of the stages are flushed as metrics at the end of every
+    invocation.
+
+    The invocation is profiled when the configuration selects it, or when one of
+    its messages has a `Profile` attribute ("cprofile" or "sample").
+    """
+    global cold_start
+    if cold_start:
+        stage_metrics.count("ColdStart")
+        cold_start = False
+    invocation_id = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
     try:
-        for record in event["Records"]:
-            payload = record["body"]
-            for r in json.loads(payload)["Records"]:
-                # Extract the reference of the image that triggered the lambda
-                bucket = r["s3"]["bucket"]["name"]
-                object_key = r["s3"]["object"]["key"]
-                logger.info(f"bucket:{bucket}, key:{object_key}")
-
-                # Extract semantinc info form the object key
-                image_id = object_key.split("/")[-1]
-                customer_id = image_id.rsplit("_", 1)[0]
-
-                # add image to collection and search for matches
-                matches = add_search_twin(
-                    bucket,
-                    object_key,
-                    image_id=image_id,
-                    collection_id=collection_id,
-                )
-                logger.info(f"Found {len(matches)} matches in the collection")
-                logger.info(matches)
-
-                # check if there's any match with other customers_id
-                res = [
-                    {**k, "CustomerId": k["Face"]["ExternalImageId"].rsplit("_", 1)[0]}
-                    for k in matches
-                    if k["Face"]["ExternalImageId"].rsplit("_", 1)[0] != customer_id
-                ]
-
-                logger.info(f"Matches that require manual investigation {res}")
-
-                # if len(res) > 0:
-                s3object = s3.Object(bucket_out, f"{prefix_out}/{image_id}.json")
-                s3object.put(
-                    Body=(
-                        bytes(
-                            json.dumps(
-                                {
-                                    "Source": f"{bucket}/{object_key}",
-                                    "CustomerID": customer_id,
-                                    "Matches": res,
-                                }
-                            ).encode("UTF-8")
-                        )
-                    )
-                )
+        with profiler.profile(invocation_id, profiling_request(event["Records"])):
+            with stage_metrics.timer("Batch"):
+                return process_batch(event, context)
+    finally:
+        stage_metrics.flush()
+
+
+def profiling_request(records):
+    """Profiling mode asked for by the `Profile` attribute of a message, if any"""
+    for record in records:
+        attributes = record.get("messageAttributes") or {}
+        mode = attributes.get("Profile", {}).get("stringValue")
+        if mode:
+            return mode
+    return None
+
+
+def process_batch(event, context):
+    records = event["Records"]
+    failures = []
+    batch_reports = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(records)))) as pool:
+        futures = {pool.submit(process_message, record): record for record in records}
+        for future in as_completed(futures):
+            message_id = futures[future]["messageId"]
+            try:
+                reports = future.result()
+                logger.info(f"Message {message_id} processed, {len(reports)} reports")
+                batch_reports[message_id] = reports
+            except Exception:
+                logger.exception(f"Failed to process message {message_id}")
+                failures.append({"itemIdentifier": message_id})
+    stage_metrics.count("Messages", len(records))
+    stage_metrics.count("FailedMessages", len(failures))
+
+    ingested = [i for items in batch_reports.values() for i in items]
+    if ingested and batched_outputs:
+        batch_id = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+        try:
+            write_outputs(batch_id, ingested)
+        except Exception:
+            logger.exception(f"Failed to write the reports of batch {batch_id}")
+            failures.extend({"itemIdentifier": m} for m in batch_reports)
+
+    return {"batchItemFailures": failures}
+
+
+def write_outputs(batch_id, ingested):
+    """Write the outputs shared by several images: the batch report object (in
+    "batch" output mode) and the rows of the match store (when enabled).
+
+    The images are marked as done as soon as their report object is written:
+    it triggers the alerts, and a redelivery would write it (and send them)
+    again. If it fails, the claims of the images are released, so that the
+    redeliveries don't wait for their lease to expire. The rows of the match store are then retried on their own, and only
+    counted as `MatchStoreFailures` if they still fail.
+    """
+    reports = [i.report for i in ingested]
+    if output_mode == "batch":
+        try:
+            with stage_metrics.timer("BatchPut"):
+                write_batch(batch_id, reports)
+            key = batch_key(prefix_out, batch_id, compress=compress_output)
+            mark_done(ingested, key)
+        except Exception:
+            release_claims(ingested)
+            raise
+    if match_store_prefix:
+        try:
+            with stage_metrics.timer("MatchStorePut"):
+                write_match_store_retry(batch_id, reports)
+        except Exception:
+            logger.exception(f"Failed to write the match store rows of {batch_id}")
+            stage_metrics.count("MatchStoreFailures")
+
+
+def process_message(record):
+    """Process all the S3 notifications wrapped in a single SQS message"""
+    payload = json.loads(record["body"])
+    attributes = record.get("messageAttributes") or {}
+
+    def process(r):
+        with stage_metrics.timer("Image"):
+            return process_s3_record(r, attributes)
+
+    # S3 sends a test event without records when the notification is configured
+    processed = []
+    try:
+        for r in payload.get("Records", []):
+            ingested = process(r)
+            if ingested is not None:
+                processed.append(ingested)
+    except Exception:
+        # (the whole message is redelivered)
+        release_claims(processed)
+        raise
+    return processed
+
+
+def processing_mode(object_key, attributes):
+    """Whether to "enroll" (index, then search) or "screen" (search only) an image.
+
+    The `Mode` message attribute takes precedence over the prefix of the key.
+    """
+    mode = attributes.get("Mode", {}).get("stringValue")
+    if mode in ("enroll", "screen"):
+        return mode
+    if screening_prefixes and object_key.startswith(screening_prefixes):
+        return "screen"
+    return "enroll"
+
+
+def process_s3_record(r, attributes=None):
+    # Extract the reference of the image that triggered the lambda
+    bucket = r["s3"]["bucket"]["name"]
+    object_key = urllib.parse.unquote_plus(r["s3"]["object"]["key"], encoding="utf-8")
+    etag = r["s3"]["object"].get("eTag")
+    mode = processing_mode(object_key, attributes or {})
+    logger.info(f"bucket:{bucket}, key:{object_key}, mode:{mode}")
+
+    # Extract semantinc info form the object key
+    image_id = object_key.split("/")[-1]
+    customer_id = image_id.rsplit("_", 1)[0]
+
+    # skip the images already processed, and don't index again the ones that were
+    # indexed by a previous attempt
+    ledger_key = (
+        IngestionLedger.key(bucket, object_key, etag) if ledger and etag else None
+    )
+    with stage_metrics.timer("Ledger"):
+        entry = ledger.begin(ledger_key) if ledger_key else None
+    if entry is not None and entry["status"] == "done":
+        logger.info(f"{object_key} already processed, FaceIds: {entry['face_ids']}")
+        return None
 
-        return {"status": "success", "message": res}
+    source = f"{bucket}/{object_key}"
+    # the collection (shard) the faces of the image are indexed in
+    home = shard_of(image_id)
+    report = None
+    # the content of the image, when it is downloaded to be hashed (and then
+    # reused to downscale it)
+    body = None
+    try:
+        with stage_metrics.timer("NearDuplicate"):
+            image_hash = None
+            if hash_index is not None and entry is None:
+                body = s3.get_object(Bucket=bucket, Key=object_key)["Body"].read()
+                image_hash = hash_image(body, object_key)
+            duplicate = find_duplicate(image_hash) if image_hash is not None else None
+        if entry is not None:
+            face_ids = entry["face_ids"]
+            # (the image is only searched in the other shards)
+            image = rekognition_image(bucket, object_key) if len(shards) > 1 else None
+            face_matches = search_faces_in_image(
+                face_ids, home, image, entry.get("boxes")
+            )
+        elif duplicate is not None:
+            # the faces of the image are already in the collection
+            face_ids = duplicate[1]["face_ids"]
+            face_matches = None
+            if face_ids:
+                report = duplicate_report(source, customer_id, *duplicate)
+        elif mode == "screen":
+            face_ids, face_matches = screen_image(
+                bucket, object_key, image_id, customer_id, ledger_key, body
+            )
+        else:
+            # add the faces in the image to the collection
+            image = rekognition_image(bucket, object_key, body)
+            face_ids, boxes = index_faces_in_image(
+                bucket, object_key, image_id, home, image, ledger_key
+            )
+            # search for matches of every face
+            face_matches = search_faces_in_image(face_ids, home, image, boxes, body)
+        if image_hash is not None and duplicate is None and ledger_key:
+            if mode != "screen" or face_ids:
+                remember_hash(
+                    image_hash, ledger_key, source, image_id, customer_id, face_ids
+                )
     except Exception:
-        logger.exception("Received an exception")
+        if ledger_key and entry is None:
+            ledger.release(ledger_key)
+        raise
+
+    if face_matches:
+        report = build_report(source, customer_id, face_matches)
+    if report is None:
+        # Nothing was found, so there is nothing to report (nor to retry)
+        if ledger_key:
+            ledger.done(ledger_key, face_ids, None)
+        return None
+
+    stage_metrics.count("FacesPerImage", len(face_ids))
+    stage_metrics.count("MatchesPerImage", len(report["Matches"]))
+    # (before the report is written, so that a failure is retried)
+    with stage_metrics.timer("IdentityGraph"):
+        link_customers(report)
+    ingested = Ingested(ledger_key, face_ids, report)
+    if output_mode != "batch":
+        key = report_key(prefix_out, image_id)
+        with stage_metrics.timer("ReportPut"):
+            s3.put_object(Bucket=bucket_out, Key=key, Body=encode_report(report))
+        mark_done([ingested], key)
+    return ingested
+
+
+def screen_image(bucket, object_key, image_id, customer_id, ledger_key=None, body=None):
+    """Search the collection for the face in the image, with a single call.
+
+    The image is enrolled afterwards only if the screening policy says so.
+    Returns the FaceIds enrolled, and the matches keyed by the enrolled FaceId,
+    or by None if the image was not enrolled (the reports then leave out the
+    FaceId of the searched face).
+    """
+    image = rekognition_image(bucket, object_key, body)
+    matches = search_image_in_shards(image)
+    if matches is None:
+        return [], {}
+    enroll = screening_enroll == "always" or (
+        screening_enroll == "no_match" and not other_customers(matches, customer_id)
+    )
+    face_ids = []
+    if enroll:
+        face_ids, _ = index_faces_in_image(
+            bucket, object_key, image_id, shard_of(image_id), image, ledger_key
+        )
+    return face_ids, {face_ids[0] if face_ids else None: matches}
+
+
+def link_customers(report):
+    """Add the cross-customer matches of a report to the identity graph"""
+    for m in report["Matches"]:
+        if m["Similarity"] >= identity_graph_threshold:
+            identity_graph.add_match(
+                report["CustomerID"], m["CustomerId"], m["Similarity"]
+            )
+
+
+def rekognition_image(bucket, object_key, body=None):
+    """The image to send to Rekognition: a reference to the object, or a
+    downscaled copy of a large one (from its `body`, if already downloaded)"""
+    s3_image = {"S3Object": {"Bucket": bucket, "Name": object_key}}
+    if normalizer is None:
+        return s3_image
+    try:
+        with stage_metrics.timer("Normalize"):
+            image = normalizer.image(bucket, object_key, body)
+    except (OSError, ValueError):
+        # (Rekognition reports the images it can't read either)
+        logger.warning(f"Can't downscale {object_key}, sending it as is")
+        stage_metrics.count("NormalizeFailures")
+        return s3_image
+    if "Bytes" in image:
+        stage_metrics.count("DownscaledImages")
+    return image
+
+
+def hash_image(body, object_key):
+    """Perceptual hash of the image, or None if it can't be decoded"""
+    try:
+        return dhash(body)
+    except (OSError, ValueError):
+        logger.warning(f"Can't hash {object_key}, skipping the near-duplicate check")
+        return None
+
+
+def find_duplicate(image_hash):
+    """(distance, hash entry, report) of an earlier upload of the same image.
+
+    Returns None if there is none, or if it is still being processed.
+    """
+    found = hash_index.lookup(image_hash)
+    if found is None:
+        return None
+    distance, earlier = found
+    previous = ledger.get(earlier["ledger_key"])
+    if previous is None or previous["status"] != "done":
+        return None
+    earlier_report = None
+    if previous["report_key"]:
+        earlier_report = read_report(previous["report_key"], earlier["source"])
+        if earlier_report is None:
+            # (e.g. compacted since), the image is processed as a new one
+            return None
+    logger.info(f"Near-duplicate of {earlier['source']}, distance {distance}")
+    return distance, earlier, earlier_report
+
+
+def read_report(key, source):
+    """The report of the image `source` in the report object `key`, or None if
+    it is gone"""
+    try:
+        body = s3.get_object(Bucket=bucket_out, Key=key)["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise
+        return None
+    for report in decode_reports(body, key):
+        if report["Source"] == source:
+            return report
+    return None
+
+
+def remember_hash(image_hash, ledger_key, source, image_id, customer_id, face_ids):
+    hash_index.add(
+        image_hash,
+        {
+            "ledger_key": ledger_key,
+            "source": source,
+            "image_id": image_id,
+            "customer_id": customer_id,
+            "face_ids": face_ids,
+        },
+    )
+
+
+def duplicate_report(source, customer_id, distance, earlier, earlier_report):
+    """Report of a near-duplicate, from the report of the earlier upload.
+
+    The faces of the earlier upload are matches of the image (with similarity
+    100) when it was uploaded by another customer, and their matches are the
+    matches of the image.
+    """
+    reused = [
+        {
+            "Face": {"FaceId": face_id, "ExternalImageId": earlier["image_id"]},
+            "Similarity": 100.0,
+            "SearchedFaceId": face_id,
+        }
+        for face_id in earlier["face_ids"]
+    ]
+    earlier_matches = (earlier_report or {}).get("Matches", [])
+    res = other_customers(reused + earlier_matches, customer_id)
+    logger.info(f"Matches that require manual investigation {res}")
+    return {
+        "Source": source,
+        "CustomerID": customer_id,
+        "Matches": res,
+        "Faces": [
+            {
+                "FaceId": face_id,
+                "Matches": [
+                    {**matched_ref(m), "Similarity": m["Similarity"]}
+                    for m in res
+                    if m.get("SearchedFaceId") == face_id
+                ],
+            }
+            for face_id in earlier["face_ids"]
+        ],
+        "DuplicateOf": {
+            "Source": earlier["source"],
+            "CustomerID": earlier["customer_id"],
+            "Distance": distance,
+        },
+    }
+
 
+def build_report(source, customer_id, face_matches):
+    """Report of the matches with other customers, overall and per face"""
+    matches = merge_matches(face_matches)
+    logger.info(f"Found {len(matches)} matches in the collection")
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.2, min=1, max=10))
+    # check if there's any match with other customers_id
+    res = other_customers(matches, customer_id)
+
+    logger.info(f"Matches that require manual investigation {res}")
+
+    return {
+        "Source": source,
+        "CustomerID": customer_id,
+        "Matches": res,
+        # the matches of each face of the image, by reference to the ones above
+        # (a screened face that was not enrolled has no FaceId)
+        "Faces": [
+            {
+                **({"FaceId": face_id} if face_id is not None else {}),
+                "Matches": [
+                    {**matched_ref(m), "Similarity": m["Similarity"]}
+                    for m in other_customers(face_match, customer_id)
+                ],
+            }
+            for face_id, face_match in face_matches.items()
+        ],
+    }
+
+
+def mark_done(ingested, key):
+    """Record in the ledger the images whose report has been written to `key`"""
+    for i in ingested:
+        if i.ledger_key:
+            ledger.done(i.ledger_key, i.face_ids, key)
+
+
+def release_claims(ingested):
+    """Release the images whose report was not written, so that a redelivery
+    processes them at once (the images indexed keep their entry)"""
+    for i in ingested:
+        if i.ledger_key:
+            ledger.release(i.ledger_key)
+
+
+def write_batch(batch_id, reports):
+    """Write the reports of the invocation as a single newline-delimited object"""
+    s3.put_object(
+        Bucket=bucket_out,
+        Key=batch_key(prefix_out, batch_id, compress=compress_output),
+        Body=encode_batch(reports, compress=compress_output),
+        ContentType="application/x-ndjson",
+    )
+
+
+@retry_throttled
+def write_match_store_retry(batch_id, reports):
+    # (the objects of a batch are overwritten by the retries)
+    return match_store.write_reports(
+        s3,
+        bucket_out,
+        match_store_prefix,
+        batch_id,
+        reports,
+        buckets=match_store_buckets,
+    )
+
+
+@retry_throttled
+def index_faces_retry(**kwargs):
+    with stage_metrics.timer("RateLimitWait"):
+        rate_limiter.acquire("IndexFaces")
+    with stage_metrics.timer("IndexFaces"):
+        return reko.index_faces(**kwargs)
+
+
+@retry_throttled
 def search_faces_retry(**kwargs):
-    return reko.search_faces(**kwargs)
+    with stage_metrics.timer("RateLimitWait"):
+        rate_limiter.acquire("SearchFaces")
+    with stage_metrics.timer("SearchFaces"):
+        return reko.search_faces(**kwargs)
+
+
+@retry_throttled
+def search_faces_by_image_retry(**kwargs):
+    with stage_metrics.timer("RateLimitWait"):
+        rate_limiter.acquire("SearchFacesByImage")
+    with stage_metrics.timer("SearchFacesByImage"):
+        return reko.search_faces_by_image(**kwargs)
+
+
+@retry_throttled
+def create_user_retry(**kwargs):
+    with stage_metrics.timer("CreateUser"):
+        return reko.create_user(**kwargs)
 
 
-def add_search_twin(bucket, s3_path, image_id, collection_id):
-    response_add = reko.index_faces(
+@retry_throttled
+def associate_faces_retry(**kwargs):
+    with stage_metrics.timer("RateLimitWait"):
+        rate_limiter.acquire("AssociateFaces")
+    with stage_metrics.timer("AssociateFaces"):
+        return reko.associate_faces(**kwargs)
+
+
+@retry_throttled
+def search_users_retry(**kwargs):
+    with stage_metrics.timer("RateLimitWait"):
+        rate_limiter.acquire("SearchUsers")
+    with stage_metrics.timer("SearchUsers"):
+        return reko.search_users(**kwargs)
+
+
+@retry_throttled
+def search_users_by_image_retry(**kwargs):
+    with stage_metrics.timer("RateLimitWait"):
+        rate_limiter.acquire("SearchUsersByImage")
+    with stage_metrics.timer("SearchUsersByImage"):
+        return reko.search_users_by_image(**kwargs)
+
+
+def shard_of(image_id):
+    """The collection the faces of an image are indexed in (hash of its ID)"""
+    if len(shards) == 1:
+        return shards[0]
+    digest = hashlib.md5(image_id.encode("UTF-8")).digest()
+    return shards[int.from_bytes(digest[:4], "big") % len(shards)]
+
+
+def top_matches(*match_lists):
+    """The `MAX_FACE_MATCH` (or `MAX_USER_MATCH`) best matches found in several
+    shards"""
+    return heapq.nlargest(
+        max_users_match if search_mode == "users" else max_faces_match,
+        (m for matches in match_lists for m in matches),
+        key=lambda m: m["Similarity"],
+    )
+
+
+def add_search_twin(bucket, s3_path, image_id, collection_id, image=None):
+    face_ids, boxes = index_faces_in_image(
+        bucket, s3_path, image_id, collection_id, image
+    )
+    if not face_ids:
+        return
+    image = image or {"S3Object": {"Bucket": bucket, "Name": s3_path}}
+    return merge_matches(search_faces_in_image(face_ids, collection_id, image, boxes))
+
+
+def index_faces_in_image(
+    bucket, s3_path, image_id, collection_id, image=None, ledger_key=None
+):
+    """Add the faces in the image to the collection, returns their FaceIds and
+    their bounding boxes, largest first.
+
+    The image is read from S3, unless given as a Rekognition `Image` (e.g. bytes).
+    The faces are recorded in the ledger (at `ledger_key`, if given) as soon as
+    they are indexed, so that a later failure never indexes them again.
+    """
+    response_add = index_faces_retry(
         CollectionId=collection_id,
-        Image={"S3Object": {"Bucket": bucket, "Name": s3_path}},
+        Image=image or {"S3Object": {"Bucket": bucket, "Name": s3_path}},
         ExternalImageId=image_id,
         MaxFaces=max_faces_index,
         QualityFilter="AUTO",
         DetectionAttributes=["DEFAULT"],
     )
+    # largest face first, the one SearchFacesByImage searches
+    records = sorted(
+        response_add.get("FaceRecords", []),
+        key=lambda r: r["Face"]["BoundingBox"]["Width"]
+        * r["Face"]["BoundingBox"]["Height"],
+        reverse=True,
+    )
+    face_ids = [r["Face"]["FaceId"] for r in records]
+    boxes = [r["Face"]["BoundingBox"] for r in records]
+    if not face_ids:
+        logger.info(f"no face detected in image {s3_path}")
+        return face_ids, boxes
+    if ledger_key:
+        ledger.indexed(ledger_key, face_ids, boxes)
+    if search_mode == "users":
+        associate_faces(face_ids, image_id.rsplit("_", 1)[0], collection_id)
+    return face_ids, boxes
+
+
+def associate_faces(face_ids, customer_id, collection_id):
+    """Associate the faces of a customer with their user, created if needed.
+
+    The faces that can't be associated (e.g. a bystander, not similar enough to
+    the other faces of the user, a user with the most faces allowed, a customer
+    ID that can't be a UserId, or calls still throttled after their retries) are
+    still searchable, and the failure is only logged and counted: the faces are
+    already indexed, and failing the image would index them again.
+    """
+    try:
+        user_id = user_id_of(customer_id)
+        associate = partial(
+            associate_faces_retry,
+            CollectionId=collection_id,
+            UserId=user_id,
+            FaceIds=face_ids,
+            UserMatchThreshold=user_association_threshold,
+        )
+        if (collection_id, user_id) not in known_users:
+            create_user(collection_id, user_id)
+        try:
+            response = associate()
+        except reko.exceptions.ResourceNotFoundException:
+            # deleted since it was created (e.g. all its faces were evicted)
+            create_user(collection_id, user_id)
+            response = associate()
+    except (ValueError, ClientError):
+        logger.warning(
+            f"Can't associate faces {face_ids} of customer {customer_id}",
+            exc_info=True,
+        )
+        stage_metrics.count("UnassociatedFaces", len(face_ids))
+        return []
+    for failure in response.get("UnsuccessfulFaceAssociations", []):
+        logger.info(f"Face {failure['FaceId']} not associated: {failure['Reasons']}")
+    stage_metrics.count(
+        "UnassociatedFaces", len(response.get("UnsuccessfulFaceAssociations", []))
+    )
+    return [f["FaceId"] for f in response.get("AssociatedFaces", [])]
+
+
+def search_faces_in_image(face_ids, collection_id, image=None, boxes=None, body=None):
+    """Matches of each face of an image, searched concurrently.
+
+    A FaceId can only be searched in its own collection: with sharded
+    collections the other shards are searched with the `image` (if given) for
+    its largest face, and with crops of the image around its other faces (from
+    their bounding `boxes`, cut from the content of the image, `body` if already
+    downloaded). The matches of each face in all the shards are merged.
+    """
+    if not face_ids:
+        return {}
+    other_shards = [s for s in shards if s != collection_id] if image else []
+    if len(face_ids) == 1 and not other_shards:
+        return {face_ids[0]: search_face(face_ids[0], collection_id)}
+    # the image searched in the other shards for each face
+    face_images = {}
+    if other_shards:
+        face_images[face_ids[0]] = image
+        if len(face_ids) > 1:
+            face_images.update(face_crops(face_ids[1:], image, (boxes or [])[1:], body))
+    searches = [(f, s) for f in face_images for s in other_shards]
+    workers = min(max_face_searches, len(face_ids) + len(searches))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda f: search_face(f, collection_id), face_ids)
+        shard_results = pool.map(
+            lambda search: search_image(face_images[search[0]], search[1]), searches
+        )
+        face_matches = dict(zip(face_ids, results))
+        shard_matches = {}
+        for (face_id, _), matches in zip(searches, shard_results):
+            if matches is not None:
+                shard_matches.setdefault(face_id, []).append(matches)
+    for face_id, matches in shard_matches.items():
+        face_matches[face_id] = top_matches(face_matches[face_id], *matches)
+    return face_matches
+
+
+def face_crops(face_ids, image, boxes, body=None):
+    """Crops of an image around some of its faces (with their bounding `boxes`),
+    as Rekognition `Image`s keyed by FaceId.
+
+    The faces that can't be cropped (unknown boxes, e.g. indexed before they were
+    recorded, or an image that can't be decoded) are only searched in their own
+    shard, and counted.
+    """
+    if len(boxes) != len(face_ids):
+        logger.warning(f"No bounding boxes to crop faces {face_ids}")
+        stage_metrics.count("UncroppedFaces", len(face_ids))
+        return {}
     try:
-        face_id = response_add["FaceRecords"][0]["Face"]["FaceId"]
-    except:
-        print("no face detected in image")
-        return
+        with stage_metrics.timer("CropFaces"):
+            if body is None:
+                body = image.get("Bytes")
+            if body is None:
+                s3_object = image["S3Object"]
+                body = s3.get_object(Bucket=s3_object["Bucket"], Key=s3_object["Name"])[
+                    "Body"
+                ].read()
+            crops = crop_faces(body, boxes)
+    except (OSError, ValueError, ClientError):
+        logger.warning(f"Can't crop faces {face_ids}", exc_info=True)
+        stage_metrics.count("UncroppedFaces", len(face_ids))
+        return {}
+    return {face_id: {"Bytes": crop} for face_id, crop in zip(face_ids, crops)}
+
+
+def create_user(collection_id, user_id):
+    try:
+        create_user_retry(CollectionId=collection_id, UserId=user_id)
+    except reko.exceptions.ConflictException:
+        # created by another instance
+        pass
+    known_users.add((collection_id, user_id))
+
+
+def search_image(image, collection_id):
+    """Matches of the largest face in the image, without indexing it"""
+    if search_mode == "users":
+        return search_users_by_image(image, collection_id)
+    try:
+        response_search = search_faces_by_image_retry(
+            CollectionId=collection_id,
+            Image=image,
+            FaceMatchThreshold=threshold,
+            MaxFaces=max_faces_match,
+            QualityFilter="AUTO",
+        )
+    except reko.exceptions.InvalidParameterException:
+        # raised when there is no face in the image
+        logger.info(f"no face detected in image {image.get('S3Object', '')}")
+        return None
+    return response_search["FaceMatches"]
+
+
+def search_image_in_shards(image):
+    """Matches of the largest face in the image in all the shards, merged"""
+    if len(shards) == 1:
+        return search_image(image, shards[0])
+    with ThreadPoolExecutor(max_workers=min(max_face_searches, len(shards))) as pool:
+        results = list(pool.map(lambda s: search_image(image, s), shards))
+    found = [m for m in results if m is not None]
+    return top_matches(*found) if found else None
+
+
+def merge_matches(face_matches):
+    """Matches of all the faces of an image, without duplicates.
 
+    A face (or user) matched by several faces of the image is kept once, with the
+    highest similarity, and the ID of the face of the image it matched
+    (`SearchedFaceId`, unless the face was screened without being enrolled).
+    """
+    best = {}
+    for searched_face_id, matches in face_matches.items():
+        for m in matches:
+            matched_id = next(iter(matched_ref(m).values()))
+            if matched_id in face_matches:
+                # another face of the same image
+                continue
+            if (
+                matched_id not in best
+                or m["Similarity"] > best[matched_id]["Similarity"]
+            ):
+                best[matched_id] = (
+                    {**m, "SearchedFaceId": searched_face_id}
+                    if searched_face_id is not None
+                    else m
+                )
+    return sorted(best.values(), key=lambda m: m["Similarity"], reverse=True)
+
+
+def matched_ref(match):
+    """Reference to what a match matched: {"FaceId": ...} or {"UserId": ...}"""
+    if "User" in match:
+        return {"UserId": match["User"]["UserId"]}
+    return {"FaceId": match["Face"]["FaceId"]}
+
+
+def matched_customer(match):
+    if "User" in match:
+        return customer_id_of_user(match["User"]["UserId"])
+    return match["Face"]["ExternalImageId"].rsplit("_", 1)[0]
+
+
+def other_customers(matches, customer_id):
+    """Matches with faces (or users) of other customers, tagged with their
+    customer ID"""
+    tagged = [{**k, "CustomerId": matched_customer(k)} for k in matches]
+    return [k for k in tagged if k["CustomerId"] != customer_id]
+
+
+def search_face(face_id, collection_id):
+    """Matches of an indexed face in the collection"""
+    if search_mode == "users":
+        return search_users(face_id, collection_id)
     response_search = search_faces_retry(
         CollectionId=collection_id,
         FaceId=face_id,
@@ -99,3 +987,37 @@ def add_search_twin(bucket, s3_path, image_id, collection_id):
 
     faceMatches = response_search["FaceMatches"]
     return faceMatches
+
+
+def search_users(face_id, collection_id):
+    """Users matching an indexed face in the collection, as matches"""
+    response_search = search_users_retry(
+        CollectionId=collection_id,
+        FaceId=face_id,
+        UserMatchThreshold=threshold,
+        MaxUsers=max_users_match,
+    )
+    return [user_match(m) for m in response_search["UserMatches"]]
+
+
+def search_users_by_image(image, collection_id):
+    """Users matching the largest face in the image, as matches"""
+    try:
+        response_search = search_users_by_image_retry(
+            CollectionId=collection_id,
+            Image=image,
+            UserMatchThreshold=threshold,
+            MaxUsers=max_users_match,
+            QualityFilter="AUTO",
+        )
+    except reko.exceptions.InvalidParameterException:
+        # raised when there is no face in the image
+        logger.info(f"no face detected in image {image.get('S3Object', '')}")
+        return None
+    return [user_match(m) for m in response_search["UserMatches"]]
+
+
+def user_match(m):
+    """A match of `SearchUsers`, in the format of the face matches of the reports
+    (with a `User` instead of a `Face`)"""
+    return {"Similarity": m["Similarity"], "User": m["User"]}
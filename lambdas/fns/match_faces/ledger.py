@@ -0,0 +1,292 @@
+"""Ingestion ledger: remembers which images have already been indexed.
+
+SQS delivers messages at least once, and the same object can be uploaded more than
+once: without a ledger every delivery indexes the image again, adding a duplicate
+face to the collection (that then matches itself) and paying for it.
+
+The ledger has one entry per image version, keyed by bucket, key and ETag, that
+goes through these states:
+
+- "claimed": a worker is indexing the image. Claims expire after `lease` seconds,
+  so that an image whose worker died is eventually processed again.
+- "indexed": the faces are in the collection (`face_ids`, and their `boxes` in
+  the image, to search them in the other shards), the report is missing. A
+  retry only searches the stored faces again.
+- "done": the report has been written, to the object `report_key` (None when
+  there was nothing to report), nothing is left to do. Only the key is stored:
+  reports can be larger than an item.
+
+Entries are created with conditional writes, so that concurrent deliveries of the
+same image don't both index it.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+from face_match import clients
+
+
+class ConditionFailed(Exception):
+    """A conditional write found the entry in an unexpected state"""
+
+
+class ImageInProgress(Exception):
+    """Another worker holds a live claim on the image"""
+
+
+class InMemoryLedgerStore:
+    """Entries local to the process, for tests and single-instance runs.
+
+    Only the `max_entries` most recently used entries are kept.
+    """
+
+    def __init__(self, max_entries=10000):
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return dict(item)
+
+    def put(self, key, item, if_absent=False, if_match=None):
+        """Write an entry, optionally only if missing or if `attr == value`"""
+        with self._lock:
+            current = self._items.get(key)
+            if if_absent and current is not None:
+                raise ConditionFailed(key)
+            if if_match is not None:
+                attr, value = if_match
+                if current is None or current.get(attr) != value:
+                    raise ConditionFailed(key)
+            self._items[key] = dict(item)
+            self._items.move_to_end(key)
+            if self.max_entries and len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def delete(self, key, if_match=None):
+        """Delete an entry, optionally only if `attr == value`"""
+        with self._lock:
+            if if_match is not None:
+                attr, value = if_match
+                current = self._items.get(key)
+                if current is None or current.get(attr) != value:
+                    raise ConditionFailed(key)
+            self._items.pop(key, None)
+
+    def scan(self):
+        """All the (key, entry) pairs"""
+        with self._lock:
+            return [(key, dict(item)) for key, item in self._items.items()]
+
+
+class DynamoDBLedgerStore:
+    """Entries stored as items of a DynamoDB table with a string partition key `image`"""
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or clients.lazy("dynamodb")
+
+    def get(self, key):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={"image": {"S": key}},
+            ConsistentRead=True,
+        ).get("Item")
+        if item is None:
+            return None
+        return self._entry(item)
+
+    @staticmethod
+    def _entry(item):
+        return {
+            "status": item["status"]["S"],
+            "updated": float(item["updated"]["N"]),
+            "face_ids": [f["S"] for f in item.get("face_ids", {}).get("L", [])],
+            "report_key": item.get("report_key", {}).get("S"),
+            "boxes": json.loads(item["boxes"]["S"]) if "boxes" in item else None,
+        }
+
+    def put(self, key, item, if_absent=False, if_match=None):
+        attributes = {
+            "image": {"S": key},
+            "status": {"S": item["status"]},
+            "updated": {"N": repr(item["updated"])},
+            "face_ids": {"L": [{"S": f} for f in item.get("face_ids", [])]},
+        }
+        if item.get("report_key") is not None:
+            attributes["report_key"] = {"S": item["report_key"]}
+        if item.get("boxes") is not None:
+            attributes["boxes"] = {"S": json.dumps(item["boxes"])}
+        condition = {}
+        if if_absent:
+            condition = {
+                "ConditionExpression": "attribute_not_exists(#image)",
+                "ExpressionAttributeNames": {"#image": "image"},
+            }
+        elif if_match is not None:
+            condition = self._condition(*if_match)
+        try:
+            self.client.put_item(
+                TableName=self.table_name, Item=attributes, **condition
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                raise ConditionFailed(key)
+            raise
+
+    @staticmethod
+    def _condition(attr, value):
+        return {
+            "ConditionExpression": "#attr = :value",
+            "ExpressionAttributeNames": {"#attr": attr},
+            "ExpressionAttributeValues": {
+                ":value": (
+                    {"N": repr(value)}
+                    if isinstance(value, (int, float))
+                    else {"S": value}
+                )
+            },
+        }
+
+    def delete(self, key, if_match=None):
+        condition = self._condition(*if_match) if if_match is not None else {}
+        try:
+            self.client.delete_item(
+                TableName=self.table_name, Key={"image": {"S": key}}, **condition
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                raise ConditionFailed(key)
+            raise
+
+    def _scan_segment(self, segment, segments):
+        entries = []
+        kwargs = {
+            "TableName": self.table_name,
+            "Segment": segment,
+            "TotalSegments": segments,
+            # (the keys of the reports and the boxes are not needed)
+            "ProjectionExpression": "#image, #status, #updated, #face_ids",
+            "ExpressionAttributeNames": {
+                "#image": "image",
+                "#status": "status",
+                "#updated": "updated",
+                "#face_ids": "face_ids",
+            },
+        }
+        while True:
+            response = self.client.scan(**kwargs)
+            entries.extend(
+                (item["image"]["S"], self._entry(item)) for item in response["Items"]
+            )
+            if "LastEvaluatedKey" not in response:
+                return entries
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def scan(self, segments=8):
+        """All the (key, entry) pairs, without the report keys, read by a parallel
+        scan of `segments` segments"""
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            results = pool.map(
+                lambda segment: self._scan_segment(segment, segments),
+                range(segments),
+            )
+            return [entry for entries in results for entry in entries]
+
+
+class IngestionLedger:
+    """Claim, progress and completion of the ingestion of images.
+
+    Args:
+        store: backend of the entries, e.g. `InMemoryLedgerStore()`.
+        lease: seconds after which the claim of a worker can be taken over.
+    """
+
+    def __init__(self, store, lease=300.0, clock=time.time):
+        self.store = store
+        self.lease = lease
+        self.clock = clock
+
+    @staticmethod
+    def key(bucket, object_key, etag):
+        etag = etag.strip('"')
+        return f"{bucket}/{object_key}#{etag}"
+
+    def begin(self, key):
+        """Claim an image before indexing it.
+
+        Returns None if the image is new (and now claimed by the caller), or the
+        stored entry if the image was already indexed ("indexed", with its
+        `face_ids`) or fully processed ("done", with its `report_key` too).
+
+        Raises:
+            ImageInProgress: if another worker is processing the image.
+        """
+        now = self.clock()
+        claim = {"status": "claimed", "updated": now}
+        entry = None
+        while entry is None:
+            try:
+                self.store.put(key, claim, if_absent=True)
+                return None
+            except ConditionFailed:
+                # (the entry can be released between the two calls)
+                entry = self.store.get(key)
+        if entry["status"] != "claimed":
+            return entry
+        if now - entry["updated"] < self.lease:
+            raise ImageInProgress(key)
+        # the claim expired, take it over (unless someone else did it first)
+        try:
+            self.store.put(key, claim, if_match=("updated", entry["updated"]))
+        except ConditionFailed:
+            raise ImageInProgress(key)
+        return None
+
+    def get(self, key):
+        """The entry of an image, or None"""
+        return self.store.get(key)
+
+    def indexed(self, key, face_ids, boxes=None):
+        """Record the faces indexed from an image, and their bounding `boxes`"""
+        self.store.put(
+            key,
+            {
+                "status": "indexed",
+                "updated": self.clock(),
+                "face_ids": face_ids,
+                "boxes": boxes,
+            },
+        )
+
+    def done(self, key, face_ids, report_key=None):
+        """Mark an image as processed, its report written to `report_key`"""
+        self.store.put(
+            key,
+            {
+                "status": "done",
+                "updated": self.clock(),
+                "face_ids": face_ids,
+                "report_key": report_key,
+            },
+        )
+
+    def release(self, key):
+        """Drop the claim of an image that failed before being indexed.
+
+        An image whose faces were indexed before the failure keeps its entry, so
+        that the retry only searches them again.
+        """
+        try:
+            self.store.delete(key, if_match=("status", "claimed"))
+        except ConditionFailed:
+            pass
@@ -0,0 +1,318 @@
+"""Near-duplicate detection of the uploaded images with a perceptual hash.
+
+The same photo is often uploaded again, under another key or lightly re-encoded.
+Its faces are already in the collection, so instead of indexing and searching them
+again the FaceIds and the report of the first upload are reused.
+
+Images are compared with a 64-bit difference hash (dHash), which survives
+re-encoding, resizing and small colour changes. Two images are near-duplicates
+when their hashes differ by at most `max_distance` bits.
+
+The index uses multi-index hashing: the hash is split into `n` bands, and by
+the pigeonhole principle two hashes within `max_distance` bits differ by at most
+`max_distance // n` bits on at least one band. A lookup lists the hashes with a
+band within that many bits of a band of the hash, then checks the Hamming
+distance of these few candidates.
+
+The hashes seen by an instance are kept in memory (at most `cache_size`), split
+into `max_distance + 1` bands looked up exactly. DynamoDB stores them the same
+way by default, one item per band, so that a lookup is one query per band (4 at
+a distance of 3, run concurrently). The hashes of a band value are a partition
+read by every lookup, of about n / 2**16 items for n hashes at a distance of 3:
+for many more hashes, wider bands (`band_bits`) keep the partitions small, at
+the cost of querying the band values near those of the hash too (66 queries
+with 2 bands of 32 bits).
+
+Pillow is only imported when an image is hashed.
+"""
+
+import io
+import itertools
+import json
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from face_match import clients
+
+HASH_BITS = 64
+
+
+def dhash(body):
+    """Difference hash of an image, as a 64-bit int"""
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(body))
+    # let the JPEG decoder downscale, instead of decoding the full image
+    image.draft("L", (64, 64))
+    image = ImageOps.exif_transpose(image).convert("L").resize((9, 8), Image.BILINEAR)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left, right = pixels[row * 9 + col], pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def bands(value, n_bands):
+    """The bands of a hash, as (band index, band value) pairs"""
+    width = -(-HASH_BITS // n_bands)
+    mask = (1 << width) - 1
+    return [(i, (value >> (i * width)) & mask) for i in range(n_bands)]
+
+
+def neighbours(band, width, radius):
+    """The values of `width` bits that differ from `band` by at most `radius`
+    bits, `band` first"""
+    yield band
+    for distance in range(1, radius + 1):
+        for bits in itertools.combinations(range(width), distance):
+            flipped = band
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+
+class InMemoryHashStore:
+    """Hashes local to the process, indexed by band in dicts.
+
+    Only the `max_entries` most recently added or found hashes are kept (all of
+    them if 0).
+    """
+
+    def __init__(self, n_bands, max_entries=0):
+        self.n_bands = n_bands
+        self.max_entries = max_entries
+        self._items = OrderedDict()  # id -> (hash, entry)
+        self._bands = [{} for _ in range(n_bands)]  # band value -> ids
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, value, entry):
+        with self._lock:
+            item_id = next(self._ids)
+            self._items[item_id] = (value, entry)
+            for i, band in bands(value, self.n_bands):
+                self._bands[i].setdefault(band, set()).add(item_id)
+            while self.max_entries and len(self._items) > self.max_entries:
+                self._remove(next(iter(self._items)))
+
+    def _remove(self, item_id):
+        value, _ = self._items.pop(item_id)
+        for i, band in bands(value, self.n_bands):
+            ids = self._bands[i][band]
+            ids.discard(item_id)
+            if not ids:
+                del self._bands[i][band]
+
+    def candidates(self, value):
+        """(hash, entry) pairs equal to `value` on at least one band"""
+        with self._lock:
+            ids = set()
+            for i, band in bands(value, self.n_bands):
+                ids.update(self._bands[i].get(band, ()))
+            for item_id in ids:
+                self._items.move_to_end(item_id)
+            return [self._items[item_id] for item_id in ids]
+
+    def remove_faces(self, face_ids):
+        """Forget the images with any of the faces, returns how many"""
+        with self._lock:
+            removed = [
+                item_id
+                for item_id, (_, entry) in self._items.items()
+                if not face_ids.isdisjoint(entry["face_ids"])
+            ]
+            for item_id in removed:
+                self._remove(item_id)
+        return len(removed)
+
+
+class DynamoDBHashStore:
+    """Hashes stored in a DynamoDB table, one item per band of every hash.
+
+    The table has a string partition key `band` ("<index>:<value>") and a string
+    sort key `hash` (the hash, then the ledger key of the image, to keep them
+    unique). A lookup queries the partitions of the band values within
+    `max_distance // n_bands` bits of the bands of the hash: only the bands of
+    the hash with the default `max_distance + 1` bands.
+
+    Args:
+        table_name: name of the table.
+        max_distance: maximum number of bits by which near-duplicates differ.
+        band_bits: width of the bands (`64 // (max_distance + 1)` by default),
+            the wider the fewer hashes per partition but the more partitions to
+            query.
+        workers: partitions queried concurrently, by default as many as the
+            connections of the client (`clients.pool_size()`).
+    """
+
+    def __init__(
+        self, table_name, max_distance, band_bits=None, client=None, workers=None
+    ):
+        self.table_name = table_name
+        self.n_bands = -(-HASH_BITS // band_bits) if band_bits else max_distance + 1
+        self.width = -(-HASH_BITS // self.n_bands)
+        self.radius = max_distance // self.n_bands
+        self.client = client or clients.lazy("dynamodb")
+        probes = self.n_bands * sum(
+            math.comb(self.width, d) for d in range(self.radius + 1)
+        )
+        self._pool = ThreadPoolExecutor(
+            max_workers=min(workers or clients.pool_size(), probes)
+        )
+
+    @staticmethod
+    def _band_key(i, band):
+        return f"{i}:{band:x}"
+
+    def add(self, value, entry):
+        sort_key = f"{value:016x}#{entry.get('ledger_key') or ''}"
+        requests = [
+            {
+                "PutRequest": {
+                    "Item": {
+                        "band": {"S": self._band_key(i, band)},
+                        "hash": {"S": sort_key},
+                        "entry": {"S": json.dumps(entry)},
+                    }
+                }
+            }
+            for i, band in bands(value, self.n_bands)
+        ]
+        while requests:
+            response = self.client.batch_write_item(
+                RequestItems={self.table_name: requests}
+            )
+            requests = response.get("UnprocessedItems", {}).get(self.table_name, [])
+
+    def _query(self, band_key):
+        items = []
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "#band = :band",
+            "ExpressionAttributeNames": {"#band": "band"},
+            "ExpressionAttributeValues": {":band": {"S": band_key}},
+        }
+        while True:
+            response = self.client.query(**kwargs)
+            items.extend(response["Items"])
+            if "LastEvaluatedKey" not in response:
+                return items
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def _scan_segment(self, segment, segments, face_ids):
+        keys = []
+        kwargs = {
+            "TableName": self.table_name,
+            "Segment": segment,
+            "TotalSegments": segments,
+        }
+        while True:
+            response = self.client.scan(**kwargs)
+            for item in response["Items"]:
+                entry = json.loads(item["entry"]["S"])
+                if not face_ids.isdisjoint(entry["face_ids"]):
+                    keys.append({"band": item["band"], "hash": item["hash"]})
+            if "LastEvaluatedKey" not in response:
+                return keys
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def remove_faces(self, face_ids, segments=8):
+        """Delete the images with any of the faces (all their bands), found by a
+        parallel scan of the table. Returns how many.
+
+        The scan reads the whole table: this is for offline maintenance (e.g.
+        `tools/collection.py` after deleting faces), not for the functions.
+        """
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            results = pool.map(
+                lambda segment: self._scan_segment(segment, segments, face_ids),
+                range(segments),
+            )
+            keys = [key for keys in results for key in keys]
+        requests = [{"DeleteRequest": {"Key": key}} for key in keys]
+        # BatchWriteItem takes at most 25 requests
+        for i in range(0, len(requests), 25):
+            batch = requests[i : i + 25]
+            while batch:
+                response = self.client.batch_write_item(
+                    RequestItems={self.table_name: batch}
+                )
+                batch = response.get("UnprocessedItems", {}).get(self.table_name, [])
+        return len({key["hash"]["S"] for key in keys})
+
+    def candidates(self, value):
+        band_keys = [
+            self._band_key(i, probe)
+            for i, band in bands(value, self.n_bands)
+            for probe in neighbours(band, self.width, self.radius)
+        ]
+        found = {}
+        for items in self._pool.map(self._query, band_keys):
+            for item in items:
+                sort_key = item["hash"]["S"]
+                if sort_key not in found:
+                    found[sort_key] = (
+                        int(sort_key.split("#", 1)[0], 16),
+                        json.loads(item["entry"]["S"]),
+                    )
+        return list(found.values())
+
+
+class HashIndex:
+    """Near-duplicate lookups of image hashes.
+
+    Args:
+        store: durable backend of the hashes, e.g. `DynamoDBHashStore(...)`, or
+            None to only keep the hashes in memory.
+        max_distance: maximum number of bits by which near-duplicates differ.
+        cache_size: hashes kept in memory, the most recently used ones.
+
+    The hashes seen by the process are also kept in memory, so that the images
+    duplicated within a warm instance are found without calling the store.
+    """
+
+    def __init__(self, store=None, max_distance=3, cache_size=100000):
+        self.max_distance = max_distance
+        self.n_bands = max_distance + 1
+        self.store = store
+        self.cache = InMemoryHashStore(self.n_bands, max_entries=cache_size)
+
+    def add(self, value, entry):
+        self.cache.add(value, entry)
+        if self.store is not None:
+            self.store.add(value, entry)
+
+    def _nearest(self, value, candidates):
+        best = None
+        for candidate, entry in candidates:
+            distance = hamming(value, candidate)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, entry)
+        return best
+
+    def remove_faces(self, face_ids):
+        """Forget the images with any of the faces (e.g. deleted from the
+        collection), so that their re-uploads are indexed again"""
+        face_ids = set(face_ids)
+        removed = self.cache.remove_faces(face_ids)
+        if self.store is not None:
+            removed = self.store.remove_faces(face_ids)
+        return removed
+
+    def lookup(self, value):
+        """(distance, entry) of the nearest hash in the index, or None"""
+        best = self._nearest(value, self.cache.candidates(value))
+        if best is None and self.store is not None:
+            best = self._nearest(value, self.store.candidates(value))
+        return best
@@ -0,0 +1,159 @@
+"""Downscaling of the large uploads before they are sent to Rekognition.
+
+Phone photos are often 12 megapixels or more: Rekognition takes longer to
+process them, and rejects the ones over its limits (15 MB for an S3 object,
+5 MB for bytes). Faces are detected as well in a few megapixels, so the images
+larger than `max_dimension` pixels (or than the S3 object limit) are
+downscaled, with their EXIF orientation applied, re-encoded as JPEG and sent as
+`Bytes`. The other images are still passed by reference (`S3Object`), without
+being downloaded.
+
+The dimensions are read from the header of the image, the first `header_bytes`
+of the object fetched with a ranged GET, without decoding it. JPEG images are
+decoded directly at a reduced scale (the `draft` mode of the decoder), the
+cheapest way to downscale them. The full GET of an image to downscale and its
+decoding both run in a pool of `workers` threads (Pillow releases the GIL while
+decoding and resizing), so that at most `workers` images read by the normalizer
+are held in memory at once. The images whose content is given (e.g. downloaded
+by the caller to hash them) are already in memory, and only their decoding waits
+for the pool.
+
+With sharded collections, the faces of an image other than the largest one are
+searched in the other shards with crops of the image around them
+(`crop_faces`), since `SearchFacesByImage` only searches the largest face.
+
+Pillow is only imported when an image is normalized (or cropped).
+"""
+
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+# the largest images Rekognition accepts
+S3_OBJECT_MAX_BYTES = 15 * 2**20
+IMAGE_BYTES_MAX_BYTES = 5 * 2**20
+
+
+def image_size(head):
+    """Width and height of an image from its first bytes, or None if unknown"""
+    from PIL import Image
+
+    try:
+        # (only the header is parsed, until the pixels are accessed)
+        with Image.open(io.BytesIO(head)) as image:
+            return image.size
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+
+def object_size(response):
+    """Size of an object, from the response to a ranged GET"""
+    content_range = response.get("ContentRange")
+    if content_range:
+        return int(content_range.rsplit("/", 1)[1])
+    return response["ContentLength"]
+
+
+def downscale(body, max_dimension, quality=90, max_bytes=IMAGE_BYTES_MAX_BYTES):
+    """JPEG of the image, upright and at most `max_dimension` pixels wide and
+    high, and at most `max_bytes` long"""
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(body))
+    # let the JPEG decoder downscale, to no less than the target size
+    scale = max_dimension / max(image.size)
+    if scale < 1:
+        image.draft("RGB", (int(image.width * scale), int(image.height * scale)))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    image.thumbnail((max_dimension, max_dimension), Image.BICUBIC)
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        if buffer.tell() <= max_bytes or quality <= 50:
+            return buffer.getvalue()
+        quality -= 15
+
+
+def crop_faces(body, boxes, margin=0.25, max_dimension=1920, quality=90):
+    """JPEG crops of an image around faces, upright, one per Rekognition
+    `BoundingBox` (relative to the upright image), widened by `margin` of the size
+    of the face on each side. The image is decoded at no more than
+    `max_dimension` pixels."""
+    from PIL import Image, ImageOps
+
+    image = Image.open(io.BytesIO(body))
+    scale = max_dimension / max(image.size)
+    if scale < 1:
+        image.draft("RGB", (int(image.width * scale), int(image.height * scale)))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    crops = []
+    for box in boxes:
+        dx, dy = box["Width"] * margin, box["Height"] * margin
+        left = max(0.0, box["Left"] - dx)
+        top = max(0.0, box["Top"] - dy)
+        right = min(1.0, box["Left"] + box["Width"] + dx)
+        bottom = min(1.0, box["Top"] + box["Height"] + dy)
+        face = image.crop(
+            (
+                int(left * image.width),
+                int(top * image.height),
+                max(int(left * image.width) + 1, round(right * image.width)),
+                max(int(top * image.height) + 1, round(bottom * image.height)),
+            )
+        )
+        buffer = io.BytesIO()
+        face.save(buffer, format="JPEG", quality=quality)
+        crops.append(buffer.getvalue())
+    return crops
+
+
+class ImageNormalizer:
+    """The image of an S3 object to send to Rekognition, downscaled if needed.
+
+    Args:
+        get_object: `get_object(**kwargs)` of an S3 client.
+        max_dimension: width or height above which an image is downscaled.
+        workers: images decoded concurrently.
+        header_bytes: bytes read to find the dimensions of an image.
+        quality: JPEG quality of the downscaled images.
+    """
+
+    def __init__(
+        self, get_object, max_dimension, workers=2, header_bytes=65536, quality=90
+    ):
+        self.get_object = get_object
+        self.max_dimension = max_dimension
+        self.header_bytes = header_bytes
+        self.quality = quality
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="normalize"
+        )
+
+    def needs_downscale(self, size, dimensions):
+        if size > S3_OBJECT_MAX_BYTES:
+            return True
+        return dimensions is not None and max(dimensions) > self.max_dimension
+
+    def image(self, bucket, key, body=None):
+        """Rekognition `Image` of an object: a reference to it, or the bytes of a
+        downscaled copy. The object is only read if its content (`body`) is not
+        given. Raises `OSError` (or `ValueError`) if it can't be decoded."""
+        if body is not None:
+            head, size = body[: self.header_bytes], len(body)
+        else:
+            response = self.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes=0-{self.header_bytes - 1}"
+            )
+            head = response["Body"].read()
+            size = object_size(response)
+        if not self.needs_downscale(size, image_size(head)):
+            return {"S3Object": {"Bucket": bucket, "Name": key}}
+        if body is None and size <= len(head):
+            body = head
+        future = self._pool.submit(self._downscale, bucket, key, body)
+        return {"Bytes": future.result()}
+
+    def _downscale(self, bucket, key, body=None):
+        # (the object is read in the pool, to bound the images held in memory)
+        if body is None:
+            body = self.get_object(Bucket=bucket, Key=key)["Body"].read()
+        return downscale(body, self.max_dimension, self.quality)
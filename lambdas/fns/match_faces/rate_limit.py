@@ -0,0 +1,181 @@
+"""Client-side rate limiting of the Rekognition calls.
+
+Every call reserves a token from a token bucket (one per operation) before being
+sent. The buckets live in a store shared by all the concurrent instances of the
+function, so that together they pace their calls to the account TPS quota, instead
+of each of them bursting, being throttled, and retrying at the same time as the
+others.
+
+A reservation never fails: when the bucket is empty the tokens go negative (a debt
+paid back at the refill rate), and the caller sleeps for the time it takes to pay
+its share back.
+"""
+
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from face_match import clients
+
+THROTTLING_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "LimitExceededException",
+}
+
+
+def is_throttling(exception):
+    return (
+        isinstance(exception, ClientError)
+        and exception.response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+    )
+
+
+def _reserve(tokens, updated, rate, burst, now):
+    """Take one token from a bucket last updated at `updated`.
+
+    Returns the tokens left in the bucket, and the seconds to wait before the
+    reserved token becomes available.
+    """
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate) - 1
+    return tokens, max(0.0, -tokens / rate)
+
+
+class InMemoryBucketStore:
+    """Buckets local to the process, shared only by the threads of one instance"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, delay = _reserve(tokens, updated, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+        return delay
+
+
+class DynamoDBBucketStore:
+    """Buckets stored as items of a DynamoDB table, shared by all the instances.
+
+    The table has a string partition key `bucket`. A bucket is stored as the time
+    its last reserved token becomes available (`tat`, the theoretical arrival
+    time of the generic cell rate algorithm, equivalent to the token bucket): a
+    reservation of `n` tokens moves it `n / rate` seconds later, with a single
+    atomic `UpdateItem` that returns the new value. Only the first reservation
+    after an idle period (when `tat` is in the past) takes a second write, to
+    bring `tat` back to the present.
+
+    To spread the load on the item of a bucket, every round trip leases `block`
+    tokens, handed out locally to the next calls of the instance. The tokens
+    leased but not used within `lease` seconds of their time are dropped.
+    """
+
+    def __init__(self, table_name, client=None, block=1, lease=1.0, max_attempts=5):
+        self.table_name = table_name
+        self.client = client or clients.lazy("dynamodb")
+        self.block = block
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._leased = {}
+        self._lock = threading.Lock()
+
+    def _update(self, key, cost, now):
+        """Move the `tat` of a bucket `cost` seconds later, returns its new value"""
+        for _ in range(self.max_attempts):
+            try:
+                response = self.client.update_item(
+                    TableName=self.table_name,
+                    Key={"bucket": {"S": key}},
+                    UpdateExpression="SET #tat = if_not_exists(#tat, :now) + :cost",
+                    ConditionExpression="attribute_not_exists(#tat) OR #tat >= :now",
+                    ExpressionAttributeNames={"#tat": "tat"},
+                    ExpressionAttributeValues={
+                        ":now": {"N": repr(now)},
+                        ":cost": {"N": repr(cost)},
+                    },
+                    ReturnValues="UPDATED_NEW",
+                )
+                return float(response["Attributes"]["tat"]["N"])
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+            # the bucket was idle: restart it from now (unless another instance
+            # just did, then the first update applies)
+            try:
+                self.client.update_item(
+                    TableName=self.table_name,
+                    Key={"bucket": {"S": key}},
+                    UpdateExpression="SET #tat = :tat",
+                    ConditionExpression="#tat < :now",
+                    ExpressionAttributeNames={"#tat": "tat"},
+                    ExpressionAttributeValues={
+                        ":now": {"N": repr(now)},
+                        ":tat": {"N": repr(now + cost)},
+                    },
+                )
+                return now + cost
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+        return None
+
+    def reserve(self, key, rate, burst, now):
+        with self._lock:
+            leased = self._leased.get(key)
+            while leased and leased[0] < now - self.lease:
+                leased.pop(0)
+            if leased:
+                return max(0.0, leased.pop(0) - now)
+        tat = self._update(key, self.block / rate, now)
+        if tat is None:
+            # Too much contention on the bucket, fall back on pacing at the
+            # nominal rate
+            return 1.0 / rate
+        # the time each leased token becomes available (`burst` tokens can be
+        # used at once)
+        first = tat - self.block / rate - (burst - 1) / rate
+        times = [first + i / rate for i in range(self.block)]
+        if len(times) > 1:
+            with self._lock:
+                self._leased.setdefault(key, []).extend(times[1:])
+        return max(0.0, times[0] - now)
+
+
+class RateLimiter:
+    """Pace calls to a set of operations, each with its own TPS budget.
+
+    Args:
+        store: where the token buckets are kept, e.g. `InMemoryBucketStore()`.
+        rates: TPS budget by operation name. Operations without a budget (or with a
+            budget of 0) are not limited.
+        burst: number of calls that can be made at once after an idle period, by
+            default one second worth of calls.
+        namespace: prefix of the bucket keys, to share a store between budgets.
+    """
+
+    def __init__(
+        self, store, rates, burst=None, namespace="", clock=time.time, sleep=time.sleep
+    ):
+        self.store = store
+        self.rates = rates
+        self.burst = burst
+        self.namespace = namespace
+        self.clock = clock
+        self.sleep = sleep
+
+    def acquire(self, operation):
+        """Block until a call to `operation` fits in its budget"""
+        rate = self.rates.get(operation)
+        if not rate:
+            return 0.0
+        delay = self.store.reserve(
+            f"{self.namespace}{operation}",
+            rate,
+            self.burst or max(1.0, rate),
+            self.clock(),
+        )
+        if delay:
+            self.sleep(delay)
+        return delay
@@ -0,0 +1,53 @@
+"""Rekognition users: one user per customer ID, in every collection (shard).
+
+The faces of a customer are associated with their user when they are indexed,
+so that `SearchUsers` returns distinct customers instead of individual faces
+(most of them belonging to the same customer, when customers have many photos).
+
+A UserId can only hold `[a-zA-Z0-9_.\\-:]` characters: the other characters of a
+customer ID (and ":", the escape character) are escaped as `:XX`, the hex value
+of each of their UTF-8 bytes, so that the customer ID of a user is known without
+any lookup.
+"""
+
+import re
+import threading
+
+USER_ID_SAFE = re.compile(rb"[a-zA-Z0-9_.\-]")
+USER_ID_ESCAPE = re.compile(rb":([0-9A-F]{2})")
+USER_ID_MAX_LENGTH = 128
+
+
+def user_id_of(customer_id):
+    """UserId of a customer ID"""
+    encoded = "".join(
+        chr(b) if USER_ID_SAFE.match(bytes([b])) else f":{b:02X}"
+        for b in customer_id.encode("UTF-8")
+    )
+    if len(encoded) > USER_ID_MAX_LENGTH:
+        raise ValueError(f"Customer ID too long for a UserId: {customer_id}")
+    return encoded
+
+
+def customer_id_of_user(user_id):
+    """Customer ID of a UserId, the reverse of `user_id`"""
+    return USER_ID_ESCAPE.sub(
+        lambda m: bytes([int(m.group(1), 16)]), user_id.encode("UTF-8")
+    ).decode("UTF-8")
+
+
+class KnownUsers:
+    """The users known to exist, by collection, so that they are created once per
+    instance (creating an existing user fails, and is harmless)"""
+
+    def __init__(self):
+        self._users = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._users
+
+    def add(self, key):
+        with self._lock:
+            self._users.add(key)
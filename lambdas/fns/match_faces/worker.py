@@ -0,0 +1,345 @@
+"""Long-running worker processing the SQS queue with the `match_faces` code.
+
+For sustained heavy traffic, the worker runs the same processing as the lambda
+function, as a container task, without its per-invocation overhead and
+concurrency cap. Messages flow through bounded stages, so that a slow stage
+holds back the ones before it instead of piling up messages:
+
+- pollers long-poll the queue (up to 10 messages per call), only when there is
+  room for more messages in flight (at most `max_in_flight`),
+- `MAX_WORKERS` threads process the messages (index, search, and write the
+  reports in "object" output mode), as the record workers of the lambda do,
+- a single output thread writes the outputs shared by several messages (batch
+  reports and match store, see `write_outputs`) every `output_batch` messages
+  or `output_interval` seconds, then deletes the messages in batches of 10.
+
+The visibility of the messages in flight is extended while they are processed,
+so that slow images are not delivered again to another worker. Failed messages
+are left to reappear after their visibility timeout, as with the lambda (and
+the redrive policy of the queue applies).
+
+On SIGTERM or SIGINT the worker stops polling, returns the messages it has not
+started to the queue, finishes the ones in progress and writes their outputs
+before exiting.
+
+Usage (in the directory of the function, with the common layer importable):
+    QUEUE_URL=<queue url> COLLECTION_NAME=... BUCKET_OUT=... python worker.py
+"""
+
+import importlib
+import os
+import queue
+import signal
+import threading
+import time
+import uuid
+
+from aws_lambda_powertools import Logger
+from face_match import clients
+
+logger = Logger()
+
+# the largest batch of the SQS batch APIs
+SQS_BATCH = 10
+
+
+def to_record(message):
+    """The SQS event record of a message, as the lambda function receives it"""
+    return {
+        "messageId": message["MessageId"],
+        "receiptHandle": message["ReceiptHandle"],
+        "body": message["Body"],
+        "attributes": message.get("Attributes", {}),
+        # (the event uses camelCase keys, e.g. "stringValue")
+        "messageAttributes": {
+            name: {k[0].lower() + k[1:]: v for k, v in attribute.items()}
+            for name, attribute in message.get("MessageAttributes", {}).items()
+        },
+    }
+
+
+def chunks(items, size=SQS_BATCH):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class QueueWorker:
+    """Pipeline processing the messages of a queue with a `match_faces` module.
+
+    Args:
+        fn: the handler module of the function (`lambda.py`), already configured.
+        sqs: SQS client.
+        queue_url: URL of the queue.
+        max_in_flight: messages received and not deleted yet (default: twice the
+            processing threads).
+        visibility_timeout: seconds the messages received are invisible for,
+            extended while they are processed.
+        wait_time: long polling time of the receive calls, in seconds.
+        output_batch, output_interval: messages, and seconds, after which the
+            outputs are written and the messages deleted.
+    """
+
+    def __init__(
+        self,
+        fn,
+        sqs,
+        queue_url,
+        max_in_flight=None,
+        visibility_timeout=120,
+        wait_time=20,
+        output_batch=100,
+        output_interval=5.0,
+    ):
+        self.fn = fn
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.workers = fn.max_workers
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.visibility_timeout = visibility_timeout
+        self.wait_time = wait_time
+        if not fn.batched_outputs:
+            # only the deletes are batched
+            output_batch, output_interval = SQS_BATCH, min(output_interval, 1.0)
+        self.output_batch = output_batch
+        self.output_interval = output_interval
+        self.processed = 0
+        self.failed = 0
+
+        self._stopping = threading.Event()
+        self._slots = threading.Semaphore(self.max_in_flight)
+        self._pending = queue.Queue()
+        self._finished = queue.Queue()
+        # receipt handle -> time at which the message becomes visible again
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._last_received = time.monotonic()
+
+    def stop(self, *args):
+        """Stop polling, and finish the messages in progress"""
+        if not self._stopping.is_set():
+            logger.info("Stopping the worker")
+            self._stopping.set()
+
+    def run(self, idle_timeout=None):
+        """Process messages until stopped, or until no message was received for
+        `idle_timeout` seconds"""
+        pollers = [
+            threading.Thread(target=self._poll, name=f"poller-{i}")
+            for i in range(-(-self.max_in_flight // (4 * SQS_BATCH)))
+        ]
+        processors = [
+            threading.Thread(target=self._process, name=f"processor-{i}")
+            for i in range(self.workers)
+        ]
+        output = threading.Thread(target=self._output, name="output")
+        heartbeat = threading.Thread(target=self._heartbeat, name="heartbeat")
+        for thread in pollers + processors + [output, heartbeat]:
+            thread.start()
+
+        # (in the main thread, to be interrupted by the signals)
+        while not self._stopping.wait(0.2):
+            idle = time.monotonic() - self._last_received
+            if idle_timeout is not None and idle > idle_timeout:
+                with self._lock:
+                    if not self._in_flight:
+                        self.stop()
+
+        for thread in pollers:
+            thread.join()
+        for _ in processors:
+            self._pending.put(None)
+        for thread in processors:
+            thread.join()
+        self._finished.put(None)
+        output.join()
+        heartbeat.join()
+        logger.info(f"Worker stopped, {self.processed} processed, {self.failed} failed")
+
+    def _poll(self):
+        while not self._stopping.is_set():
+            # wait for room for at least one message, then take what's free
+            if not self._slots.acquire(timeout=0.5):
+                continue
+            slots = 1
+            while slots < SQS_BATCH and self._slots.acquire(blocking=False):
+                slots += 1
+            try:
+                messages = self.sqs.receive_message(
+                    QueueUrl=self.queue_url,
+                    MaxNumberOfMessages=slots,
+                    WaitTimeSeconds=self.wait_time,
+                    VisibilityTimeout=self.visibility_timeout,
+                    AttributeNames=["ApproximateReceiveCount"],
+                    MessageAttributeNames=["All"],
+                ).get("Messages", [])
+            except Exception:
+                logger.exception("Failed to receive messages")
+                messages = []
+                self._stopping.wait(1)
+            for _ in range(slots - len(messages)):
+                self._slots.release()
+            if not messages:
+                continue
+            now = time.monotonic()
+            with self._lock:
+                for m in messages:
+                    self._in_flight[m["ReceiptHandle"]] = now + self.visibility_timeout
+                self._last_received = now
+            for m in messages:
+                self._pending.put(to_record(m))
+
+    def _process(self):
+        while True:
+            record = self._pending.get()
+            if record is None:
+                return
+            if self._stopping.is_set():
+                # not started: give it back to the other workers
+                self._finished.put(("returned", record, None))
+                continue
+            try:
+                ingested = self.fn.process_message(record)
+                self._finished.put(("done", record, ingested))
+            except Exception:
+                logger.exception(f"Failed to process message {record['messageId']}")
+                self._finished.put(("failed", record, None))
+
+    def _output(self):
+        finished = []
+        oldest = None
+        while True:
+            timeout = (
+                None
+                if oldest is None
+                else max(0.0, oldest + self.output_interval - time.monotonic())
+            )
+            try:
+                item = self._finished.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                finished.append(item)
+                oldest = oldest or time.monotonic()
+            if len(finished) >= self.output_batch or (
+                oldest is not None and time.monotonic() - oldest >= self.output_interval
+            ):
+                self._flush(finished)
+                finished, oldest = [], None
+        self._flush(finished)
+
+    def _flush(self, finished):
+        """Write the outputs of the messages done and delete them from the queue,
+        and let go of the other ones"""
+        done = [(r, i) for status, r, i in finished if status == "done"]
+        failed = [r for status, r, _ in finished if status == "failed"]
+        returned = [r for status, r, _ in finished if status == "returned"]
+        stage_metrics = self.fn.stage_metrics
+        ingested = [i for _, items in done for i in items]
+        if ingested and self.fn.batched_outputs:
+            try:
+                self.fn.write_outputs(uuid.uuid4().hex, ingested)
+            except Exception:
+                logger.exception("Failed to write the outputs of the batch")
+                failed, done = failed + [r for r, _ in done], []
+
+        for batch in chunks([r for r, _ in done]):
+            with stage_metrics.timer("DeleteMessages"):
+                self._delete(batch)
+        # (failed messages reappear after their visibility timeout)
+        for batch in chunks(returned):
+            self._change_visibility(batch, 0)
+        with self._lock:
+            for record in [r for r, _ in done] + failed + returned:
+                self._in_flight.pop(record["receiptHandle"], None)
+                self._slots.release()
+        self.processed += len(done)
+        self.failed += len(failed)
+        if done or failed:
+            stage_metrics.count("Messages", len(done) + len(failed))
+            stage_metrics.count("FailedMessages", len(failed))
+        stage_metrics.flush()
+
+    def _delete(self, records):
+        try:
+            response = self.sqs.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": r["receiptHandle"]}
+                    for i, r in enumerate(records)
+                ],
+            )
+        except Exception:
+            # the messages will be delivered again, and skipped by the ledger
+            logger.exception("Failed to delete messages")
+            return
+        for failure in response.get("Failed", []):
+            logger.warning(f"Failed to delete message: {failure}")
+
+    def _change_visibility(self, records, timeout):
+        try:
+            response = self.sqs.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {
+                        "Id": str(i),
+                        "ReceiptHandle": r["receiptHandle"],
+                        "VisibilityTimeout": timeout,
+                    }
+                    for i, r in enumerate(records)
+                ],
+            )
+        except Exception:
+            logger.exception("Failed to change the visibility of messages")
+            return []
+        return [int(s["Id"]) for s in response.get("Successful", [])]
+
+    def _heartbeat(self):
+        """Extend the visibility of the messages in flight before it runs out"""
+        while not (self._stopping.is_set() and self._idle()):
+            time.sleep(0.2)
+            now = time.monotonic()
+            with self._lock:
+                expiring = [
+                    {"receiptHandle": receipt}
+                    for receipt, visible_at in self._in_flight.items()
+                    if visible_at - now < self.visibility_timeout / 2
+                ]
+            for batch in chunks(expiring):
+                extended = self._change_visibility(batch, self.visibility_timeout)
+                with self._lock:
+                    for i in extended:
+                        receipt = batch[i]["receiptHandle"]
+                        if receipt in self._in_flight:
+                            self._in_flight[receipt] = now + self.visibility_timeout
+                self.fn.stage_metrics.count("VisibilityExtensions", len(extended))
+
+    def _idle(self):
+        with self._lock:
+            return not self._in_flight
+
+
+def main():
+    # the handler module reads its configuration from the environment
+    fn = importlib.import_module("lambda")
+    sqs = clients.get("sqs")
+    queue_url = (
+        os.getenv("QUEUE_URL")
+        or sqs.get_queue_url(QueueName=os.environ["QUEUE_NAME"])["QueueUrl"]
+    )
+    worker = QueueWorker(
+        fn,
+        sqs,
+        queue_url,
+        visibility_timeout=int(os.getenv("WORKER_VISIBILITY_TIMEOUT", 120)),
+        output_batch=int(os.getenv("WORKER_OUTPUT_BATCH", 100)),
+        output_interval=float(os.getenv("WORKER_OUTPUT_INTERVAL", 5)),
+    )
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    logger.info(f"Polling {queue_url} with {worker.workers} workers")
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
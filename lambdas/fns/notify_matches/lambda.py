@@ -1,72 +1,204 @@
 import json
 import os
+import threading
+import time
 import urllib.parse
-from collections import Counter
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Logger, Metrics
+from face_match import clients
+from face_match.metrics import PowertoolsSink, StageMetrics
+from face_match.profiling import Profiler
+from face_match.reports import decode_reports
 
 logger = Logger()
-s3 = boto3.resource("s3")
-ssm = boto3.client("ssm")
-sns = boto3.client("sns")
+# per-stage timings and counters, in CloudWatch Embedded Metric Format
+stage_metrics = StageMetrics(
+    PowertoolsSink(
+        Metrics(
+            namespace=os.getenv("POWERTOOLS_METRICS_NAMESPACE", "FaceMatching"),
+            service=os.getenv("POWERTOOLS_SERVICE_NAME", "notify_matches"),
+        )
+    )
+)
+cold_start = True
+# the clients are created on first use (SSM only when the threshold expires)
+s3 = clients.lazy("s3")
+ssm = clients.lazy("ssm")
+sns = clients.lazy("sns")
 
 bucket_out = os.getenv("BUCKET_OUT")
 prefix_out = os.getenv("PREFIX_OUT", "output")
 topic_arn = os.getenv("TOPIC_ARN")
 threshold_param_name = os.getenv("NOTIFICATION_THRESHOLD")
-print(threshold_param_name)
+threshold_ttl = float(os.getenv("NOTIFICATION_THRESHOLD_TTL", 300))
+max_workers = int(os.getenv("MAX_WORKERS", 10))
+clients.configure(pool_size=max_workers)
+
+# SNS accepts at most 10 messages per PublishBatch call
+PUBLISH_BATCH_SIZE = 10
+
+_threshold_cache = {"value": None, "expires": 0.0}
+_threshold_lock = threading.Lock()
+
+# Invocations profiled on demand (`PROFILING_MODE`), written to the output bucket
+# unless `PROFILING_BUCKET` is set
+profiling_bucket = os.getenv("PROFILING_BUCKET") or bucket_out
+profiler = Profiler.from_env(
+    lambda key, body: s3.put_object(Bucket=profiling_bucket, Key=key, Body=body),
+    "notify_matches",
+)
+
+
+class NotificationError(Exception):
+    """Reports that could not be read, or alerts that could not be sent"""
+
 
 # @logger.inject_lambda_context(log_event=True)
 def handler(event, context):
+    """Publish the alerts for all the report objects in the event.
+
+    The objects are read concurrently, and the alerts of all of them are sent in
+    batches. A record that can't be processed is logged and doesn't prevent the
+    alerts of the others, but the invocation then fails (`NotificationError`),
+    as it does when alerts still fail to be published after a retry: Lambda
+    retries the S3 event, whose alerts already sent are sent again.
+
+    The invocation is profiled when the configuration selects it.
+    """
+    global cold_start
+    if cold_start:
+        stage_metrics.count("ColdStart")
+        cold_start = False
+    invocation_id = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
     try:
-        bucket = event["Records"][0]["s3"]["bucket"]["name"]
-        key = urllib.parse.unquote_plus(
-            event["Records"][0]["s3"]["object"]["key"], encoding="utf-8"
+        with profiler.profile(invocation_id):
+            with stage_metrics.timer("Notify"):
+                return notify(event)
+    finally:
+        stage_metrics.flush()
+
+
+def notify(event):
+    with stage_metrics.timer("GetThreshold"):
+        threshold = get_threshold()
+
+    records = event["Records"]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(records)))) as pool:
+        results = list(pool.map(lambda r: read_messages(r, threshold), records))
+    messages = [m for result in results if result is not None for m in result]
+
+    response_list, unsent = publish(topic_arn, messages)
+    logger.info(f"Process finished, sent {len(response_list)} alert messages")
+
+    failed_reports = sum(r is None for r in results)
+    stage_metrics.count("Alerts", len(response_list))
+    stage_metrics.count("FailedReports", failed_reports)
+    if failed_reports or unsent:
+        raise NotificationError(
+            f"{failed_reports} reports not read, {len(unsent)} alerts not sent"
         )
+    return {"status": "success", "message": json.dumps(response_list)}
 
-        threshold = ssm.get_parameters(Names=[threshold_param_name])["Parameters"][0][
-            "Value"
-        ]
-        threshold = float(threshold)
 
-        file_object = s3.Object(bucket, key)
-        report = json.loads(file_object.get()["Body"].read())
+def get_threshold():
+    """Notification threshold from SSM, cached for `NOTIFICATION_THRESHOLD_TTL` seconds"""
+    with _threshold_lock:
+        now = time.monotonic()
+        if _threshold_cache["value"] is None or now >= _threshold_cache["expires"]:
+            response = ssm.get_parameters(Names=[threshold_param_name])
+            _threshold_cache["value"] = float(response["Parameters"][0]["Value"])
+            _threshold_cache["expires"] = now + threshold_ttl
+        return _threshold_cache["value"]
 
-        response_list = parse_and_publish(topic_arn, report, threshold)
-        logger.info(f"Process finished, sent {len(response_list)} alert messages")
 
-        return {"status": "success", "message": json.dumps(response_list)}
+def read_messages(record, threshold):
+    """Alert messages for the reports in the object of an S3 record (None on error)"""
+    try:
+        bucket = record["s3"]["bucket"]["name"]
+        key = urllib.parse.unquote_plus(record["s3"]["object"]["key"], encoding="utf-8")
+        with stage_metrics.timer("ReportGet"):
+            body = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+        # the object holds either a single report or a batch of them
+        messages = []
+        for report in decode_reports(body, key):
+            report_messages = build_messages(report, threshold)
+            stage_metrics.count("AlertsPerReport", len(report_messages))
+            messages.extend(report_messages)
+        return messages
     except Exception:
         logger.exception("Received an exception")
+        return None
 
 
-def parse_and_publish(topic_arn, report: dict, threshold: float):
+def aggregate_matches(report: dict, threshold: float):
+    """Number of matches and max similarity per matched customer, in one pass"""
+    stats = {}
+    for m in report["Matches"]:
+        if m["Similarity"] < threshold:
+            continue
+        name = m.get("CustomerId") or m["Face"]["ExternalImageId"].rsplit("_", 1)[0]
+        count, similarity = stats.get(name, (0, 0.0))
+        stats[name] = (count + 1, max(similarity, m["Similarity"]))
+    return stats
 
-    # parse the report to extract matches above threshold
-    name_matches = [
-        m["Face"]["ExternalImageId"].rsplit("_", 1)[0]
-        for m in report["Matches"]
-        if m["Similarity"] >= threshold
-    ]
-    # Use a counter to only notify of the number of matches per ID
-    name_counter = Counter(name_matches)
-
-    match_dict = {
-        k: max(
-            [
-                m["Similarity"]
-                for m in report["Matches"]
-                if k in m["Face"]["ExternalImageId"]
-            ]
-        )
-        for k in name_counter
-    }
 
-    messages = [
+def build_messages(report: dict, threshold: float):
+    return [
         f"{report['CustomerID']}, image {report['Source']}, "
-        f"matched {name} {name_counter.get(name)} times with max similarity {sim:.3f}"
-        for name, sim in match_dict.items()
+        f"matched {name} {count} times with max similarity {sim:.3f}"
+        for name, (count, sim) in aggregate_matches(report, threshold).items()
+    ]
+
+
+def publish(topic_arn, messages):
+    """Publish the messages in batches of 10.
+
+    Returns the IDs of the messages sent, and the messages that failed on the
+    service side even after a retry.
+    """
+    batches = [
+        messages[i : i + PUBLISH_BATCH_SIZE]
+        for i in range(0, len(messages), PUBLISH_BATCH_SIZE)
     ]
-    responses = [sns.publish(TopicArn=topic_arn, Message=m) for m in messages]
-    return [r["MessageId"] for r in responses]
+    if not batches:
+        return [], []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as pool:
+        results = list(pool.map(lambda batch: publish_batch(topic_arn, batch), batches))
+    return (
+        [message_id for message_ids, _ in results for message_id in message_ids],
+        [message for _, unsent in results for message in unsent],
+    )
+
+
+def publish_batch(topic_arn, messages):
+    """Publish at most 10 messages, returns the IDs of the messages sent and the
+    messages not sent.
+
+    The entries that failed on the service side are retried once. The ones
+    rejected as the sender's fault (e.g. too large) are only logged: they would
+    fail again.
+    """
+    entries = [{"Id": str(i), "Message": m} for i, m in enumerate(messages)]
+    message_ids = []
+    for attempt in range(2):
+        if attempt:
+            stage_metrics.count("Retries")
+        with stage_metrics.timer("Publish"):
+            response = sns.publish_batch(
+                TopicArn=topic_arn, PublishBatchRequestEntries=entries
+            )
+        message_ids.extend(r["MessageId"] for r in response.get("Successful", []))
+        failed = {f["Id"] for f in response.get("Failed", []) if not f["SenderFault"]}
+        stage_metrics.count("PublishFailures", len(response.get("Failed", [])))
+        for f in response.get("Failed", []):
+            logger.warning(f"Failed to publish message {f['Id']}: {f.get('Message')}")
+        entries = [e for e in entries if e["Id"] in failed]
+        if not entries:
+            break
+    return message_ids, [e["Message"] for e in entries]
+
+
+def parse_and_publish(topic_arn, report: dict, threshold: float):
+    return publish(topic_arn, build_messages(report, threshold))[0]
@@ -0,0 +1 @@
+"""Code shared by the lambda functions of the face matching pipeline"""
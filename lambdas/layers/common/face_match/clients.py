@@ -0,0 +1,101 @@
+"""Shared AWS clients of the lambda functions, created on first use.
+
+Creating a boto3 client takes tens of milliseconds (it loads the service model),
+so the functions only create the clients they actually call, once per instance,
+and share them between their threads (clients, unlike resources, are
+thread-safe). The clients are tuned for the functions:
+
+- a connection pool as large as the concurrency of the function
+  (`AWS_CLIENT_POOL_SIZE`), so that concurrent calls don't wait for, or throw
+  away, connections; connections are kept alive between invocations,
+- the adaptive retry mode, which also slows down the client when throttled,
+  except for the services in `SELF_RETRIED`, whose calls the functions pace and
+  retry themselves: their clients make a single attempt, so that there is only
+  one layer of retries (and a throttled call is not retried up to
+  `AWS_CLIENT_MAX_ATTEMPTS` times on every retry of the function),
+- short connect and read timeouts (`AWS_CLIENT_CONNECT_TIMEOUT`,
+  `AWS_CLIENT_READ_TIMEOUT`, in seconds), so that a stuck call is retried rather
+  than holding the invocation until its timeout.
+
+`lazy(service)` returns a stand-in that creates the client on the first
+attribute access, to be assigned at import time like a regular client.
+"""
+
+import os
+import threading
+
+# services whose calls are retried by the functions, not by their client
+SELF_RETRIED = {"rekognition"}
+
+_clients = {}
+_lock = threading.Lock()
+_settings = {
+    "pool_size": int(os.getenv("AWS_CLIENT_POOL_SIZE", 10)),
+    "connect_timeout": float(os.getenv("AWS_CLIENT_CONNECT_TIMEOUT", 2)),
+    "read_timeout": float(os.getenv("AWS_CLIENT_READ_TIMEOUT", 10)),
+    "max_attempts": int(os.getenv("AWS_CLIENT_MAX_ATTEMPTS", 3)),
+}
+
+
+def configure(**settings):
+    """Change the settings of the clients not created yet (e.g. `pool_size`)"""
+    unknown = set(settings) - set(_settings)
+    if unknown:
+        raise TypeError(f"Unknown client settings: {sorted(unknown)}")
+    _settings.update(settings)
+
+
+def pool_size():
+    """Connections of the pool of the clients, the concurrency they serve"""
+    return _settings["pool_size"]
+
+
+def client_config(service=None):
+    from botocore.config import Config
+
+    retries = (
+        {"mode": "standard", "max_attempts": 1}
+        if service in SELF_RETRIED
+        else {"mode": "adaptive", "max_attempts": _settings["max_attempts"]}
+    )
+    kwargs = {
+        "max_pool_connections": _settings["pool_size"],
+        "connect_timeout": _settings["connect_timeout"],
+        "read_timeout": _settings["read_timeout"],
+        "retries": retries,
+    }
+    try:
+        return Config(tcp_keepalive=True, **kwargs)
+    except TypeError:
+        # botocore < 1.27.84 has no TCP keep-alive option
+        return Config(**kwargs)
+
+
+def get(service):
+    """The shared client of a service, created on the first call"""
+    client = _clients.get(service)
+    if client is None:
+        with _lock:
+            client = _clients.get(service)
+            if client is None:
+                import boto3
+
+                client = boto3.client(service, config=client_config(service))
+                _clients[service] = client
+    return client
+
+
+class _LazyClient:
+    def __init__(self, service):
+        self._service = service
+
+    def __getattr__(self, name):
+        return getattr(get(self._service), name)
+
+    def __repr__(self):
+        return f"<lazy {self._service} client>"
+
+
+def lazy(service):
+    """A stand-in for the shared client of a service, created when first used"""
+    return _LazyClient(service)
@@ -0,0 +1,387 @@
+"""Compaction of the small report objects into Parquet files, by time window.
+
+The functions write one small object per image (or per invocation) under
+`output/`, forever: queries, and listings, pay for every object. The compaction
+merges the reports written during a time window (by the `LastModified` of the
+objects, a day or an hour) into a few Parquet files:
+
+    compacted/report_window=<window>/run=<run id>/part-NNNNN.parquet
+
+with the columns of the reports, plus `reportpath` (the `s3://` path of the
+original object, as Athena's `"$path"`). Only the windows closed for at least
+`grace` seconds are compacted, so that the reports still being written are left
+alone, and only the objects smaller than `max_object_size`.
+
+Every run of a window writes a new directory, then points the partition of the
+window at it in the catalog (a single, atomic update), and only then deletes (or
+archives) the originals and the previous run of the window. The originals
+compacted are listed in the `_manifest.json` of the run, so that a run that
+stopped before the clean-up is finished by the next one, without compacting the
+same reports twice. Readers union the compacted table with the originals of the
+windows that have no partition yet, and the objects too large to be compacted
+(see the `face_match_reports` view), so a report is never counted twice, nor
+missed, while the originals are removed.
+
+pyarrow is only imported when reports are compacted.
+"""
+
+import datetime
+import io
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from face_match.reports import decode_reports
+
+WINDOW_FORMATS = {"day": "%Y-%m-%d", "hour": "%Y-%m-%d-%H"}
+WINDOW_LENGTHS = {
+    "day": datetime.timedelta(days=1),
+    "hour": datetime.timedelta(hours=1),
+}
+PARTITION_KEY = "report_window"
+MANIFEST = "_manifest.json"
+
+
+def report_schema():
+    """Arrow schema of the compacted reports, the columns of the reports table"""
+    import pyarrow as pa
+
+    face = pa.struct(
+        [
+            ("FaceId", pa.string()),
+            (
+                "BoundingBox",
+                pa.struct(
+                    [
+                        ("Width", pa.float64()),
+                        ("Height", pa.float64()),
+                        ("Left", pa.float64()),
+                        ("Top", pa.float64()),
+                    ]
+                ),
+            ),
+            ("ImageId", pa.string()),
+            ("ExternalImageId", pa.string()),
+            ("Confidence", pa.float64()),
+        ]
+    )
+    match = pa.struct(
+        [
+            ("Similarity", pa.float64()),
+            ("Face", face),
+            ("CustomerId", pa.string()),
+            ("SearchedFaceId", pa.string()),
+            # (matches of users, rather than faces)
+            ("User", pa.struct([("UserId", pa.string()), ("UserStatus", pa.string())])),
+        ]
+    )
+    face_matches = pa.struct(
+        [
+            ("FaceId", pa.string()),
+            (
+                "Matches",
+                pa.list_(
+                    pa.struct(
+                        [
+                            ("FaceId", pa.string()),
+                            ("UserId", pa.string()),
+                            ("Similarity", pa.float64()),
+                        ]
+                    )
+                ),
+            ),
+        ]
+    )
+    duplicate_of = pa.struct(
+        [
+            ("Source", pa.string()),
+            ("CustomerID", pa.string()),
+            ("Distance", pa.int32()),
+        ]
+    )
+    return pa.schema(
+        [
+            ("source", pa.string()),
+            ("customerid", pa.string()),
+            ("matches", pa.list_(match)),
+            ("faces", pa.list_(face_matches)),
+            ("duplicateof", duplicate_of),
+            ("reportpath", pa.string()),
+        ]
+    )
+
+
+def to_parquet(rows):
+    """Parquet file of (report path, report) pairs"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = report_schema()
+    columns = {
+        "source": [r["Source"] for _, r in rows],
+        "customerid": [r["CustomerID"] for _, r in rows],
+        "matches": [r.get("Matches") for _, r in rows],
+        "faces": [r.get("Faces") for _, r in rows],
+        "duplicateof": [r.get("DuplicateOf") for _, r in rows],
+        "reportpath": [path for path, _ in rows],
+    }
+    table = pa.Table.from_arrays(
+        [pa.array(columns[f.name], type=f.type) for f in schema], schema=schema
+    )
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="snappy")
+    return buffer.getvalue()
+
+
+class InMemoryCatalog:
+    """Locations of the partitions, local to the process"""
+
+    def __init__(self):
+        self.locations = {}
+
+    def get_location(self, window):
+        return self.locations.get(window)
+
+    def set_location(self, window, location):
+        self.locations[window] = location
+
+
+class GlueCatalog:
+    """Partitions of the compacted reports table in the Glue Data Catalog"""
+
+    def __init__(self, glue, database, table):
+        self.glue = glue
+        self.database = database
+        self.table = table
+        self._storage = None
+
+    def get_location(self, window):
+        try:
+            partition = self.glue.get_partition(
+                DatabaseName=self.database,
+                TableName=self.table,
+                PartitionValues=[window],
+            )["Partition"]
+        except self.glue.exceptions.EntityNotFoundException:
+            return None
+        return partition["StorageDescriptor"]["Location"]
+
+    def set_location(self, window, location):
+        if self._storage is None:
+            table = self.glue.get_table(DatabaseName=self.database, Name=self.table)
+            self._storage = table["Table"]["StorageDescriptor"]
+        partition = {
+            "Values": [window],
+            "StorageDescriptor": {**self._storage, "Location": location},
+        }
+        try:
+            self.glue.update_partition(
+                DatabaseName=self.database,
+                TableName=self.table,
+                PartitionValueList=[window],
+                PartitionInput=partition,
+            )
+        except self.glue.exceptions.EntityNotFoundException:
+            self.glue.create_partition(
+                DatabaseName=self.database,
+                TableName=self.table,
+                PartitionInput=partition,
+            )
+
+
+class Compactor:
+    """Compaction of the reports of a bucket.
+
+    Args:
+        s3: S3 client.
+        bucket: output bucket of the functions.
+        catalog: partitions of the compacted table, e.g. `GlueCatalog(...)`.
+        prefix: prefix of the reports to compact.
+        compacted_prefix: prefix of the compacted files, and of their table.
+        window: "day" or "hour".
+        grace: seconds after the end of a window before it is compacted.
+        max_object_size: larger objects are left as they are.
+        archive_prefix: the originals are copied there before being deleted,
+            if given.
+        max_file_reports: reports per Parquet file.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket,
+        catalog=None,
+        prefix="output",
+        compacted_prefix="compacted",
+        window="day",
+        grace=3600,
+        max_object_size=1 << 20,
+        archive_prefix=None,
+        max_file_reports=200000,
+        max_workers=16,
+    ):
+        self.s3 = s3
+        self.bucket = bucket
+        self.catalog = catalog or InMemoryCatalog()
+        self.prefix = prefix
+        self.compacted_prefix = compacted_prefix
+        self.window = window
+        self.grace = datetime.timedelta(seconds=grace)
+        self.max_object_size = max_object_size
+        self.archive_prefix = archive_prefix
+        self.max_file_reports = max_file_reports
+        self.max_workers = max_workers
+
+    def window_of(self, last_modified):
+        return last_modified.astimezone(datetime.timezone.utc).strftime(
+            WINDOW_FORMATS[self.window]
+        )
+
+    def closed_windows(self, now=None):
+        """The small objects of the windows closed for at least `grace`, by window"""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        windows = {}
+        kwargs = {"Bucket": self.bucket, "Prefix": f"{self.prefix}/"}
+        while True:
+            response = self.s3.list_objects_v2(**kwargs)
+            for obj in response.get("Contents", []):
+                if obj["Size"] > self.max_object_size:
+                    continue
+                window = self.window_of(obj["LastModified"])
+                start = datetime.datetime.strptime(
+                    window, WINDOW_FORMATS[self.window]
+                ).replace(tzinfo=datetime.timezone.utc)
+                if start + WINDOW_LENGTHS[self.window] + self.grace <= now:
+                    windows.setdefault(window, []).append(obj["Key"])
+            if not response.get("IsTruncated"):
+                return windows
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def run(self, now=None, deadline=None):
+        """Compact the closed windows, oldest first, until `deadline` (a
+        `time.monotonic()` value). Returns the statistics of every window."""
+        stats = []
+        for window, keys in sorted(self.closed_windows(now).items()):
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            stats.append(self.compact_window(window, keys))
+        return stats
+
+    def _read(self, key):
+        body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        return len(body), decode_reports(body, key)
+
+    def _manifest(self, location):
+        """The originals compacted in the run at `location`"""
+        key = f"{location.split('/', 3)[3]}{MANIFEST}"
+        body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        return json.loads(body)
+
+    def _list(self, prefix):
+        keys = []
+        kwargs = {"Bucket": self.bucket, "Prefix": prefix}
+        while True:
+            response = self.s3.list_objects_v2(**kwargs)
+            keys.extend(obj["Key"] for obj in response.get("Contents", []))
+            if not response.get("IsTruncated"):
+                return keys
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def compact_window(self, window, keys):
+        """Merge the reports of `keys` (and the previous run of the window) into a
+        new run, point the partition at it, then remove what it replaces"""
+        start = time.monotonic()
+        previous = self.catalog.get_location(window)
+        manifest = self._manifest(previous) if previous else {"keys": []}
+        # (left by a run stopped before its clean-up: already compacted)
+        done = set(manifest["keys"])
+        new_keys = [k for k in keys if k not in done]
+
+        stats = {"window": window, "objects": len(new_keys), "reports": 0}
+        stats["bytes_in"] = stats["bytes_out"] = 0
+        if new_keys:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                read = list(pool.map(self._read, new_keys))
+            rows = [
+                (f"s3://{self.bucket}/{key}", report)
+                for key, (_, reports) in zip(new_keys, read)
+                for report in reports
+            ]
+            stats["bytes_in"] = sum(size for size, _ in read)
+            stats["reports"] = len(rows)
+            if previous:
+                rows = self._previous_rows(previous) + rows
+
+            run_id = "{:%Y%m%dT%H%M%SZ}-{}".format(
+                datetime.datetime.now(datetime.timezone.utc), uuid.uuid4().hex[:8]
+            )
+            run_prefix = (
+                f"{self.compacted_prefix}/{PARTITION_KEY}={window}/run={run_id}/"
+            )
+            for part, i in enumerate(range(0, len(rows), self.max_file_reports)):
+                body = to_parquet(rows[i : i + self.max_file_reports])
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=f"{run_prefix}part-{part:05d}.parquet",
+                    Body=body,
+                )
+                stats["bytes_out"] += len(body)
+            self.s3.put_object(
+                Bucket=self.bucket,
+                Key=f"{run_prefix}{MANIFEST}",
+                Body=json.dumps({"keys": sorted(done | set(new_keys))}),
+            )
+            # the swap: from now on the compacted table has the reports
+            self.catalog.set_location(window, f"s3://{self.bucket}/{run_prefix}")
+            if previous:
+                self._delete(self._list(previous.split("/", 3)[3]))
+        # the originals, including the ones compacted by a stopped run
+        self._remove_originals(keys)
+        stats["seconds"] = time.monotonic() - start
+        return stats
+
+    def _previous_rows(self, location):
+        import pyarrow.parquet as pq
+
+        rows = []
+        for key in self._list(location.split("/", 3)[3]):
+            if not key.endswith(".parquet"):
+                continue
+            body = self.s3.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+            for row in pq.read_table(io.BytesIO(body)).to_pylist():
+                report = {
+                    "Source": row["source"],
+                    "CustomerID": row["customerid"],
+                    "Matches": row["matches"],
+                    "Faces": row["faces"],
+                    "DuplicateOf": row["duplicateof"],
+                }
+                rows.append((row["reportpath"], report))
+        return rows
+
+    def _remove_originals(self, keys):
+        if self.archive_prefix:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                list(
+                    pool.map(
+                        lambda key: self.s3.copy_object(
+                            Bucket=self.bucket,
+                            Key=f"{self.archive_prefix}/{key}",
+                            CopySource={"Bucket": self.bucket, "Key": key},
+                        ),
+                        keys,
+                    )
+                )
+        self._delete(keys)
+
+    def _delete(self, keys):
+        # DeleteObjects takes at most 1000 keys
+        for i in range(0, len(keys), 1000):
+            self.s3.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [{"Key": key} for key in keys[i : i + 1000]],
+                    "Quiet": True,
+                },
+            )
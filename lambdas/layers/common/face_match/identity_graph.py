@@ -0,0 +1,431 @@
+"""Duplicate-identity graph: which customer IDs are (likely) the same person.
+
+Every cross-customer match links two customer IDs with an edge, weighted by the
+highest similarity seen between them. The connected components of the graph are
+the clusters of customer IDs that share a face, and are kept in a union-find
+structure (union by size, path compression), so that the cluster of a customer
+is found in a few reads instead of an analytical query over all the reports.
+
+The root of every cluster holds its size and the highest similarity of its
+edges. The members are not stored with it (a cluster can outgrow an item): every
+union records the root merged under the other one as its child, and the members
+of a cluster are the nodes reached from its root through the children. Roots are
+updated with optimistic conditional writes (on a `version` attribute), so that
+concurrent writers can grow the graph safely.
+
+Stores:
+
+- `InMemoryGraphStore`: local to the process, for tests and single-instance runs.
+- `DynamoDBGraphStore`: a table with a string partition key `node` (customer ID)
+  and a string sort key `peer` ("#" for the node itself, the other customer ID
+  for an edge), and a sparse global secondary index `roots` (partition key
+  `root_partition`, numeric sort key `score`) over the roots of the clusters,
+  spread across `ROOT_PARTITIONS` partitions by a hash of the root. The children
+  of a node are the sort keys of the partition "#children#<node>".
+"""
+
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from face_match import clients
+
+NODE = "#"
+CHILDREN = "#children#"
+ROOTS_INDEX = "roots"
+# partitions of the roots in the index, so that they don't all update one
+ROOT_PARTITIONS = 16
+
+
+class ConditionFailed(Exception):
+    """A node changed since it was read"""
+
+
+def score(size, max_similarity):
+    """Rank of a cluster: the number of customer IDs, then the best similarity"""
+    return size * 1000 + round(max_similarity, 3)
+
+
+def root_partition(node):
+    """Partition of the index of the roots a root is in"""
+    digest = hashlib.md5(node.encode("UTF-8")).digest()
+    return f"root#{int.from_bytes(digest[:4], 'big') % ROOT_PARTITIONS}"
+
+
+class InMemoryGraphStore:
+    """Nodes and edges in dicts"""
+
+    def __init__(self):
+        self._nodes = {}
+        self._children = {}
+        self._edges = {}
+        self._lock = threading.Lock()
+
+    def get(self, node):
+        with self._lock:
+            item = self._nodes.get(node)
+            return None if item is None else dict(item)
+
+    def put(self, nodes, children=()):
+        """Write nodes atomically, if their version is still the one read, with
+        the (parent, child) links of `children`.
+
+        `nodes` maps the node IDs to their new item; the `version` of an item
+        must be the one read + 1 (or 1 for a new node).
+        """
+        with self._lock:
+            for node, item in nodes.items():
+                current = self._nodes.get(node)
+                if (current["version"] if current else 0) != item["version"] - 1:
+                    raise ConditionFailed(node)
+            for node, item in nodes.items():
+                self._nodes[node] = dict(item)
+            for parent, child in children:
+                self._children.setdefault(parent, set()).add(child)
+
+    def children(self, node):
+        with self._lock:
+            return sorted(self._children.get(node, ()))
+
+    def set_parent(self, node, parent):
+        with self._lock:
+            self._nodes[node]["parent"] = parent
+
+    def put_edge(self, a, b, similarity):
+        """Record an edge in both directions, keeping the highest similarity"""
+        with self._lock:
+            for key in ((a, b), (b, a)):
+                self._edges[key] = max(self._edges.get(key, 0.0), similarity)
+
+    def edges(self, node):
+        with self._lock:
+            return {b: s for (a, b), s in self._edges.items() if a == node}
+
+    def top_roots(self, k):
+        with self._lock:
+            roots = [
+                dict(item, node=node)
+                for node, item in self._nodes.items()
+                if item["parent"] == node
+            ]
+        roots.sort(key=lambda r: score(r["size"], r["max_similarity"]), reverse=True)
+        return roots[:k]
+
+
+class DynamoDBGraphStore:
+    """Nodes and edges stored as items of a DynamoDB table (see the module doc)"""
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or clients.lazy("dynamodb")
+
+    def get(self, node):
+        item = self.client.get_item(
+            TableName=self.table_name,
+            Key={"node": {"S": node}, "peer": {"S": NODE}},
+            ConsistentRead=True,
+        ).get("Item")
+        return None if item is None else self._decode(item)
+
+    @staticmethod
+    def _decode(item):
+        return {
+            "parent": item["parent"]["S"],
+            "size": int(item["size"]["N"]),
+            "max_similarity": float(item["max_similarity"]["N"]),
+            "version": int(item["version"]["N"]),
+        }
+
+    def _put_request(self, node, item):
+        attributes = {
+            "node": {"S": node},
+            "peer": {"S": NODE},
+            "parent": {"S": item["parent"]},
+            "size": {"N": str(item["size"])},
+            "max_similarity": {"N": repr(item["max_similarity"])},
+            "version": {"N": str(item["version"])},
+        }
+        if item["parent"] == node:
+            # only the roots are in the index
+            attributes["root_partition"] = {"S": root_partition(node)}
+            attributes["score"] = {
+                "N": repr(score(item["size"], item["max_similarity"]))
+            }
+        if item["version"] == 1:
+            condition = {"ConditionExpression": "attribute_not_exists(#node)"}
+            names = {"#node": "node"}
+            values = {}
+        else:
+            condition = {"ConditionExpression": "#version = :version"}
+            names = {"#version": "version"}
+            values = {":version": {"N": str(item["version"] - 1)}}
+        put = {
+            "TableName": self.table_name,
+            "Item": attributes,
+            "ExpressionAttributeNames": names,
+            **condition,
+        }
+        if values:
+            put["ExpressionAttributeValues"] = values
+        return {"Put": put}
+
+    def put(self, nodes, children=()):
+        links = [
+            {
+                "Put": {
+                    "TableName": self.table_name,
+                    "Item": {"node": {"S": CHILDREN + parent}, "peer": {"S": child}},
+                }
+            }
+            for parent, child in children
+        ]
+        try:
+            self.client.transact_write_items(
+                TransactItems=[
+                    self._put_request(node, item) for node, item in nodes.items()
+                ]
+                + links
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in (
+                "TransactionCanceledException",
+                "ConditionalCheckFailedException",
+            ):
+                raise ConditionFailed(",".join(nodes))
+            raise
+
+    def set_parent(self, node, parent):
+        self.client.update_item(
+            TableName=self.table_name,
+            Key={"node": {"S": node}, "peer": {"S": NODE}},
+            UpdateExpression="SET #parent = :parent",
+            ExpressionAttributeNames={"#parent": "parent"},
+            ExpressionAttributeValues={":parent": {"S": parent}},
+        )
+
+    def put_edge(self, a, b, similarity):
+        for node, peer in ((a, b), (b, a)):
+            try:
+                self.client.update_item(
+                    TableName=self.table_name,
+                    Key={"node": {"S": node}, "peer": {"S": peer}},
+                    UpdateExpression="SET #similarity = :similarity",
+                    ConditionExpression=(
+                        "attribute_not_exists(#similarity) "
+                        "OR #similarity < :similarity"
+                    ),
+                    ExpressionAttributeNames={"#similarity": "similarity"},
+                    ExpressionAttributeValues={":similarity": {"N": repr(similarity)}},
+                )
+            except ClientError as e:
+                # a higher similarity is already recorded
+                if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+
+    def edges(self, node):
+        edges = {}
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "#node = :node AND #peer > :self",
+            "ExpressionAttributeNames": {"#node": "node", "#peer": "peer"},
+            "ExpressionAttributeValues": {":node": {"S": node}, ":self": {"S": NODE}},
+        }
+        while True:
+            response = self.client.query(**kwargs)
+            for item in response["Items"]:
+                edges[item["peer"]["S"]] = float(item["similarity"]["N"])
+            if "LastEvaluatedKey" not in response:
+                return edges
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def children(self, node):
+        children = []
+        kwargs = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "#node = :node",
+            "ExpressionAttributeNames": {"#node": "node"},
+            "ExpressionAttributeValues": {":node": {"S": CHILDREN + node}},
+        }
+        while True:
+            response = self.client.query(**kwargs)
+            children.extend(item["peer"]["S"] for item in response["Items"])
+            if "LastEvaluatedKey" not in response:
+                return children
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def _top_roots_in(self, partition, k):
+        """The `k` best roots of a partition of the index still current, read
+        page by page"""
+        roots = []
+        kwargs = {
+            "TableName": self.table_name,
+            "IndexName": ROOTS_INDEX,
+            "KeyConditionExpression": "root_partition = :root",
+            "ExpressionAttributeValues": {":root": {"S": partition}},
+            "ScanIndexForward": False,
+            "Limit": k,
+        }
+        while len(roots) < k:
+            response = self.client.query(**kwargs)
+            for item in response["Items"]:
+                node = item["node"]["S"]
+                # the index may lag behind the table, keep the roots still current
+                current = self.get(node)
+                if current is not None and current["parent"] == node:
+                    roots.append(dict(current, node=node))
+            if "LastEvaluatedKey" not in response:
+                break
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        return roots
+
+    def top_roots(self, k):
+        partitions = [f"root#{i}" for i in range(ROOT_PARTITIONS)]
+        with ThreadPoolExecutor(max_workers=ROOT_PARTITIONS) as pool:
+            results = pool.map(lambda p: self._top_roots_in(p, k), partitions)
+            roots = [root for roots in results for root in roots]
+        roots.sort(key=lambda r: score(r["size"], r["max_similarity"]), reverse=True)
+        return roots[:k]
+
+
+class IdentityGraph:
+    """Union-find of the customer IDs linked by cross-customer matches.
+
+    Args:
+        store: backend of the graph, e.g. `InMemoryGraphStore()`.
+        max_attempts: retries of an update that raced with another writer.
+    """
+
+    def __init__(self, store, max_attempts=10):
+        self.store = store
+        self.max_attempts = max_attempts
+
+    def _find(self, node):
+        """(root, root item) of the cluster of a node, (None, None) if unknown"""
+        item = self.store.get(node)
+        if item is None:
+            return None, None
+        path = []
+        while item["parent"] != node:
+            path.append(node)
+            node = item["parent"]
+            item = self.store.get(node)
+        # path compression: the nodes seen point to the root directly
+        for child in path[:-1]:
+            self.store.set_parent(child, node)
+        return node, item
+
+    def find(self, customer_id):
+        """Root of the cluster of a customer ID (itself if it was never matched)"""
+        root, _ = self._find(customer_id)
+        return root or customer_id
+
+    def add_match(self, a, b, similarity):
+        """Link two customer IDs matched with a given similarity"""
+        if a == b:
+            return
+        self.store.put_edge(a, b, similarity)
+        for attempt in range(self.max_attempts):
+            try:
+                return self._union(a, b, similarity)
+            except ConditionFailed:
+                if attempt == self.max_attempts - 1:
+                    raise
+
+    def _union(self, a, b, similarity):
+        roots = {}
+        for node in (a, b):
+            root, item = self._find(node)
+            if root is None:
+                # new node, a cluster of its own (version 0: not stored yet)
+                root, item = node, {
+                    "parent": node,
+                    "size": 1,
+                    "max_similarity": 0.0,
+                    "version": 0,
+                }
+            roots[root] = item
+        if len(roots) == 1:
+            ((root, item),) = roots.items()
+            if similarity > item["max_similarity"]:
+                self.store.put(
+                    {
+                        root: dict(
+                            item,
+                            max_similarity=similarity,
+                            version=item["version"] + 1,
+                        )
+                    }
+                )
+            return root
+        # union by size: the smaller cluster goes under the root of the larger
+        (big, big_item), (small, small_item) = sorted(
+            roots.items(), key=lambda r: (r[1]["size"], r[0]), reverse=True
+        )
+        self.store.put(
+            {
+                big: {
+                    "parent": big,
+                    "size": big_item["size"] + small_item["size"],
+                    "max_similarity": max(
+                        big_item["max_similarity"],
+                        small_item["max_similarity"],
+                        similarity,
+                    ),
+                    "version": big_item["version"] + 1,
+                },
+                small: {
+                    "parent": big,
+                    "size": small_item["size"],
+                    "max_similarity": small_item["max_similarity"],
+                    "version": small_item["version"] + 1,
+                },
+            },
+            children=[(big, small)],
+        )
+        return big
+
+    def members(self, root):
+        """The customer IDs of the cluster of a root: the nodes reached from it
+        through the roots merged under it"""
+        members, pending = [], [root]
+        while pending:
+            node = pending.pop()
+            members.append(node)
+            pending.extend(self.store.children(node))
+        return members
+
+    def cluster(self, customer_id):
+        """The cluster of a customer ID: its members, size and best similarity"""
+        root, item = self._find(customer_id)
+        if root is None:
+            return {
+                "root": customer_id,
+                "members": [customer_id],
+                "size": 1,
+                "max_similarity": 0.0,
+            }
+        return {
+            "root": root,
+            "members": self.members(root),
+            "size": item["size"],
+            "max_similarity": item["max_similarity"],
+        }
+
+    def edges(self, customer_id):
+        """The customer IDs matched by a customer ID, with the best similarity"""
+        return self.store.edges(customer_id)
+
+    def top_clusters(self, k=10):
+        """The `k` largest clusters (then with the best similarity)"""
+        return [
+            {
+                "root": r["node"],
+                "members": self.members(r["node"]),
+                "size": r["size"],
+                "max_similarity": r["max_similarity"],
+            }
+            for r in self.store.top_roots(k)
+            if r["size"] > 1
+        ]
@@ -0,0 +1,107 @@
+"""Match store: the reports flattened to one row per match, in partitioned Parquet.
+
+Rows are partitioned by ingestion date and by a hash bucket of the customer ID:
+
+    <prefix>/ingest_date=YYYY-MM-DD/customer_bucket=N/<batch_id>.parquet
+
+so that Athena (with partition projection on both keys) only reads the files of
+the days and customers a query is about. The bucket of a customer can be computed
+in SQL with `CUSTOMER_BUCKET_SQL`, e.g.
+
+    WHERE customer_bucket = mod(bitwise_and(from_big_endian_32(
+        substr(md5(to_utf8('Hans_Blix')), 1, 4)), 2147483647), 16)
+
+pyarrow is only imported when rows are written, so that the functions that don't
+write to the match store don't need it.
+"""
+
+import datetime
+import hashlib
+import io
+
+DEFAULT_BUCKETS = 16
+
+CUSTOMER_BUCKET_SQL = (
+    "mod(bitwise_and(from_big_endian_32(substr(md5(to_utf8({column})), 1, 4)), "
+    "2147483647), {buckets})"
+)
+
+COLUMNS = [
+    ("source", "string"),
+    ("customer_id", "string"),
+    ("match_customer_id", "string"),
+    ("match_image_id", "string"),
+    ("match_face_id", "string"),
+    ("similarity", "double"),
+    ("ingested_at", "timestamp"),
+]
+
+
+def customer_bucket(customer_id, buckets=DEFAULT_BUCKETS):
+    """Hash bucket of a customer ID, equal to `CUSTOMER_BUCKET_SQL` in Athena"""
+    digest = hashlib.md5(customer_id.encode("UTF-8")).digest()
+    return (int.from_bytes(digest[:4], "big") & 0x7FFFFFFF) % buckets
+
+
+def flatten(report, ingested_at):
+    """One row per match of the report (no rows for reports without matches)"""
+    return [
+        {
+            "source": report["Source"],
+            "customer_id": report["CustomerID"],
+            "match_customer_id": match["CustomerId"],
+            # (matches of users, rather than faces, have no face)
+            "match_image_id": match.get("Face", {}).get("ExternalImageId"),
+            "match_face_id": match.get("Face", {}).get("FaceId"),
+            "similarity": float(match["Similarity"]),
+            "ingested_at": ingested_at,
+        }
+        for match in report["Matches"]
+    ]
+
+
+def partition_rows(reports, ingested_at=None, buckets=DEFAULT_BUCKETS):
+    """Group the flattened rows of the reports by partition path"""
+    ingested_at = ingested_at or datetime.datetime.now(datetime.timezone.utc)
+    partitions = {}
+    for report in reports:
+        rows = flatten(report, ingested_at)
+        if rows:
+            path = (
+                f"ingest_date={ingested_at:%Y-%m-%d}/"
+                f"customer_bucket={customer_bucket(report['CustomerID'], buckets)}"
+            )
+            partitions.setdefault(path, []).extend(rows)
+    return partitions
+
+
+def to_parquet(rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"string": pa.string(), "double": pa.float64()}
+    schema = pa.schema(
+        [
+            (name, types.get(kind) or pa.timestamp("ms", tz="UTC"))
+            for name, kind in COLUMNS
+        ]
+    )
+    table = pa.Table.from_pydict(
+        {name: [row[name] for row in rows] for name, _ in COLUMNS}, schema=schema
+    )
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="snappy")
+    return buffer.getvalue()
+
+
+def write_reports(s3, bucket, prefix, batch_id, reports, buckets=DEFAULT_BUCKETS):
+    """Write the matches of the reports, one Parquet file per partition.
+
+    Returns the keys of the objects written.
+    """
+    keys = []
+    for path, rows in partition_rows(reports, buckets=buckets).items():
+        key = f"{prefix}/{path}/{batch_id}.parquet"
+        s3.put_object(Bucket=bucket, Key=key, Body=to_parquet(rows))
+        keys.append(key)
+    return keys
@@ -0,0 +1,89 @@
+"""Per-stage metrics of the lambda functions.
+
+The functions time their stages (e.g. `IndexFaces`, `SearchFaces`, `ReportPut`)
+and count retries, throttles and matches with a `StageMetrics`, which forwards
+every value to a sink:
+
+- `PowertoolsSink`: CloudWatch Embedded Metric Format, through the Metrics
+  utility of AWS Lambda Powertools. Every value of a metric is kept (EMF accepts
+  a list of values per metric), so that CloudWatch computes the percentiles.
+- `LocalSink`: the values in memory, e.g. for the benchmark.
+
+Stage latencies are named `<Stage>Latency`, in milliseconds.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+MILLISECONDS = "Milliseconds"
+COUNT = "Count"
+
+
+class PowertoolsSink:
+    """Values added to a Powertools `Metrics`, written when flushed"""
+
+    # EMF accepts at most 100 values per metric in a document
+    MAX_VALUES = 100
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, unit, value):
+        # (the Metrics utility is not thread-safe)
+        with self._lock:
+            if self._counts.get(name, 0) >= self.MAX_VALUES:
+                self.metrics.flush_metrics()
+                self._counts = {}
+            self.metrics.add_metric(name=name, unit=unit, value=value)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def flush(self):
+        with self._lock:
+            if self._counts:
+                self.metrics.flush_metrics()
+            self._counts = {}
+
+
+class LocalSink:
+    """Values kept in memory, in `values` (name -> list of values)"""
+
+    def __init__(self):
+        self.values = {}
+        self.units = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, unit, value):
+        with self._lock:
+            self.values.setdefault(name, []).append(value)
+            self.units[name] = unit
+
+    def flush(self):
+        pass
+
+
+class StageMetrics:
+    """Stage timings, counters and histograms, sent to `sink`"""
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the block as the `<stage>Latency` metric (also when it raises)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.latency(stage, time.perf_counter() - start)
+
+    def latency(self, stage, seconds):
+        self.sink.add(f"{stage}Latency", MILLISECONDS, seconds * 1000)
+
+    def count(self, name, value=1):
+        self.sink.add(name, COUNT, value)
+
+    def flush(self):
+        self.sink.flush()
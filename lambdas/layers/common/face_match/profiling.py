@@ -0,0 +1,285 @@
+"""Opt-in profiling of the invocations of the lambda functions.
+
+An invocation is profiled when the function is configured to
+(`PROFILING_MODE` and the fraction of the invocations `PROFILING_RATE`), or when
+the caller asks for it (e.g. a `Profile` message attribute). The modes:
+
+- "cprofile": deterministic profile of every function call, with a
+  `cProfile.Profile` per thread started during the invocation (the records are
+  processed by thread pools), merged. Written as a `.prof` file, readable with
+  `pstats`, snakeviz...
+- "sample": wall-clock stacks of all the threads, sampled every
+  `PROFILING_INTERVAL` seconds (the idle threads, waiting for work, are
+  skipped). Much lower overhead. Written as folded stacks (`.folded`), the input
+  of flamegraph.pl and speedscope.
+
+Both also trace the memory allocations (tracemalloc) during the invocation. A
+`.json` summary is written next to the profile: duration, peak memory, the
+largest allocation sites and the functions with most time of their own.
+
+The profiles are written under `<PROFILING_PREFIX>/<function>/<date>/`, through
+the `put(key, body)` callable of the function (e.g. to its output bucket).
+"""
+
+import cProfile
+import datetime
+import io
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cprofile", "sample")
+# the leaf frames of threads waiting for work (pools, queues, sockets)
+IDLE_FILES = ("threading.py", "queue.py", "selectors.py", "thread.py")
+TOP = 20
+
+
+class _ThreadProfiles:
+    """A `cProfile.Profile` for the current thread and each thread it starts"""
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _enable(self, *args):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python >= 3.12: a single profiler sees all the threads
+            return
+        with self._lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        # (called by the new threads on their first event, it replaces itself)
+        threading.setprofile(self._enable)
+        self._enable()
+
+    def stop(self):
+        threading.setprofile(None)
+        self.profiles[0].disable()
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+class _Sampler:
+    """Folded stacks of the busy threads, sampled by a background thread"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="profiling-sampler", daemon=True
+        )
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+
+def folded(stacks):
+    """Folded stacks ("frame;frame;frame count" lines), heaviest first"""
+    return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+def parse_folded(text):
+    """The counts of the stacks of a folded file, e.g. to add several"""
+    stacks = Counter()
+    for line in text.splitlines():
+        stack, _, n = line.rpartition(" ")
+        if stack:
+            stacks[stack] += int(n)
+    return stacks
+
+
+def top_functions(profile, top=TOP):
+    """The functions with most time of their own (not in the functions they
+    call): seconds (cprofile), or share of the samples (sample)"""
+    if isinstance(profile, pstats.Stats):
+        rows = sorted(profile.stats.items(), key=lambda kv: kv[1][2], reverse=True)
+        return [
+            {
+                "function": f"{os.path.basename(file)}:{line}:{name}",
+                "calls": nc,
+                "own_seconds": tt,
+                "cumulative_seconds": ct,
+            }
+            for (file, line, name), (cc, nc, tt, ct, callers) in rows[:top]
+        ]
+    samples = sum(profile.values())
+    leaves = Counter()
+    for stack, n in profile.items():
+        leaves[stack.rpartition(";")[2]] += n
+    return [
+        {"function": name, "samples": n, "share": n / samples}
+        for name, n in leaves.most_common(top)
+    ]
+
+
+class Profiler:
+    """Profiles the invocations selected by the configuration or the caller.
+
+    Args:
+        put: `put(key, body)` writes a profile object.
+        function: name of the function, in the keys of the profiles.
+        mode: mode of the invocations profiled by the configuration, "" for none.
+        rate: fraction of the invocations profiled by the configuration.
+        prefix: key prefix of the profiles.
+        interval: seconds between two samples, in "sample" mode.
+    """
+
+    def __init__(
+        self,
+        put,
+        function,
+        mode="",
+        rate=1.0,
+        prefix="profiling",
+        interval=0.005,
+        clock=time.time,
+    ):
+        if mode and mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}, expected {MODES}")
+        self.put = put
+        self.function = function
+        self.mode = mode
+        self.rate = rate
+        self.prefix = prefix
+        self.interval = interval
+        self.clock = clock
+
+    @classmethod
+    def from_env(cls, put, function):
+        return cls(
+            put,
+            function,
+            mode=os.getenv("PROFILING_MODE", ""),
+            rate=float(os.getenv("PROFILING_RATE", 1)),
+            prefix=os.getenv("PROFILING_PREFIX", "profiling"),
+            interval=float(os.getenv("PROFILING_INTERVAL", 0.005)),
+        )
+
+    def mode_for(self, requested=None):
+        """Mode of an invocation ("" when not profiled)"""
+        if requested in MODES:
+            return requested
+        if requested:
+            logger.warning(f"Ignoring unknown profiling mode {requested!r}")
+        if self.mode and random.random() < self.rate:
+            return self.mode
+        return ""
+
+    @contextmanager
+    def profile(self, invocation_id, requested=None):
+        """Profile the block if the invocation is selected (or `requested` is a
+        mode), then write the profile"""
+        mode = self.mode_for(requested)
+        if not mode:
+            yield
+            return
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        profiler = _ThreadProfiles() if mode == "cprofile" else _Sampler(self.interval)
+        start = time.perf_counter()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profile = profiler.stop()
+            seconds = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            allocations = tracemalloc.take_snapshot().statistics("lineno")[:TOP]
+            if not tracing:
+                tracemalloc.stop()
+            summary = {
+                "function": self.function,
+                "invocation": invocation_id,
+                "mode": mode,
+                "seconds": seconds,
+                "peak_memory_bytes": peak,
+                "retained_memory_bytes": current,
+                "top_allocations": [
+                    {
+                        "file": str(stat.traceback[0].filename),
+                        "line": stat.traceback[0].lineno,
+                        "bytes": stat.size,
+                        "count": stat.count,
+                    }
+                    for stat in allocations
+                ],
+                "top_functions": top_functions(profile),
+            }
+            try:
+                self.write(invocation_id, mode, profile, summary)
+            except Exception:
+                logger.exception(f"Failed to write the profile of {invocation_id}")
+
+    def write(self, invocation_id, mode, profile, summary):
+        now = datetime.datetime.fromtimestamp(self.clock(), datetime.timezone.utc)
+        base = (
+            f"{self.prefix}/{self.function}/{now:%Y/%m/%d}/"
+            f"{now:%H%M%S}-{invocation_id}"
+        )
+        if mode == "cprofile":
+            # (the format of `pstats.Stats.dump_stats`)
+            self.put(f"{base}.prof", marshal.dumps(profile.stats))
+        else:
+            self.put(f"{base}.folded", folded(profile).encode("UTF-8"))
+        self.put(f"{base}.json", json.dumps(summary, indent=1).encode("UTF-8"))
+
+
+def load_stats(bodies):
+    """The `.prof` profiles added up, as a `pstats.Stats`"""
+    stats = None
+    for body in bodies:
+        loaded = pstats.Stats(_Loaded(marshal.loads(body)), stream=io.StringIO())
+        if stats is None:
+            stats = loaded
+        else:
+            stats.add(loaded)
+    return stats
+
+
+class _Loaded:
+    """Stats read back, in the shape `pstats.Stats` loads from a profiler"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
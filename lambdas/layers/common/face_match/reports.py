@@ -0,0 +1,44 @@
+"""Serialization of the match reports written to the output bucket.
+
+A report is the JSON document `{"Source", "CustomerID", "Matches"}` produced for
+each image. Reports are stored either one per object (`<image_id>.json`), or all
+the reports of one invocation in a single newline-delimited object
+(`<batch_id>.jsonl`), optionally gzip-compressed (`.jsonl.gz`). Both layouts can
+be read by the JSON SerDe of Athena, which decompresses files by extension.
+"""
+
+import gzip
+import json
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def report_key(prefix, image_id):
+    return f"{prefix}/{image_id}.json"
+
+
+def batch_key(prefix, batch_id, compress=False):
+    return f"{prefix}/{batch_id}.jsonl" + (".gz" if compress else "")
+
+
+def encode_report(report):
+    return json.dumps(report).encode("UTF-8")
+
+
+def encode_batch(reports, compress=False):
+    """One report per line, gzip-compressed if `compress`"""
+    body = "".join(json.dumps(report) + "\n" for report in reports).encode("UTF-8")
+    if compress:
+        # mtime=0 gives the same bytes for the same reports (e.g. on retries)
+        body = gzip.compress(body, mtime=0)
+    return body
+
+
+def decode_reports(body, key=""):
+    """List the reports in an object body, whatever the layout it was written in"""
+    if body[:2] == GZIP_MAGIC:
+        body = gzip.decompress(body)
+    text = body.decode("UTF-8")
+    if key.endswith((".jsonl", ".jsonl.gz")):
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [json.loads(text)]
@@ -1,3 +1,6 @@
+from aws_cdk import aws_dynamodb as dynamodb
+from aws_cdk import aws_ecs as ecs
+from aws_cdk import aws_ecs_patterns as ecs_patterns
 from aws_cdk import aws_iam as iam
 from aws_cdk import aws_lambda as lambda_
 from aws_cdk import aws_lambda_event_sources as es
@@ -10,6 +13,21 @@ from aws_cdk import aws_ssm as ssm
 from aws_cdk import core as cdk
 from aws_cdk import custom_resources as cr
 
+# Layout of the match store, the Parquet copy of the matches partitioned by
+# ingestion date and by customer ID hash bucket
+MATCH_STORE_PREFIX = "matches"
+MATCH_STORE_BUCKETS = 16
+# Bits by which the perceptual hashes of near-duplicate images can differ
+NEAR_DUPLICATE_DISTANCE = 3
+# CloudWatch namespace of the per-stage metrics of the functions (the functions
+# are the "service" dimension)
+METRICS_NAMESPACE = "FaceMatching"
+# Width or height above which the uploads are downscaled, with normalize_images
+NORMALIZE_MAX_DIMENSION = 1920
+# Tasks of the long-running worker service, and record workers (threads) per task
+WORKER_MAX_TASKS = 10
+WORKER_THREADS = 40
+
 
 class RekognitionBatchDetectStack(cdk.Stack):
     def __init__(
@@ -17,6 +35,13 @@ class RekognitionBatchDetectStack(cdk.Stack):
         scope: cdk.Construct,
         construct_id: str,
         notification_on: bool = False,
+        batch_output: bool = False,
+        match_store: bool = False,
+        near_duplicates: bool = False,
+        collection_shards: int = 1,
+        worker_service: bool = False,
+        user_search: bool = False,
+        normalize_images: bool = False,
         **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
@@ -53,30 +78,95 @@ class RekognitionBatchDetectStack(cdk.Stack):
             s3n.SqsDestination(queue),
             s3.NotificationKeyFilter(prefix="images/"),
         )
+        # Images under screening/ are only searched against the collection
+        bk_test_images.add_event_notification(
+            s3.EventType.OBJECT_CREATED,
+            s3n.SqsDestination(queue),
+            s3.NotificationKeyFilter(prefix="screening/"),
+        )
 
         # Create the Rekognition collection, and ignore if the collection already exists,
         # caling Rekognition API via a Custom Resource
+        # With several shards, the faces are spread across the collections
+        # <collection>-0 ... <collection>-<N-1> (named as in the function)
+        shard_names = (
+            [f"{collection_id.value_as_string}-{i}" for i in range(collection_shards)]
+            if collection_shards > 1
+            else [collection_id.value_as_string]
+        )
+        for i, shard_name in enumerate(shard_names):
+            suffix = str(i) if collection_shards > 1 else ""
+            _ = cr.AwsCustomResource(
+                self,
+                f"RekognitionCollection{suffix}",
+                on_create={
+                    "service": "Rekognition",
+                    "action": "createCollection",
+                    "parameters": {"CollectionId": shard_name},
+                    "physical_resource_id": cr.PhysicalResourceId.of(
+                        f"RekognitionCollection{suffix}"
+                    ),
+                    "ignore_error_codes_matching": "ResourceAlreadyExistsException",
+                },
+                on_delete={
+                    "service": "Rekognition",
+                    "action": "deleteCollection",
+                    "parameters": {"CollectionId": shard_name},
+                },
+                policy=cr.AwsCustomResourcePolicy.from_sdk_calls(
+                    resources=cr.AwsCustomResourcePolicy.ANY_RESOURCE
+                ),
+            )
 
-        _ = cr.AwsCustomResource(
+        # Token buckets shared by the concurrent instances of the function, to pace
+        # the Rekognition calls within the account TPS quotas
+        rate_limit_table = dynamodb.Table(
             self,
-            "RekognitionCollection",
-            on_create={
-                "service": "Rekognition",
-                "action": "createCollection",
-                "parameters": {"CollectionId": collection_id.value_as_string},
-                "physical_resource_id": cr.PhysicalResourceId.of(
-                    "RekognitionCollection"
-                ),
-                "ignore_error_codes_matching": "ResourceAlreadyExistsException",
-            },
-            on_delete={
-                "service": "Rekognition",
-                "action": "deleteCollection",
-                "parameters": {"CollectionId": collection_id.value_as_string},
-            },
-            policy=cr.AwsCustomResourcePolicy.from_sdk_calls(
-                resources=cr.AwsCustomResourcePolicy.ANY_RESOURCE
+            "RateLimitTable",
+            partition_key=dynamodb.Attribute(
+                name="bucket", type=dynamodb.AttributeType.STRING
             ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # Ledger of the images already indexed, so that redelivered messages and
+        # uploads of the same object version don't add duplicate faces
+        ledger_table = dynamodb.Table(
+            self,
+            "IngestionLedgerTable",
+            partition_key=dynamodb.Attribute(
+                name="image", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # Clusters of the customer IDs that share a face (union-find), updated by
+        # the function with every cross-customer match. The sparse index ranks
+        # the roots of the clusters (spread across a few partitions), for the
+        # most suspicious ones
+        identity_graph_table = dynamodb.Table(
+            self,
+            "IdentityGraphTable",
+            partition_key=dynamodb.Attribute(
+                name="node", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="peer", type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+        identity_graph_table.add_global_secondary_index(
+            index_name="roots",
+            partition_key=dynamodb.Attribute(
+                name="root_partition", type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="score", type=dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=dynamodb.ProjectionType.KEYS_ONLY,
         )
 
         # Define the main lambda function, starting from the library layers
@@ -97,37 +187,197 @@ class RekognitionBatchDetectStack(cdk.Stack):
             description="AWS-Lambda-Powertools",
             layer_version_name="AWS-Lambda-Powertools",
         )
-
-        # The lambda function proper
-        process_fn = lambda_.Function(
+        # Code shared by the functions of the pipeline (e.g. the report format)
+        common_lambda_layer = lambda_python.PythonLayerVersion(
             self,
-            "MatchFacesFn",
-            code=lambda_.Code.from_asset("lambdas/fns/match_faces"),
-            handler="lambda.handler",
-            runtime=lambda_.Runtime.PYTHON_3_8,
-            environment={
+            "CommonLambdaLayer",
+            entry="lambdas/layers/common",
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_8],
+            description="Face matching common code",
+            layer_version_name="face-match-common",
+        )
+        match_faces_layers = [
+            tenacity_lambda_layer,
+            powertools_lambda_layer,
+            common_lambda_layer,
+        ]
+        match_faces_environment = {}
+        if match_store:
+            match_faces_layers.append(
+                lambda_python.PythonLayerVersion(
+                    self,
+                    "PyArrowLambdaLayer",
+                    entry="lambdas/layers/pyarrow",
+                    compatible_runtimes=[lambda_.Runtime.PYTHON_3_8],
+                    description="PyArrow",
+                    layer_version_name="pyarrow",
+                )
+            )
+            match_faces_environment.update(
+                {
+                    "MATCH_STORE_PREFIX": MATCH_STORE_PREFIX,
+                    "MATCH_STORE_BUCKETS": str(MATCH_STORE_BUCKETS),
+                }
+            )
+        # Perceptual hashes of the images indexed, so that near-duplicate uploads
+        # reuse the faces of the first one instead of calling Rekognition again.
+        # Every hash is stored once per band, partitioned by the band value
+        image_hash_table = None
+        if near_duplicates:
+            image_hash_table = dynamodb.Table(
+                self,
+                "ImageHashTable",
+                partition_key=dynamodb.Attribute(
+                    name="band", type=dynamodb.AttributeType.STRING
+                ),
+                sort_key=dynamodb.Attribute(
+                    name="hash", type=dynamodb.AttributeType.STRING
+                ),
+                billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                removal_policy=cdk.RemovalPolicy.DESTROY,
+            )
+            match_faces_environment.update(
+                {
+                    "NEAR_DUPLICATE_DISTANCE": str(NEAR_DUPLICATE_DISTANCE),
+                    "IMAGE_HASH_TABLE": image_hash_table.table_name,
+                }
+            )
+        # Large uploads (e.g. phone photos) are downscaled, with their EXIF
+        # orientation applied, before being sent to Rekognition as bytes
+        if normalize_images:
+            match_faces_environment.update(
+                {
+                    "NORMALIZE_MAX_DIMENSION": str(NORMALIZE_MAX_DIMENSION),
+                    "NORMALIZE_WORKERS": "2",
+                    "NORMALIZE_QUALITY": "90",
+                }
+            )
+        # (sharded collections crop the faces of the images to search them in
+        # the other shards)
+        if near_duplicates or normalize_images or collection_shards > 1:
+            match_faces_layers.append(
+                lambda_python.PythonLayerVersion(
+                    self,
+                    "PillowLambdaLayer",
+                    entry="lambdas/layers/pillow",
+                    compatible_runtimes=[lambda_.Runtime.PYTHON_3_8],
+                    description="Pillow",
+                    layer_version_name="pillow",
+                )
+            )
+
+        match_faces_environment.update(
+            {
                 "COLLECTION_NAME": collection_id.value_as_string,
+                "COLLECTION_SHARDS": str(collection_shards),
+                "POWERTOOLS_METRICS_NAMESPACE": METRICS_NAMESPACE,
+                "POWERTOOLS_SERVICE_NAME": "match_faces",
                 "BUCKET_OUT": bk_output.bucket_name,
                 "PREFIX_OUT": "output",
-            },
-            layers=[tenacity_lambda_layer, powertools_lambda_layer],
-            timeout=cdk.Duration.seconds(60),
-            reserved_concurrent_executions=5,
+                "MAX_WORKERS": "10",
+                # faces indexed (and searched) per image, e.g. for group photos
+                "MAX_FACE_INDEX": "5",
+                "MAX_FACE_SEARCH_WORKERS": "5",
+                "RATE_LIMIT_TABLE": rate_limit_table.table_name,
+                "LEDGER_TABLE": ledger_table.table_name,
+                "IDENTITY_GRAPH_TABLE": identity_graph_table.table_name,
+                "IDENTITY_GRAPH_THRESHOLD": "90",
+                "INDEX_FACES_TPS": "50",
+                "SEARCH_FACES_TPS": "50",
+                "SEARCH_FACES_BY_IMAGE_TPS": "50",
+                # screened images are searched without being added to the collection
+                "SCREENING_PREFIXES": "screening/",
+                "SCREENING_ENROLL_POLICY": "never",
+                # batch output writes a single gzipped, newline-delimited object
+                # per invocation instead of one object per image
+                "OUTPUT_MODE": "batch" if batch_output else "object",
+                "OUTPUT_COMPRESSION": "gzip" if batch_output else "",
+                # the faces of each customer are associated with a Rekognition
+                # user, and searched by user: every match is a distinct customer
+                "SEARCH_MODE": "users" if user_search else "faces",
+                "MAX_USER_MATCH": "100",
+                "ASSOCIATE_FACES_TPS": "50",
+                "SEARCH_USERS_TPS": "50",
+                "SEARCH_USERS_BY_IMAGE_TPS": "50",
+                # invocations profiled ("cprofile" or "sample"), and the fraction
+                # of them; a `Profile` message attribute profiles an invocation
+                "PROFILING_MODE": "",
+                "PROFILING_RATE": "0.01",
+                "PROFILING_PREFIX": "profiling",
+            }
         )
 
-        # Setup the trigger for the lambda function. CDK takes care of
-        # the relevant IAM policies in the lambda role
-        process_fn.add_event_source(es.SqsEventSource(queue))
+        if worker_service:
+            # For sustained heavy traffic, long-running workers poll the queue
+            # instead of the function, with the same code (worker.py), scaled
+            # out with the number of messages in the queue. The workers finish
+            # the messages in progress when stopped, hence the longer stop
+            # timeout. (Their metrics are in Embedded Metric Format in the logs)
+            worker = ecs_patterns.QueueProcessingFargateService(
+                self,
+                "MatchFacesWorker",
+                queue=queue,
+                image=ecs.ContainerImage.from_asset(
+                    "lambdas", file="fns/match_faces/Dockerfile"
+                ),
+                cpu=1024,
+                memory_limit_mib=2048,
+                environment={
+                    **match_faces_environment,
+                    "QUEUE_URL": queue.queue_url,
+                    "MAX_WORKERS": str(WORKER_THREADS),
+                    "WORKER_VISIBILITY_TIMEOUT": "120",
+                },
+                min_scaling_capacity=1,
+                max_scaling_capacity=WORKER_MAX_TASKS,
+            )
+            worker.task_definition.node.default_child.add_property_override(
+                "ContainerDefinitions.0.StopTimeout", 120
+            )
+            consumer = worker.task_definition.task_role
+        else:
+            # The lambda function proper
+            process_fn = lambda_.Function(
+                self,
+                "MatchFacesFn",
+                code=lambda_.Code.from_asset("lambdas/fns/match_faces"),
+                handler="lambda.handler",
+                runtime=lambda_.Runtime.PYTHON_3_8,
+                environment=match_faces_environment,
+                layers=match_faces_layers,
+                timeout=cdk.Duration.seconds(60),
+                # (decoding large images needs memory, and a full vCPU)
+                memory_size=1769 if normalize_images else None,
+                reserved_concurrent_executions=5,
+            )
+
+            # Setup the trigger for the lambda function. The function reports the
+            # messages it failed to process, so that only those are redelivered
+            # (the SqsEventSource of this CDK version can't enable it, hence the override)
+            sqs_mapping = process_fn.add_event_source_mapping(
+                "QueueEventSource", event_source_arn=queue.queue_arn, batch_size=10
+            )
+            sqs_mapping.node.default_child.add_property_override(
+                "FunctionResponseTypes", ["ReportBatchItemFailures"]
+            )
+            consumer = process_fn
+        queue.grant_consume_messages(consumer)
 
-        # Add read-write privileges to the lambda function to access the buckets
-        bk_test_images.grant_read(process_fn)
-        bk_output.grant_read_write(process_fn)
+        # Add read-write privileges to the consumer of the queue to access the buckets
+        bk_test_images.grant_read(consumer)
+        bk_output.grant_read_write(consumer)
+        rate_limit_table.grant_read_write_data(consumer)
+        ledger_table.grant_read_write_data(consumer)
+        identity_graph_table.grant_read_write_data(consumer)
+        if image_hash_table is not None:
+            image_hash_table.grant_read_write_data(consumer)
 
-        # Grant necessary Rekognition privileges to lambda fn
-        process_fn.role.add_to_policy(
+        # Grant necessary Rekognition privileges to the consumer
+        consumer.grant_principal.add_to_principal_policy(
             iam.PolicyStatement(
                 resources=[
-                    f"arn:aws:rekognition:{self.region}:{self.account}:collection/{collection_id.value_as_string}"
+                    f"arn:aws:rekognition:{self.region}:{self.account}:collection/{shard_name}"
+                    for shard_name in shard_names
                 ],
                 actions=[
                     "rekognition:CompareFaces",
@@ -139,6 +389,10 @@ class RekognitionBatchDetectStack(cdk.Stack):
                     "rekognition:SearchFaces",
                     "rekognition:SearchFacesByImage",
                     "rekognition:ListTagsForResource",
+                    "rekognition:CreateUser",
+                    "rekognition:AssociateFaces",
+                    "rekognition:SearchUsers",
+                    "rekognition:SearchUsersByImage",
                 ],
             )
         )
@@ -157,6 +411,12 @@ class RekognitionBatchDetectStack(cdk.Stack):
             string_value=collection_id.value_as_string,
             parameter_name=f"/{self.stack_name}/CollectionId",
         )
+        _ = ssm.StringParameter(
+            self,
+            "SsmIdentityGraphTable",
+            string_value=identity_graph_table.table_name,
+            parameter_name=f"/{self.stack_name}/IdentityGraphTable",
+        )
         _ = ssm.StringParameter(
             self,
             "SsmBucketName",
@@ -188,8 +448,13 @@ class RekognitionBatchDetectStack(cdk.Stack):
                     "PREFIX_OUT": "output",
                     "NOTIFICATION_THRESHOLD": f"/{self.stack_name}/NotificationThreshold",
                     "TOPIC_ARN": sns_topic.topic_arn,
+                    "POWERTOOLS_METRICS_NAMESPACE": METRICS_NAMESPACE,
+                    "POWERTOOLS_SERVICE_NAME": "notify_matches",
+                    "PROFILING_MODE": "",
+                    "PROFILING_RATE": "0.01",
+                    "PROFILING_PREFIX": "profiling",
                 },
-                layers=[powertools_lambda_layer],
+                layers=[powertools_lambda_layer, common_lambda_layer],
                 timeout=cdk.Duration.seconds(60),
                 reserved_concurrent_executions=5,
             )
@@ -198,6 +463,7 @@ class RekognitionBatchDetectStack(cdk.Stack):
             sns_topic.grant_publish(process_fn)
             alarm_threshold.grant_read(process_fn)
             bk_output.grant_read(process_fn)
+            bk_output.grant_put(process_fn, "profiling/*")
 
             process_fn.add_event_source(
                 es.S3EventSource(
@@ -1,13 +1,88 @@
+from aws_cdk import aws_cloudwatch as cloudwatch
+from aws_cdk import aws_events as events
+from aws_cdk import aws_events_targets as targets
 from aws_cdk import aws_glue as glue
 from aws_cdk import aws_iam as iam
+from aws_cdk import aws_lambda as lambda_
+from aws_cdk import aws_lambda_python as lambda_python
 from aws_cdk import aws_s3 as s3
 from aws_cdk import core as cdk
 from aws_cdk import custom_resources as cr
 
+from rekognition_batch_detect.base_stack import (
+    MATCH_STORE_BUCKETS,
+    MATCH_STORE_PREFIX,
+    METRICS_NAMESPACE,
+)
+
+# Compacted reports, one Parquet directory per (daily) window of report objects
+COMPACTED_PREFIX = "compacted"
+COMPACTION_WINDOW = "day"
+# the originals of the compacted reports are moved under this prefix
+ARCHIVE_PREFIX = "archive"
+# larger report objects are left as they are
+COMPACTION_MAX_OBJECT_SIZE = 1 << 20
+# Athena format of the windows (the ones of face_match.compaction)
+WINDOW_FORMATS = {"day": "%Y-%m-%d", "hour": "%Y-%m-%d-%H"}
+
+# Hive types of the nested columns of the reports (the matches are faces, or
+# users when the function searches users)
+MATCHES_TYPE = "struct<Similarity:double,Face:struct<FaceId:string,BoundingBox:struct<Width:double,Height:double,Left:double,Top:double>,ImageId:string,ExternalImageId:string,Confidence:double>,CustomerId:string,SearchedFaceId:string,User:struct<UserId:string,UserStatus:string>>"
+FACES_TYPE = "struct<FaceId:string,Matches:array<struct<FaceId:string,UserId:string,Similarity:double>>>"
+
+# Stages timed by the functions, with the p99 latency (ms) that raises an alarm
+STAGE_ALARMS = {
+    "match_faces": {
+        "Batch": 30000,
+        "Image": 10000,
+        "IndexFaces": 3000,
+        "SearchFaces": 2000,
+        "SearchFacesByImage": 3000,
+        "RateLimitWait": 5000,
+        "ReportPut": 1000,
+        "Normalize": 5000,
+    },
+    "notify_matches": {
+        "Notify": 10000,
+        "ReportGet": 1000,
+        "Publish": 1000,
+    },
+    "compact_reports": {
+        "Compaction": 600000,
+        "Window": 300000,
+    },
+}
+# Counters of the functions, summed on the dashboard
+COUNTERS = {
+    "match_faces": [
+        "Messages",
+        "FailedMessages",
+        "Retries",
+        "Throttles",
+        "ColdStart",
+        "DownscaledImages",
+        "NormalizeFailures",
+        "MatchStoreFailures",
+    ],
+    "notify_matches": ["Alerts", "FailedReports", "PublishFailures", "ColdStart"],
+    "compact_reports": ["CompactedObjects", "CompactedReports"],
+}
+# Distributions of values per image, report or compacted window
+HISTOGRAMS = {
+    "match_faces": ["FacesPerImage", "MatchesPerImage"],
+    "notify_matches": ["AlertsPerReport"],
+    "compact_reports": ["CompactedObjects", "CompactedReports"],
+}
+
 
 class MonitoringStack(cdk.Stack):
     def __init__(
-        self, scope: cdk.Construct, construct_id: str, data_bucket: s3.Bucket, **kwargs
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        data_bucket: s3.Bucket,
+        compact_reports: bool = False,
+        **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
@@ -35,47 +110,186 @@ class MonitoringStack(cdk.Stack):
             )
         )
 
+        # The columns of the reports (set on the reports of near-duplicates of an
+        # earlier upload)
+        report_columns = [
+            {"name": "source", "type": glue.Schema.STRING},
+            {"name": "customerid", "type": glue.Schema.STRING},
+            {
+                "name": "matches",
+                "type": glue.Schema.array(
+                    input_string=MATCHES_TYPE, is_primitive=False
+                ),
+            },
+            {
+                "name": "faces",
+                "type": glue.Schema.array(input_string=FACES_TYPE, is_primitive=False),
+            },
+            {
+                "name": "duplicateof",
+                "type": glue.Schema.struct(
+                    [
+                        {"name": "Source", "type": glue.Schema.STRING},
+                        {"name": "CustomerID", "type": glue.Schema.STRING},
+                        {"name": "Distance", "type": glue.Schema.INTEGER},
+                    ]
+                ),
+            },
+        ]
+
+        # The reports are either one JSON object per file, or newline-delimited
+        # JSON (possibly gzipped, decompressed by Athena based on the .gz
+        # extension) when the function writes them in batches: the JSON SerDe
+        # reads one report per line in both cases
         face_match_table = glue.Table(
             self,
             "FaceMatchResultsTable",
             database=face_match_db,
             table_name="face_match_output",
+            columns=report_columns,
+            data_format=glue.DataFormat.JSON,
+            bucket=data_bucket,
+            s3_prefix="output/",
+        )
+
+        # One row per match, in Parquet partitioned by ingestion date and customer
+        # hash bucket. Partition projection computes the partitions from the query
+        # predicates, so there is no partition to register and queries filtered by
+        # date or customer only read the matching files
+        match_store_location = f"s3://{data_bucket.bucket_name}/{MATCH_STORE_PREFIX}"
+        match_store_table = glue.Table(
+            self,
+            "FaceMatchStoreTable",
+            database=face_match_db,
+            table_name="face_match_rows",
             columns=[
                 {"name": "source", "type": glue.Schema.STRING},
-                {"name": "customerid", "type": glue.Schema.STRING},
-                {
-                    "name": "matches",
-                    "type": glue.Schema.array(
-                        input_string="struct<Similarity:double,Face:struct<FaceId:string,BoundingBox:struct<Width:double,Height:double,Left:double,Top:double>,ImageId:string,ExternalImageId:string,Confidence:double>,CustomerId:string>",
-                        is_primitive=False,
-                    ),
-                },
+                {"name": "customer_id", "type": glue.Schema.STRING},
+                {"name": "match_customer_id", "type": glue.Schema.STRING},
+                {"name": "match_image_id", "type": glue.Schema.STRING},
+                {"name": "match_face_id", "type": glue.Schema.STRING},
+                {"name": "similarity", "type": glue.Schema.DOUBLE},
+                {"name": "ingested_at", "type": glue.Schema.TIMESTAMP},
             ],
-            data_format=glue.DataFormat.JSON,
+            partition_keys=[
+                {"name": "ingest_date", "type": glue.Schema.STRING},
+                {"name": "customer_bucket", "type": glue.Schema.INTEGER},
+            ],
+            data_format=glue.DataFormat.PARQUET,
             bucket=data_bucket,
-            s3_prefix="output/",
+            s3_prefix=f"{MATCH_STORE_PREFIX}/",
         )
+        projection = {
+            "projection.enabled": "true",
+            "projection.ingest_date.type": "date",
+            "projection.ingest_date.range": "2021-01-01,NOW",
+            "projection.ingest_date.format": "yyyy-MM-dd",
+            "projection.ingest_date.interval": "1",
+            "projection.ingest_date.interval.unit": "DAYS",
+            "projection.customer_bucket.type": "integer",
+            "projection.customer_bucket.range": f"0,{MATCH_STORE_BUCKETS - 1}",
+            "storage.location.template": f"{match_store_location}/"
+            "ingest_date=${ingest_date}/customer_bucket=${customer_bucket}/",
+        }
+        # (one override per key, added to the parameters of the table, e.g. its
+        # classification; the dots of the keys are escaped in the paths)
+        for key, value in projection.items():
+            escaped = key.replace(".", "\\.")
+            match_store_table.node.default_child.add_property_override(
+                f"TableInput.Parameters.{escaped}", value
+            )
 
-        # Create a view in athena to unnest the matches array
-        athena_view = cr.AwsCustomResource(
+        # (the compaction function only exists with compact_reports)
+        self.add_dashboard(
+            [
+                service
+                for service in STAGE_ALARMS
+                if compact_reports or service != "compact_reports"
+            ]
+        )
+
+        if not compact_reports:
+            self.add_stats_view(
+                face_match_db,
+                face_match_table.table_name,
+                [face_match_table],
+                data_bucket,
+            )
+            return
+
+        # The compacted reports: the small report objects of every closed window,
+        # merged into Parquet files by a scheduled function. Each window is a
+        # partition, pointed at the directory of its last compaction run
+        compacted_table = glue.Table(
             self,
+            "FaceMatchCompactedTable",
+            database=face_match_db,
+            table_name="face_match_compacted",
+            columns=report_columns
+            + [{"name": "reportpath", "type": glue.Schema.STRING}],
+            partition_keys=[{"name": "report_window", "type": glue.Schema.STRING}],
+            data_format=glue.DataFormat.PARQUET,
+            bucket=data_bucket,
+            s3_prefix=f"{COMPACTED_PREFIX}/",
+        )
+        self.add_compaction(data_bucket, face_match_db, compacted_table)
+
+        # All the reports: the compacted ones, and the originals of the windows
+        # not compacted yet (or too large to be compacted). The compacted windows
+        # are read from the partitions of the catalog, without scanning the table
+        reports_view = self.add_view(
+            "AthenaReportsView",
+            reports_view_query.format(
+                database=face_match_db.database_name,
+                table=face_match_table.table_name,
+                compacted=compacted_table.table_name,
+                window_format=WINDOW_FORMATS[COMPACTION_WINDOW],
+                max_object_size=COMPACTION_MAX_OBJECT_SIZE,
+            ),
+            face_match_db,
+            [face_match_table.table_arn, compacted_table.table_arn],
+            "face_match_reports",
+            data_bucket,
+        )
+        stats_view = self.add_stats_view(
+            face_match_db,
+            "face_match_reports",
+            [face_match_table, compacted_table],
+            data_bucket,
+        )
+        stats_view.node.add_dependency(reports_view)
+
+    def add_stats_view(self, database, table_name, tables, data_bucket):
+        """View unnesting the matches of the reports of a table (or view)"""
+        return self.add_view(
             "AthenaView",
+            view_query.format(database=database.database_name, table=table_name),
+            database,
+            [t.table_arn for t in tables] + [self.table_arn(database, table_name)],
+            "matchingstats",
+            data_bucket,
+        )
+
+    def table_arn(self, database, table_name):
+        return f"arn:aws:glue:{self.region}:{self.account}:table/{database.database_name}/{table_name}"
+
+    def add_view(self, construct_id, query, database, sources, view_name, data_bucket):
+        """Athena view created by a query, when the stack is created, reading the
+        tables (and views) of the ARNs `sources`"""
+        return cr.AwsCustomResource(
+            self,
+            construct_id,
             on_create={
                 "service": "Athena",
                 "action": "startQueryExecution",
                 "parameters": {
-                    "QueryString": view_query.format(
-                        **{
-                            "database": face_match_db.database_name,
-                            "table": face_match_table.table_name,
-                        }
-                    ),
-                    "QueryExecutionContext": {"Database": face_match_db.database_name},
+                    "QueryString": query,
+                    "QueryExecutionContext": {"Database": database.database_name},
                     "ResultConfiguration": {
                         "OutputLocation": f"s3://{data_bucket.bucket_name}/queries"
                     },
                 },
-                "physical_resource_id": cr.PhysicalResourceId.of("AthenaView"),
+                "physical_resource_id": cr.PhysicalResourceId.of(construct_id),
             },
             install_latest_aws_sdk=False,
             policy=cr.AwsCustomResourcePolicy.from_statements(
@@ -83,14 +297,15 @@ class MonitoringStack(cdk.Stack):
                     iam.PolicyStatement(
                         actions=[
                             "glue:GetTable",
+                            "glue:GetPartitions",
                             "glue:CreateTable",
                             "athena:StartQueryExecution",
                         ],
                         resources=[
-                            face_match_db.catalog_arn,
-                            face_match_db.database_arn,
-                            face_match_table.table_arn,
-                            f"arn:aws:glue:{self.region}:{self.account}:table/{face_match_db.database_name}/matchingstats",
+                            database.catalog_arn,
+                            database.database_arn,
+                            *sources,
+                            self.table_arn(database, view_name),
                             f"arn:aws:athena:{self.region}:{self.account}:workgroup/primary",
                         ],
                     ),
@@ -102,6 +317,133 @@ class MonitoringStack(cdk.Stack):
             ),
         )
 
+    def add_compaction(self, data_bucket, database, compacted_table):
+        """Scheduled function compacting the small report objects"""
+        compact_fn = lambda_.Function(
+            self,
+            "CompactReportsFn",
+            code=lambda_.Code.from_asset("lambdas/fns/compact_reports"),
+            handler="lambda.handler",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            environment={
+                "BUCKET_OUT": data_bucket.bucket_name,
+                "PREFIX_OUT": "output",
+                "COMPACTED_PREFIX": COMPACTED_PREFIX,
+                "COMPACTION_WINDOW": COMPACTION_WINDOW,
+                # reports still being written (e.g. retried) are left alone
+                "COMPACTION_GRACE": "3600",
+                "COMPACTION_MAX_OBJECT_SIZE": str(COMPACTION_MAX_OBJECT_SIZE),
+                "ARCHIVE_PREFIX": ARCHIVE_PREFIX,
+                "GLUE_DATABASE": database.database_name,
+                "GLUE_TABLE": compacted_table.table_name,
+                "POWERTOOLS_METRICS_NAMESPACE": METRICS_NAMESPACE,
+                "POWERTOOLS_SERVICE_NAME": "compact_reports",
+            },
+            layers=[
+                lambda_python.PythonLayerVersion(
+                    self,
+                    layer_id,
+                    entry=f"lambdas/layers/{entry}",
+                    compatible_runtimes=[lambda_.Runtime.PYTHON_3_8],
+                )
+                for layer_id, entry in (
+                    ("PowerToolsLayer", "aws-lambda-powertools"),
+                    ("CommonLayer", "common"),
+                    ("PyArrowLayer", "pyarrow"),
+                )
+            ],
+            memory_size=2048,
+            timeout=cdk.Duration.minutes(15),
+            # a single compaction at a time
+            reserved_concurrent_executions=1,
+        )
+        data_bucket.grant_read_write(compact_fn)
+        data_bucket.grant_delete(compact_fn)
+        compact_fn.add_to_role_policy(
+            iam.PolicyStatement(
+                actions=[
+                    "glue:GetTable",
+                    "glue:GetPartition",
+                    "glue:CreatePartition",
+                    "glue:UpdatePartition",
+                ],
+                resources=[
+                    database.catalog_arn,
+                    database.database_arn,
+                    compacted_table.table_arn,
+                ],
+            )
+        )
+        events.Rule(
+            self,
+            "CompactReportsSchedule",
+            schedule=events.Schedule.rate(cdk.Duration.hours(1)),
+            targets=[targets.LambdaFunction(compact_fn)],
+        )
+
+    def add_dashboard(self, services):
+        """Dashboard of the stage metrics of the functions (`services`), and p99
+        alarms"""
+
+        def metric(service, name, statistic):
+            return cloudwatch.Metric(
+                namespace=METRICS_NAMESPACE,
+                metric_name=name,
+                dimensions={"service": service},
+                statistic=statistic,
+                period=cdk.Duration.minutes(1),
+            )
+
+        dashboard = cloudwatch.Dashboard(
+            self, "FaceMatchDashboard", dashboard_name="FaceMatching"
+        )
+        for service in services:
+            stages = STAGE_ALARMS[service]
+            dashboard.add_widgets(
+                *[
+                    cloudwatch.GraphWidget(
+                        title=f"{service} stage latency ({statistic}, ms)",
+                        left=[
+                            metric(service, f"{stage}Latency", statistic)
+                            for stage in stages
+                        ],
+                        width=12,
+                    )
+                    for statistic in ("p50", "p99")
+                ]
+            )
+            dashboard.add_widgets(
+                cloudwatch.GraphWidget(
+                    title=f"{service} counters",
+                    left=[metric(service, name, "Sum") for name in COUNTERS[service]],
+                    width=12,
+                ),
+                cloudwatch.GraphWidget(
+                    title=f"{service} per image / report (p50, p99)",
+                    left=[
+                        metric(service, name, statistic)
+                        for name in HISTOGRAMS[service]
+                        for statistic in ("p50", "p99")
+                    ],
+                    width=12,
+                ),
+            )
+            for stage, threshold_ms in stages.items():
+                cloudwatch.Alarm(
+                    self,
+                    f"{service}{stage}P99Alarm",
+                    metric=metric(service, f"{stage}Latency", "p99"),
+                    threshold=threshold_ms,
+                    evaluation_periods=5,
+                    datapoints_to_alarm=3,
+                    comparison_operator=(
+                        cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD
+                    ),
+                    treat_missing_data=cloudwatch.TreatMissingData.NOT_BREACHING,
+                    alarm_description=f"p99 latency of {stage} in {service} above "
+                    f"{threshold_ms} ms",
+                )
+
 
 view_query = """CREATE OR REPLACE VIEW matchingstats AS 
 SELECT
@@ -112,3 +454,16 @@ FROM
   ({database}.{table}
 CROSS JOIN UNNEST(matches) t (match))
 """
+
+
+reports_view_query = """CREATE OR REPLACE VIEW face_match_reports AS
+SELECT source, customerid, matches, faces, duplicateof
+FROM {database}.{table}
+WHERE "$file_size" > {max_object_size}
+OR date_format("$file_modified_time", '{window_format}') NOT IN (
+  SELECT report_window FROM {database}."{compacted}$partitions"
+)
+UNION ALL
+SELECT source, customerid, matches, faces, duplicateof
+FROM {database}.{compacted}
+"""
@@ -0,0 +1,89 @@
+"""Fixtures shared by the tests of the functions"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from tools.lambdas import load_function
+from tools.local_aws import LocalS3
+from tools.rekognition_emulator import RekognitionEmulator
+
+from face_match.metrics import LocalSink  # isort: skip
+
+BUCKET = "images"
+
+
+class MatchFaces:
+    """A fresh `match_faces` module on a local S3 and a Rekognition emulator (an
+    instance of `emulator`), with its collections created and its metrics kept
+    in memory (`metrics`).
+
+    Args:
+        emulator: class of the Rekognition emulator.
+        emulator_args: arguments of the emulator, other than `s3`.
+        env: environment variables of the function, added to the defaults.
+    """
+
+    def __init__(self, emulator=RekognitionEmulator, emulator_args=None, **env):
+        self.s3 = LocalS3()
+        self.reko = emulator(s3=self.s3, **(emulator_args or {}))
+        self.fn = load_function(
+            "match_faces",
+            env={
+                "COLLECTION_NAME": "faces",
+                "BUCKET_OUT": "output",
+                "PREFIX_OUT": "output",
+                "LOG_LEVEL": "WARNING",
+                **env,
+            },
+            reko=self.reko,
+            s3=self.s3,
+        )
+        for shard in self.fn.shards:
+            self.reko.create_collection(CollectionId=shard)
+        self.metrics = LocalSink()
+        self.fn.stage_metrics.sink = self.metrics
+
+    def upload(self, key, body=b"image"):
+        """Put an image in the images bucket, returns its object"""
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        return self.s3.objects[(BUCKET, key)]
+
+    def record(self, key):
+        """The S3 event record of an uploaded image"""
+        etag = self.s3.objects[(BUCKET, key)]["ETag"]
+        return LocalS3.event_record(BUCKET, key, etag=etag)
+
+    def ledger_entry(self, key):
+        """The ledger entry of an uploaded image, or None"""
+        etag = self.s3.objects[(BUCKET, key)]["ETag"]
+        return self.fn.ledger.get(self.fn.ledger.key(BUCKET, key, etag))
+
+    def process(self, key):
+        """Process the S3 event of an uploaded image"""
+        return self.fn.process_s3_record(self.record(key))
+
+    def message(self, key, **attributes):
+        """The SQS record of the S3 event of an uploaded image, with the ID `key`
+        and the string message `attributes`"""
+        return {
+            "messageId": key,
+            "receiptHandle": key,
+            "body": json.dumps({"Records": [self.record(key)]}),
+            "messageAttributes": {
+                name: {"stringValue": value, "dataType": "String"}
+                for name, value in attributes.items()
+            },
+        }
+
+    def invoke(self, *keys, request_id="request-1"):
+        """Invoke the handler with the messages of the uploaded images `keys`"""
+        event = {"Records": [self.message(key) for key in keys]}
+        return self.fn.handler(event, SimpleNamespace(aws_request_id=request_id))
+
+
+@pytest.fixture
+def match_faces():
+    """Factory of `MatchFaces`, e.g. `match_faces(COLLECTION_SHARDS=2)`"""
+    return MatchFaces
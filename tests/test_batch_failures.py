@@ -0,0 +1,57 @@
+"""Partial failures of the SQS batches of `match_faces`"""
+
+import json
+
+import pytest
+
+from tools.rekognition_emulator import _raise
+
+
+@pytest.fixture
+def app(match_faces):
+    app = match_faces(LOG_LEVEL="CRITICAL")
+    index_faces = app.reko.index_faces
+
+    def broken_images(Image, **kwargs):
+        if "broken" in Image["S3Object"]["Name"]:
+            _raise(
+                app.reko.exceptions.InvalidImageFormatException,
+                "IndexFaces",
+                "Request has invalid image format",
+            )
+        return index_faces(Image=Image, **kwargs)
+
+    app.reko.index_faces = broken_images
+    return app
+
+
+def reports(app):
+    return sorted(key for bucket, key in app.s3.objects if bucket == "output")
+
+
+def test_only_the_failed_messages_are_redelivered(app):
+    for key in ("alice_0001.jpg", "broken_0001.jpg", "alice_0002.jpg"):
+        app.upload(key)
+    response = app.invoke("alice_0001.jpg", "broken_0001.jpg", "alice_0002.jpg")
+    assert response == {"batchItemFailures": [{"itemIdentifier": "broken_0001.jpg"}]}
+    for key in ("alice_0001.jpg", "alice_0002.jpg"):
+        assert app.ledger_entry(key)["status"] == "done"
+    assert "output/broken_0001.jpg.json" not in reports(app)
+    assert app.metrics.values["Messages"] == [3]
+    assert app.metrics.values["FailedMessages"] == [1]
+
+
+def test_a_message_fails_with_any_of_its_records(app):
+    app.upload("alice_0001.jpg")
+    app.upload("broken_0001.jpg")
+    message = app.message("alice_0001.jpg")
+    message["body"] = json.dumps(
+        {"Records": [app.record("alice_0001.jpg"), app.record("broken_0001.jpg")]}
+    )
+    response = app.fn.handler({"Records": [message]}, None)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "alice_0001.jpg"}]}
+
+
+def test_test_events_are_not_failures(app):
+    message = {"messageId": "test", "body": '{"Event": "s3:TestEvent"}'}
+    assert app.fn.handler({"Records": [message]}, None) == {"batchItemFailures": []}
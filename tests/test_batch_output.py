@@ -0,0 +1,114 @@
+"""Batch output of `match_faces`: one report object, and match store rows, per
+invocation"""
+
+import pytest
+from botocore.exceptions import ClientError
+
+IMAGES = ["alice_0001.jpg", "alice_0002.jpg", "bob_0001.jpg"]
+
+
+def server_error(operation):
+    return ClientError(
+        {
+            "Error": {"Code": "InternalError", "Message": "Internal Error"},
+            "ResponseMetadata": {"HTTPStatusCode": 500},
+        },
+        operation,
+    )
+
+
+@pytest.fixture
+def app(match_faces, monkeypatch):
+    app = match_faces(
+        # (Alice and Bob look alike)
+        emulator_args={"alias_rate": 1.0, "alias_pool": 1},
+        OUTPUT_MODE="batch",
+        MATCH_STORE_PREFIX="matches",
+        LOG_LEVEL="CRITICAL",
+    )
+    # (no waiting between the retries)
+    monkeypatch.setattr(app.fn.write_match_store_retry.retry, "sleep", lambda _: None)
+    for key in IMAGES:
+        app.upload(key)
+    return app
+
+
+def objects(app, prefix):
+    return sorted(
+        key
+        for bucket, key in app.s3.objects
+        if bucket == "output" and key.startswith(prefix)
+    )
+
+
+def test_match_store_failures_do_not_write_the_reports_again(app, monkeypatch):
+    def write_reports(*args, **kwargs):
+        raise server_error("PutObject")
+
+    monkeypatch.setattr(app.fn.match_store, "write_reports", write_reports)
+    assert app.invoke(*IMAGES) == {"batchItemFailures": []}
+    batch = app.fn.batch_key("output", "request-1")
+    assert objects(app, "output/") == [batch]
+    for key in IMAGES:
+        entry = app.ledger_entry(key)
+        assert entry["status"] == "done"
+        assert entry["report_key"] in (batch, None)
+    assert app.metrics.values["MatchStoreFailures"] == [1]
+    assert app.metrics.values["Retries"] == [1] * 4
+
+    # a redelivery has nothing left to write
+    assert app.invoke(*IMAGES, request_id="request-2") == {"batchItemFailures": []}
+    assert objects(app, "output/") == [batch]
+
+
+def test_match_store_rows_are_retried_on_their_own(app, monkeypatch):
+    write_reports = app.fn.match_store.write_reports
+    calls = []
+
+    def fail_once(*args, **kwargs):
+        calls.append(args[3])
+        if len(calls) == 1:
+            raise server_error("PutObject")
+        return write_reports(*args, **kwargs)
+
+    monkeypatch.setattr(app.fn.match_store, "write_reports", fail_once)
+    # (the images of the second batch match the first one)
+    assert app.invoke(IMAGES[0]) == {"batchItemFailures": []}
+    calls.clear()
+    response = app.invoke(*IMAGES[1:], request_id="request-2")
+    assert response == {"batchItemFailures": []}
+    # (the retry writes the same objects)
+    assert calls == ["request-2", "request-2"]
+    assert objects(app, "matches/")
+    assert "MatchStoreFailures" not in app.metrics.values
+
+
+def test_failed_batch_objects_fail_every_message(app, monkeypatch):
+    def write_batch(batch_id, reports):
+        raise server_error("PutObject")
+
+    monkeypatch.setattr(app.fn, "write_batch", write_batch)
+    response = app.invoke(*IMAGES)
+    assert sorted(f["itemIdentifier"] for f in response["batchItemFailures"]) == IMAGES
+    assert objects(app, "matches/") == []
+
+
+def test_failed_batches_release_the_images_not_indexed(app, monkeypatch):
+    write_batch = app.fn.write_batch
+
+    def fail_once(batch_id, reports):
+        monkeypatch.setattr(app.fn, "write_batch", write_batch)
+        raise server_error("PutObject")
+
+    app.invoke(IMAGES[0])
+    monkeypatch.setattr(app.fn, "write_batch", fail_once)
+    # a screened image is not enrolled, so it has no ledger entry to retry from
+    app.upload("bob_0002.jpg")
+    event = {"Records": [app.message("bob_0002.jpg", Mode="screen")]}
+    response = app.fn.handler(event, None)
+    assert response == {"batchItemFailures": [{"itemIdentifier": "bob_0002.jpg"}]}
+    assert app.ledger_entry("bob_0002.jpg") is None
+
+    # the redelivery doesn't wait for the lease of the claim
+    assert app.fn.handler(event, None) == {"batchItemFailures": []}
+    assert app.ledger_entry("bob_0002.jpg")["status"] == "done"
@@ -0,0 +1,89 @@
+"""Inventory of the collection and eviction of the faces selected by policy"""
+
+import pytest
+
+from tools.collection import Evictor, FaceIndex, snapshot
+from tools.lambdas import load_function
+from tools.rekognition_emulator import RekognitionEmulator
+
+ledger = load_function("match_faces", module="ledger")
+near_duplicates = load_function("match_faces", module="near_duplicates")
+
+# image -> index time
+IMAGES = {
+    "alice_0001.jpg": 100.0,
+    "alice_0002.jpg": 200.0,
+    "alice_0003.jpg": 300.0,
+    "bob_0001.jpg": 400.0,
+    "carol_0001.jpg": 500.0,
+    "carol_0002.jpg": 600.0,
+}
+
+
+@pytest.fixture
+def collection():
+    """A collection of faces associated with the users of their customers, with
+    their ledger entries and image hashes"""
+    reko = RekognitionEmulator()
+    reko.create_collection(CollectionId="faces")
+    face_ids = dict(zip(IMAGES, reko.bulk_index_faces("faces", list(IMAGES))))
+    reko.bulk_associate_faces("faces")
+    store = ledger.InMemoryLedgerStore()
+    hash_index = near_duplicates.HashIndex(max_distance=3)
+    for n, (image, indexed_at) in enumerate(IMAGES.items()):
+        entry = {"status": "done", "updated": indexed_at, "face_ids": [face_ids[image]]}
+        store.put(f"images/{image}#etag", entry)
+        hash_index.add(n << 48, {"face_ids": [face_ids[image]]})
+    index = FaceIndex(":memory:")
+    snapshot(reko, ["faces"], index, store)
+    return reko, index, store, hash_index
+
+
+def images(index):
+    """The images of the faces left in the index"""
+    customers = ("alice", "bob", "carol")
+    return sorted(f["external_image_id"] for c in customers for f in index.customer(c))
+
+
+def test_snapshots_take_the_index_times_of_the_ledger(collection):
+    _, index, _, _ = collection
+    faces = index.customer("alice")
+    assert [f["indexed_at"] for f in faces] == [100.0, 200.0, 300.0]
+    assert {f["user_id"] for f in faces} == {"alice"}
+    assert index.counts()["faces"] == len(IMAGES)
+
+
+def test_policies_select_the_faces(collection):
+    _, index, _, _ = collection
+    selected = index.select(older_than=150.0, customers=["bob"], max_per_customer=1)
+    assert sorted(f["external_image_id"] for f in selected) == [
+        "alice_0001.jpg",
+        "alice_0002.jpg",
+        "bob_0001.jpg",
+        "carol_0001.jpg",
+    ]
+
+
+def test_eviction_deletes_the_faces_and_their_artifacts(collection):
+    reko, index, store, hash_index = collection
+    selected = index.select(older_than=150.0, customers=["bob"], max_per_customer=1)
+    stats = Evictor(reko, index, store, hash_index).evict(selected)
+    assert stats == {
+        "selected": 4,
+        # (the faces of users can only be deleted once disassociated)
+        "disassociated": 4,
+        "deleted": 4,
+        "failed": 0,
+        # Bob has no face left
+        "deleted_users": 1,
+        "ledger_entries": 4,
+        "image_hashes": 4,
+    }
+    left = ["alice_0003.jpg", "carol_0002.jpg"]
+    assert images(index) == left
+    faces = reko.list_faces(CollectionId="faces")["Faces"]
+    assert sorted(f["ExternalImageId"] for f in faces) == left
+    users = reko.list_users(CollectionId="faces")["Users"]
+    assert sorted(u["UserId"] for u in users) == ["alice", "carol"]
+    assert sorted(key for key, _ in store.scan()) == [f"images/{i}#etag" for i in left]
+    assert len(hash_index.cache) == 2
@@ -0,0 +1,181 @@
+"""Union-find of the customer IDs, in memory and on a stand-in table"""
+
+import random
+
+import pytest
+from botocore.exceptions import ClientError
+
+import tools.lambdas  # noqa: F401 (makes the common layer importable)
+from face_match import identity_graph
+from face_match.identity_graph import (
+    DynamoDBGraphStore,
+    IdentityGraph,
+    InMemoryGraphStore,
+)
+
+
+def _error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "Operation")
+
+
+class GraphTable:
+    """The calls of the graph store to its table, in memory.
+
+    Like a global secondary index, the index of the roots lags behind the
+    table: the roots merged into another cluster stay in it.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.index = {}
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get((Key["node"]["S"], Key["peer"]["S"]))
+        return {"Item": dict(item)} if item else {}
+
+    def transact_write_items(self, TransactItems):
+        for request in TransactItems:
+            put = request["Put"]
+            item = put["Item"]
+            current = self.items.get((item["node"]["S"], item["peer"]["S"]))
+            condition = put.get("ConditionExpression", "")
+            if "attribute_not_exists" in condition and current is not None:
+                raise _error("TransactionCanceledException")
+            if "#version" in condition and (
+                current is None
+                or current["version"] != put["ExpressionAttributeValues"][":version"]
+            ):
+                raise _error("TransactionCanceledException")
+        for request in TransactItems:
+            item = request["Put"]["Item"]
+            self.items[(item["node"]["S"], item["peer"]["S"])] = dict(item)
+            if "root_partition" in item:
+                self.index[item["node"]["S"]] = (
+                    item["root_partition"]["S"],
+                    float(item["score"]["N"]),
+                )
+        return {}
+
+    def update_item(self, Key, ExpressionAttributeValues, **kwargs):
+        key = (Key["node"]["S"], Key["peer"]["S"])
+        item = self.items.setdefault(key, {"node": Key["node"], "peer": Key["peer"]})
+        if ":similarity" in ExpressionAttributeValues:
+            similarity = ExpressionAttributeValues[":similarity"]
+            if "similarity" in item and float(item["similarity"]["N"]) >= float(
+                similarity["N"]
+            ):
+                raise _error("ConditionalCheckFailedException")
+            item["similarity"] = similarity
+        else:
+            item["parent"] = ExpressionAttributeValues[":parent"]
+        return {}
+
+    def query(
+        self,
+        ExpressionAttributeValues,
+        IndexName=None,
+        Limit=None,
+        ExclusiveStartKey=None,
+        **kwargs,
+    ):
+        if IndexName:
+            partition = ExpressionAttributeValues[":root"]["S"]
+            keys = sorted(
+                (
+                    (score, node)
+                    for node, (p, score) in self.index.items()
+                    if p == partition
+                ),
+                reverse=True,
+            )
+            items = [{"node": {"S": node}} for _, node in keys]
+        else:
+            node = ExpressionAttributeValues[":node"]["S"]
+            after = ExpressionAttributeValues.get(":self", {"S": ""})["S"]
+            items = [
+                item
+                for (n, peer), item in sorted(self.items.items())
+                if n == node and peer > after
+            ]
+        start = ExclusiveStartKey["position"] if ExclusiveStartKey else 0
+        end = start + Limit if Limit else len(items)
+        response = {"Items": items[start:end]}
+        if end < len(items):
+            response["LastEvaluatedKey"] = {"position": end}
+        return response
+
+
+def random_matches(n_customers=60, n_matches=50, seed=0):
+    rng = random.Random(seed)
+    customers = [f"customer-{i}" for i in range(n_customers)]
+    return [
+        (*rng.sample(customers, 2), round(rng.uniform(90, 100), 3))
+        for _ in range(n_matches)
+    ]
+
+
+@pytest.fixture(params=["memory", "dynamodb"])
+def graph(request):
+    if request.param == "memory":
+        return IdentityGraph(InMemoryGraphStore())
+    return IdentityGraph(DynamoDBGraphStore("graph", client=GraphTable()))
+
+
+def test_clusters_are_the_connected_customers(graph):
+    matches = random_matches()
+    for a, b, similarity in matches:
+        graph.add_match(a, b, similarity)
+
+    # the connected components, the slow way
+    components = {}
+    for a, b, _ in matches:
+        merged = components.get(a, {a}) | components.get(b, {b})
+        for node in merged:
+            components[node] = merged
+    for customer, component in components.items():
+        cluster = graph.cluster(customer)
+        assert sorted(cluster["members"]) == sorted(component)
+        assert cluster["size"] == len(component)
+        assert graph.find(customer) == cluster["root"]
+    assert graph.cluster("stranger")["members"] == ["stranger"]
+
+
+def test_roots_do_not_hold_the_members():
+    table = GraphTable()
+    graph = IdentityGraph(DynamoDBGraphStore("graph", client=table))
+    for i in range(1, 200):
+        graph.add_match("customer-0", f"customer-{i}", 95.0)
+    root = graph.find("customer-0")
+    item = table.items[(root, "#")]
+    assert "members" not in item
+    assert item["size"]["N"] == "200"
+    assert len(graph.cluster("customer-0")["members"]) == 200
+
+
+def test_roots_are_spread_across_partitions():
+    table = GraphTable()
+    graph = IdentityGraph(DynamoDBGraphStore("graph", client=table))
+    for i in range(0, 100, 2):
+        graph.add_match(f"customer-{i}", f"customer-{i + 1}", 95.0)
+    partitions = {partition for partition, _ in table.index.values()}
+    assert len(partitions) > 8
+
+
+@pytest.mark.parametrize("partitions", [1, 16])
+@pytest.mark.parametrize("k", [1, 3, 10])
+def test_top_clusters_skips_the_merged_roots(k, partitions, monkeypatch):
+    monkeypatch.setattr(identity_graph, "ROOT_PARTITIONS", partitions)
+    memory = IdentityGraph(InMemoryGraphStore())
+    table = GraphTable()
+    dynamodb = IdentityGraph(DynamoDBGraphStore("graph", client=table))
+    for a, b, similarity in random_matches(n_customers=200, n_matches=150):
+        memory.add_match(a, b, similarity)
+        dynamodb.add_match(a, b, similarity)
+    # (the index still has the roots merged into other clusters)
+    assert len(table.index) > len(dynamodb.store.top_roots(1000))
+
+    expected = memory.top_clusters(k)
+    top = dynamodb.top_clusters(k)
+    assert len(top) == k
+    assert [c["size"] for c in top] == [c["size"] for c in expected]
+    assert [c["max_similarity"] for c in top] == [c["max_similarity"] for c in expected]
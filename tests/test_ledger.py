@@ -0,0 +1,145 @@
+"""State machine of the ingestion ledger of `match_faces`, on the in-memory store"""
+
+import threading
+
+import pytest
+
+from tools.lambdas import load_function
+
+ledger = load_function("match_faces", module="ledger")
+
+KEY = ledger.IngestionLedger.key("images", "images/alice/alice_0001.jpg", '"abc"')
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def ingestion(clock):
+    return ledger.IngestionLedger(ledger.InMemoryLedgerStore(), lease=300, clock=clock)
+
+
+def test_key_strips_the_etag_quotes():
+    assert KEY == "images/images/alice/alice_0001.jpg#abc"
+
+
+def test_begin_claims_a_new_image(ingestion):
+    assert ingestion.begin(KEY) is None
+    assert ingestion.get(KEY)["status"] == "claimed"
+
+
+def test_begin_refuses_a_live_claim(ingestion, clock):
+    ingestion.begin(KEY)
+    clock.now += 299
+    with pytest.raises(ledger.ImageInProgress):
+        ingestion.begin(KEY)
+
+
+def test_begin_takes_over_an_expired_claim(ingestion, clock):
+    ingestion.begin(KEY)
+    clock.now += 301
+    assert ingestion.begin(KEY) is None
+    assert ingestion.get(KEY)["updated"] == clock.now
+
+
+def test_takeover_fails_if_the_claim_changed(ingestion, clock):
+    ingestion.begin(KEY)
+    clock.now += 301
+    store = ingestion.store
+    expired = store.get(KEY)
+    # another worker takes the claim over first
+    assert ingestion.begin(KEY) is None
+    with pytest.raises(ledger.ConditionFailed):
+        store.put(
+            KEY,
+            {"status": "claimed", "updated": clock.now},
+            if_match=("updated", expired["updated"]),
+        )
+
+
+def test_begin_returns_the_faces_of_an_indexed_image(ingestion, clock):
+    boxes = [
+        {"Width": 0.4, "Height": 0.4, "Left": 0.1, "Top": 0.1},
+        {"Width": 0.1, "Height": 0.1, "Left": 0.7, "Top": 0.2},
+    ]
+    ingestion.begin(KEY)
+    ingestion.indexed(KEY, ["face-1", "face-2"], boxes)
+    # (even long after, an indexed image is never indexed again)
+    clock.now += 3600
+    entry = ingestion.begin(KEY)
+    assert entry["status"] == "indexed"
+    assert entry["face_ids"] == ["face-1", "face-2"]
+    assert entry["boxes"] == boxes
+
+
+def test_begin_returns_a_done_image_with_its_report_key(ingestion):
+    ingestion.begin(KEY)
+    ingestion.indexed(KEY, ["face-1"])
+    ingestion.done(KEY, ["face-1"], "output/alice_0001.jpg.json")
+    entry = ingestion.begin(KEY)
+    assert entry["status"] == "done"
+    assert entry["face_ids"] == ["face-1"]
+    assert entry["report_key"] == "output/alice_0001.jpg.json"
+
+
+def test_done_without_report(ingestion):
+    ingestion.begin(KEY)
+    ingestion.done(KEY, [])
+    entry = ingestion.begin(KEY)
+    assert entry["status"] == "done"
+    assert entry["report_key"] is None
+
+
+def test_release_lets_the_image_be_claimed_again(ingestion):
+    ingestion.begin(KEY)
+    ingestion.release(KEY)
+    assert ingestion.get(KEY) is None
+    assert ingestion.begin(KEY) is None
+
+
+def test_release_keeps_the_indexed_faces(ingestion):
+    ingestion.begin(KEY)
+    ingestion.indexed(KEY, ["face-1"])
+    # (the image failed after its faces were indexed)
+    ingestion.release(KEY)
+    entry = ingestion.begin(KEY)
+    assert entry["status"] == "indexed"
+    assert entry["face_ids"] == ["face-1"]
+
+
+def test_a_single_concurrent_begin_claims_the_image(ingestion):
+    results = []
+    barrier = threading.Barrier(8)
+
+    def begin():
+        barrier.wait()
+        try:
+            results.append(ingestion.begin(KEY))
+        except ledger.ImageInProgress:
+            results.append("in progress")
+
+    threads = [threading.Thread(target=begin) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(None) == 1
+    assert results.count("in progress") == 7
+
+
+def test_in_memory_store_keeps_the_most_recent_entries():
+    store = ledger.InMemoryLedgerStore(max_entries=2)
+    for key in ("a", "b", "c"):
+        store.put(key, {"status": "claimed", "updated": 0.0})
+    assert store.get("a") is None
+    assert [key for key, _ in store.scan()] == ["b", "c"]
@@ -0,0 +1,86 @@
+"""Near-duplicate lookups of `match_faces`, in memory and on a stand-in table"""
+
+import random
+
+import pytest
+
+from tools.lambdas import load_function
+
+near_duplicates = load_function("match_faces", module="near_duplicates")
+
+
+class HashTable:
+    """The `BatchWriteItem` and `Query` calls of the hash store, in memory"""
+
+    def __init__(self):
+        self.partitions = {}
+        self.queries = 0
+
+    def batch_write_item(self, RequestItems):
+        for requests in RequestItems.values():
+            for request in requests:
+                item = request["PutRequest"]["Item"]
+                partition = self.partitions.setdefault(item["band"]["S"], {})
+                partition[item["hash"]["S"]] = item
+        return {}
+
+    def query(self, ExpressionAttributeValues, **kwargs):
+        self.queries += 1
+        partition = self.partitions.get(ExpressionAttributeValues[":band"]["S"], {})
+        return {"Items": list(partition.values())}
+
+
+def flip(value, n_bits, rng):
+    for bit in rng.sample(range(64), n_bits):
+        value ^= 1 << bit
+    return value
+
+
+def test_neighbours():
+    values = list(near_duplicates.neighbours(0b101, 4, 1))
+    assert values == [0b101, 0b100, 0b111, 0b001, 0b1101]
+
+
+@pytest.mark.parametrize(
+    "band_bits, n_bands, queries",
+    [
+        # 4 bands of 16 bits, looked up exactly
+        (None, 4, 4),
+        # 2 bands of 32 bits, each probed with its 32 values 1 bit away
+        (32, 2, 66),
+    ],
+)
+def test_table_finds_every_hash_within_the_distance(band_bits, n_bands, queries):
+    rng = random.Random(0)
+    table = HashTable()
+    store = near_duplicates.DynamoDBHashStore(
+        "hashes", max_distance=3, band_bits=band_bits, client=table
+    )
+    index = near_duplicates.HashIndex(store, max_distance=3, cache_size=0)
+    hashes = [rng.getrandbits(64) for _ in range(200)]
+    for n, value in enumerate(hashes):
+        index.add(value, {"ledger_key": f"images/{n}", "face_ids": [str(n)]})
+    # (the lookups must query the table, not the cache of the instance)
+    index.cache = near_duplicates.InMemoryHashStore(index.n_bands)
+    for n, value in enumerate(hashes):
+        distance = rng.randint(0, 3)
+        found = index.lookup(flip(value, distance, rng))
+        assert found == (distance, {"ledger_key": f"images/{n}", "face_ids": [str(n)]})
+    assert index.lookup(flip(hashes[0], 8, rng)) is None
+    assert store.n_bands == n_bands
+    assert table.queries == 201 * queries
+
+
+def test_cache_keeps_the_most_recently_used_hashes():
+    # (hashes with no band in common)
+    a, b, c = (0x1111 * k * 0x0001000100010001 for k in (1, 2, 3))
+    cache = near_duplicates.InMemoryHashStore(4, max_entries=2)
+    cache.add(a, {"face_ids": ["a"]})
+    cache.add(b, {"face_ids": ["b"]})
+    assert cache.candidates(a)
+    cache.add(c, {"face_ids": ["c"]})
+    assert len(cache) == 2
+    assert cache.candidates(a) == [(a, {"face_ids": ["a"]})]
+    assert cache.candidates(b) == []
+    assert cache.remove_faces({"a", "c"}) == 2
+    assert len(cache) == 0
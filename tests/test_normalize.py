@@ -0,0 +1,69 @@
+"""Downscaling of the large images by `match_faces`"""
+
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from tools.lambdas import load_function
+from tools.local_aws import LocalS3
+
+normalize = load_function("match_faces", module="normalize")
+
+BUCKET = "images"
+
+
+def jpeg(size):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (200, 120, 80)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class ConcurrentReads(LocalS3):
+    """S3 that remembers the most full GETs in progress at once"""
+
+    def __init__(self):
+        super().__init__()
+        self.reading = 0
+        self.max_reading = 0
+        self._reads = threading.Lock()
+
+    def get_object(self, **kwargs):
+        if "Range" in kwargs:
+            return super().get_object(**kwargs)
+        with self._reads:
+            self.reading += 1
+            self.max_reading = max(self.max_reading, self.reading)
+        try:
+            time.sleep(0.02)
+            return super().get_object(**kwargs)
+        finally:
+            with self._reads:
+                self.reading -= 1
+
+
+def test_small_images_are_passed_by_reference():
+    s3 = LocalS3()
+    s3.put_object(Bucket=BUCKET, Key="small.jpg", Body=jpeg((200, 100)))
+    normalizer = normalize.ImageNormalizer(s3.get_object, max_dimension=400)
+    image = normalizer.image(BUCKET, "small.jpg")
+    assert image == {"S3Object": {"Bucket": BUCKET, "Name": "small.jpg"}}
+
+
+def test_large_images_are_read_and_downscaled_by_the_pool():
+    s3 = ConcurrentReads()
+    # (larger than the header, so that the whole object is read again)
+    body = jpeg((3000, 2000)) + b"\0" * 1024
+    keys = [f"large_{i}.jpg" for i in range(8)]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+    normalizer = normalize.ImageNormalizer(
+        s3.get_object, max_dimension=400, workers=2, header_bytes=1024
+    )
+    with ThreadPoolExecutor(max_workers=len(keys)) as pool:
+        images = list(pool.map(lambda key: normalizer.image(BUCKET, key), keys))
+    assert s3.max_reading <= 2
+    with Image.open(io.BytesIO(images[0]["Bytes"])) as image:
+        assert image.size == (400, 267)
@@ -0,0 +1,134 @@
+"""Alerts of `notify_matches`: batched publishing, retries and failures"""
+
+import pytest
+
+from tools.lambdas import load_function
+from tools.local_aws import LocalS3, LocalSNS, LocalSSM
+
+from face_match.metrics import LocalSink  # isort: skip
+from face_match.reports import encode_report  # isort: skip
+
+THRESHOLD = "/stack/NotificationThreshold"
+
+
+class FlakySNS(LocalSNS):
+    """Topic that fails the entries of `failures`, a list of the `Failed`
+    entries (by message) of each call, e.g. `[{"alert": True}]` for a sender
+    fault of the message "alert" on the first call"""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = list(failures)
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries, **kwargs):
+        failing = self.failures.pop(0) if self.failures else {}
+        entries = [e for e in PublishBatchRequestEntries if e["Message"] in failing]
+        sent = [e for e in PublishBatchRequestEntries if e not in entries]
+        if sent:
+            response = super().publish_batch(TopicArn, sent, **kwargs)
+        else:
+            self._call("PublishBatch")
+            response = {"Successful": []}
+        response["Failed"] = [
+            {
+                "Id": e["Id"],
+                "Code": "InternalError",
+                "Message": "failed",
+                "SenderFault": failing[e["Message"]],
+            }
+            for e in entries
+        ]
+        return response
+
+
+def load(sns=None):
+    s3 = LocalS3()
+    fn = load_function(
+        "notify_matches",
+        env={
+            "BUCKET_OUT": "output",
+            "TOPIC_ARN": "topic",
+            "NOTIFICATION_THRESHOLD": THRESHOLD,
+            "LOG_LEVEL": "CRITICAL",
+        },
+        s3=s3,
+        ssm=LocalSSM({THRESHOLD: "90"}),
+        sns=sns or LocalSNS(),
+    )
+    fn.stage_metrics.sink = LocalSink()
+    return fn
+
+
+def upload(fn, image_id, matched):
+    """The S3 record of the report of an image that matched the customers"""
+    report = {
+        "Source": f"images/{image_id}",
+        "CustomerID": image_id.rsplit("_", 1)[0],
+        "Matches": [{"CustomerId": c, "Similarity": 99.0} for c in matched],
+    }
+    key = f"output/{image_id}.json"
+    fn.s3.put_object(Bucket="output", Key=key, Body=encode_report(report))
+    return LocalS3.event_record("output", key)
+
+
+def alert(image_id, matched):
+    customer_id = image_id.rsplit("_", 1)[0]
+    return (
+        f"{customer_id}, image images/{image_id}, "
+        f"matched {matched} 1 times with max similarity 99.000"
+    )
+
+
+def published(fn):
+    return sorted(m["Message"] for m in fn.sns.messages)
+
+
+def test_alerts_are_published_in_batches():
+    fn = load()
+    customers = [f"customer{n:02d}" for n in range(25)]
+    record = upload(fn, "alice_0001.jpg", customers)
+    response = fn.handler({"Records": [record]}, None)
+    assert response["status"] == "success"
+    assert published(fn) == sorted(alert("alice_0001.jpg", c) for c in customers)
+    # (10 + 10 + 5)
+    assert fn.sns.calls["PublishBatch"] == 3
+
+
+def test_service_failures_are_retried_once():
+    fn = load(FlakySNS([{alert("alice_0001.jpg", "bob"): False}]))
+    record = upload(fn, "alice_0001.jpg", ["bob", "carol"])
+    assert fn.handler({"Records": [record]}, None)["status"] == "success"
+    assert published(fn) == [alert("alice_0001.jpg", c) for c in ("bob", "carol")]
+    assert fn.sns.calls["PublishBatch"] == 2
+    assert fn.stage_metrics.sink.values["Retries"] == [1]
+
+
+def test_sender_faults_are_not_retried():
+    fn = load(FlakySNS([{alert("alice_0001.jpg", "bob"): True}]))
+    record = upload(fn, "alice_0001.jpg", ["bob", "carol"])
+    assert fn.handler({"Records": [record]}, None)["status"] == "success"
+    assert published(fn) == [alert("alice_0001.jpg", "carol")]
+    assert fn.sns.calls["PublishBatch"] == 1
+    assert fn.stage_metrics.sink.values["PublishFailures"] == [1]
+
+
+def test_alerts_still_failing_fail_the_invocation():
+    failing = {alert("alice_0001.jpg", "bob"): False}
+    fn = load(FlakySNS([failing, failing]))
+    record = upload(fn, "alice_0001.jpg", ["bob", "carol"])
+    with pytest.raises(fn.NotificationError, match="1 alerts not sent"):
+        fn.handler({"Records": [record]}, None)
+    assert published(fn) == [alert("alice_0001.jpg", "carol")]
+
+
+def test_unreadable_reports_fail_the_invocation():
+    fn = load()
+    records = [
+        upload(fn, "alice_0001.jpg", ["bob"]),
+        LocalS3.event_record("output", "output/missing_0001.json"),
+    ]
+    with pytest.raises(fn.NotificationError, match="1 reports not read"):
+        fn.handler({"Records": records}, None)
+    # (the alerts of the other reports are sent)
+    assert published(fn) == [alert("alice_0001.jpg", "bob")]
+    assert fn.stage_metrics.sink.values["FailedReports"] == [1]
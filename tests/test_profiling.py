@@ -0,0 +1,101 @@
+"""Profiles of the invocations, as written by the functions"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from face_match.profiling import Profiler, load_stats, parse_folded  # isort: skip
+
+# 2024-01-02T03:04:05Z
+NOW = 1704164645.0
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def writing_profiler(**kwargs):
+    """A profiler writing to a dict"""
+    written = {}
+    profiler = Profiler(written.__setitem__, "match_faces", clock=lambda: NOW, **kwargs)
+    return profiler, written
+
+
+def test_cprofile_adds_up_the_threads_of_the_invocation():
+    profiler, written = writing_profiler(mode="cprofile")
+    with profiler.profile("request-1"):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(busy, [0.05, 0.05]))
+    base = "profiling/match_faces/2024/01/02/030405-request-1"
+    assert sorted(written) == [f"{base}.json", f"{base}.prof"]
+    stats = load_stats([written[f"{base}.prof"]])
+    calls = {name: nc for (_, _, name), (_, nc, *_) in stats.stats.items()}
+    # (both calls ran in the threads of the pool)
+    assert calls["busy"] == 2
+    summary = json.loads(written[f"{base}.json"])
+    assert summary["mode"] == "cprofile" and summary["invocation"] == "request-1"
+    assert summary["top_functions"][0]["function"].endswith(":busy")
+
+
+def test_samples_skip_the_idle_threads():
+    profiler, written = writing_profiler(mode="sample", interval=0.001)
+    with profiler.profile("request-1"):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            # (the other worker waits for work)
+            pool.submit(busy, 0.2).result()
+    base = "profiling/match_faces/2024/01/02/030405-request-1"
+    stacks = parse_folded(written[f"{base}.folded"].decode("UTF-8"))
+    leaves = {stack.rpartition(";")[2] for stack in stacks}
+    assert "test_profiling.py:busy" in leaves
+    assert not any(leaf.startswith("threading.py") for leaf in leaves)
+    summary = json.loads(written[f"{base}.json"])
+    assert summary["top_functions"][0]["function"] == "test_profiling.py:busy"
+
+
+@pytest.mark.parametrize(
+    "mode, rate, requested, profiled",
+    [
+        ("", 1.0, None, ""),
+        ("cprofile", 0.0, None, ""),
+        ("cprofile", 1.0, None, "cprofile"),
+        # the caller's mode, whatever the configuration
+        ("", 1.0, "sample", "sample"),
+        ("cprofile", 0.0, "sample", "sample"),
+        ("", 1.0, "perf", ""),
+    ],
+)
+def test_invocations_profiled(mode, rate, requested, profiled):
+    profiler, _ = writing_profiler(mode=mode, rate=rate)
+    assert profiler.mode_for(requested) == profiled
+
+
+def test_unknown_modes_are_rejected():
+    with pytest.raises(ValueError):
+        Profiler(lambda key, body: None, "match_faces", mode="perf")
+
+
+def test_failed_writes_do_not_fail_the_invocation():
+    def put(key, body):
+        raise OSError("Access Denied")
+
+    with Profiler(put, "match_faces", mode="cprofile").profile("request-1"):
+        result = sum(range(10))
+    assert result == 45
+
+
+def test_messages_ask_for_a_profile(match_faces):
+    app = match_faces(LOG_LEVEL="CRITICAL")
+    app.upload("alice_0001.jpg")
+    event = {"Records": [app.message("alice_0001.jpg", Profile="sample")]}
+    app.fn.handler(event, SimpleNamespace(aws_request_id="request-1"))
+    keys = [
+        key.rpartition(".")[2]
+        for bucket, key in app.s3.objects
+        if bucket == "output" and key.startswith("profiling/match_faces/")
+    ]
+    assert sorted(keys) == ["folded", "json"]
@@ -0,0 +1,110 @@
+"""Token buckets of the Rekognition calls, stored in a stand-in table"""
+
+import pytest
+from botocore.exceptions import ClientError
+
+from tools.lambdas import load_function
+
+rate_limit = load_function("match_faces", module="rate_limit")
+
+KEY = "faces/SearchFaces"
+
+
+def conditional_check_failed():
+    return ClientError(
+        {"Error": {"Code": "ConditionalCheckFailedException", "Message": "failed"}},
+        "UpdateItem",
+    )
+
+
+class BucketTable:
+    """The two `UpdateItem` calls of the bucket store, in memory.
+
+    With `contention`, every update fails its condition, as if other instances
+    kept changing the bucket in between.
+    """
+
+    def __init__(self, contention=False):
+        self.contention = contention
+        self.items = {}
+        self.updates = 0
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        self.updates += 1
+        key = Key["bucket"]["S"]
+        tat = self.items.get(key)
+        now = float(ExpressionAttributeValues[":now"]["N"])
+        if self.contention:
+            raise conditional_check_failed()
+        if "if_not_exists" in UpdateExpression:
+            if tat is not None and tat < now:
+                raise conditional_check_failed()
+            cost = float(ExpressionAttributeValues[":cost"]["N"])
+            self.items[key] = (now if tat is None else tat) + cost
+            return {"Attributes": {"tat": {"N": repr(self.items[key])}}}
+        # (restart of an idle bucket)
+        if tat is None or tat >= now:
+            raise conditional_check_failed()
+        self.items[key] = float(ExpressionAttributeValues[":tat"]["N"])
+        return {}
+
+
+def test_burst_then_pacing():
+    table = BucketTable()
+    store = rate_limit.DynamoDBBucketStore("buckets", client=table)
+    delays = [store.reserve(KEY, 10, 10, 100.0) for _ in range(12)]
+    assert delays[:10] == [0.0] * 10
+    assert delays[10:] == pytest.approx([0.1, 0.2])
+
+
+def test_idle_buckets_restart_from_now():
+    table = BucketTable()
+    store = rate_limit.DynamoDBBucketStore("buckets", client=table)
+    for _ in range(20):
+        store.reserve(KEY, 10, 10, 100.0)
+    table.updates = 0
+    # (the debt was paid back long ago, and the burst is available again)
+    assert store.reserve(KEY, 10, 10, 200.0) == 0.0
+    # the update fails its condition, then the bucket is restarted
+    assert table.updates == 2
+    assert table.items[KEY] == pytest.approx(200.1)
+
+
+def test_leased_tokens_are_used_locally():
+    table = BucketTable()
+    store = rate_limit.DynamoDBBucketStore("buckets", client=table, block=5)
+    delays = [store.reserve(KEY, 10, 1, 100.0) for _ in range(6)]
+    assert delays == pytest.approx([0.0, 0.1, 0.2, 0.3, 0.4, 0.5])
+    # one round trip for every 5 tokens
+    assert table.updates == 2
+
+
+def test_leased_tokens_expire():
+    table = BucketTable()
+    store = rate_limit.DynamoDBBucketStore("buckets", client=table, block=5)
+    store.reserve(KEY, 10, 1, 100.0)
+    # (the 4 tokens leased are more than a second old)
+    assert store.reserve(KEY, 10, 1, 102.0) == 0.0
+    assert table.updates == 3
+
+
+def test_contention_falls_back_on_the_nominal_rate():
+    table = BucketTable(contention=True)
+    store = rate_limit.DynamoDBBucketStore("buckets", client=table, max_attempts=3)
+    assert store.reserve(KEY, 10, 10, 100.0) == pytest.approx(0.1)
+    # both updates of every attempt
+    assert table.updates == 6
+
+
+def test_limiter_sleeps_the_delay():
+    sleeps = []
+    limiter = rate_limit.RateLimiter(
+        rate_limit.InMemoryBucketStore(),
+        rates={"SearchFaces": 2, "IndexFaces": 0},
+        clock=lambda: 100.0,
+        sleep=sleeps.append,
+    )
+    for _ in range(4):
+        limiter.acquire("SearchFaces")
+    limiter.acquire("IndexFaces")
+    assert sleeps == pytest.approx([0.5, 1.0])
@@ -0,0 +1,40 @@
+"""Screening of images: a search of the collection, enrolled depending on policy"""
+
+import pytest
+
+SCREEN = {"Mode": {"stringValue": "screen", "dataType": "String"}}
+
+
+@pytest.fixture
+def screening(match_faces):
+    def screening(policy):
+        app = match_faces(
+            # (Alice and Bob look alike)
+            emulator_args={"alias_rate": 1.0, "alias_pool": 1},
+            SCREENING_ENROLL_POLICY=policy,
+        )
+        app.upload("alice_0001.jpg")
+        app.process("alice_0001.jpg")
+        app.upload("bob_0001.jpg")
+        return app
+
+    return screening
+
+
+def test_screen_only_reports_have_no_searched_face(screening):
+    app = screening("never")
+    report = app.fn.process_s3_record(app.record("bob_0001.jpg"), SCREEN).report
+    assert [m["CustomerId"] for m in report["Matches"]] == ["alice"]
+    assert "SearchedFaceId" not in report["Matches"][0]
+    [face] = report["Faces"]
+    assert "FaceId" not in face
+    assert face["Matches"][0]["FaceId"] == report["Matches"][0]["Face"]["FaceId"]
+    assert app.ledger_entry("bob_0001.jpg")["face_ids"] == []
+
+
+def test_enrolled_screens_report_their_face(screening):
+    app = screening("always")
+    report = app.fn.process_s3_record(app.record("bob_0001.jpg"), SCREEN).report
+    [face_id] = app.ledger_entry("bob_0001.jpg")["face_ids"]
+    assert report["Faces"][0]["FaceId"] == face_id
+    assert report["Matches"][0]["SearchedFaceId"] == face_id
@@ -0,0 +1,96 @@
+"""Search of the faces of an image in the other shards of the collection"""
+
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tools.rekognition_emulator import RekognitionEmulator
+
+BUCKET = "images"
+BOB = "bob_0001.jpg"
+
+
+class GroupPhotos(RekognitionEmulator):
+    """Emulator where the second face of the group photos is Bob's"""
+
+    group_photos = set()
+
+    def detect(self, image_key):
+        faces = super().detect(image_key)
+        if image_key in self.group_photos:
+            faces.append((self.identity("bob"), image_key))
+        return faces
+
+
+def jpeg(seed):
+    pixels = np.random.default_rng(seed).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).resize((400, 400), Image.BILINEAR).save(
+        buffer, format="JPEG"
+    )
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def group_photo(match_faces):
+    """A photo of Alice with Bob in the background, in another shard than Bob's
+    own photo"""
+    crops = {}
+    app = match_faces(
+        emulator=GroupPhotos,
+        # the emulator recognizes the crops around the faces
+        emulator_args={"identify_bytes": crops.get},
+        COLLECTION_SHARDS=2,
+        MAX_FACE_INDEX=5,
+    )
+    fn = app.fn
+    alice = next(
+        f"alice_{k:04d}.jpg"
+        for k in range(1, 100)
+        if fn.shard_of(f"alice_{k:04d}.jpg") != fn.shard_of(BOB)
+    )
+    image_key = f"{BUCKET}/{alice}"
+    app.reko.group_photos = {image_key}
+    body = app.upload(alice, jpeg(1))["Body"]
+    box = app.reko._describe_face(None, image_key, 1, None)["BoundingBox"]
+    crops[fn.crop_faces(body, [box])[0]] = (image_key, 1)
+    app.upload(BOB, jpeg(2))
+    return app, alice
+
+
+def test_every_face_is_searched_in_the_other_shards(group_photo):
+    app, alice = group_photo
+    app.process(BOB)
+    ingested = app.process(alice)
+    assert ingested is not None
+    report = ingested.report
+    assert [m["CustomerId"] for m in report["Matches"]] == ["bob"]
+    # the match is Bob's face, found by the crop around the second face
+    bystander = report["Faces"][1]
+    assert report["Matches"][0]["SearchedFaceId"] == bystander["FaceId"]
+    assert bystander["Matches"][0]["FaceId"] == report["Matches"][0]["Face"]["FaceId"]
+
+
+def test_retries_crop_the_faces_recorded_in_the_ledger(group_photo):
+    app, alice = group_photo
+    fn = app.fn
+    app.process(BOB)
+    etag = app.s3.objects[(BUCKET, alice)]["ETag"]
+    ledger_key = fn.ledger.key(BUCKET, alice, etag)
+    # a previous attempt indexed the faces, and failed before writing the report
+    fn.ledger.begin(ledger_key)
+    image = {"S3Object": {"Bucket": BUCKET, "Name": alice}}
+    fn.index_faces_in_image(BUCKET, alice, alice, fn.shard_of(alice), image, ledger_key)
+
+    ingested = app.process(alice)
+    assert [m["CustomerId"] for m in ingested.report["Matches"]] == ["bob"]
+
+
+def test_top_matches_of_users(match_faces):
+    fn = match_faces(
+        COLLECTION_SHARDS=2, SEARCH_MODE="users", MAX_FACE_MATCH=1, MAX_USER_MATCH=3
+    ).fn
+    matches = [{"Similarity": float(s)} for s in range(5)]
+    assert fn.top_matches(matches[:2], matches[2:]) == matches[:1:-1]
@@ -0,0 +1,25 @@
+"""Cross-match sweep of the faces of the collection"""
+
+import pytest
+
+from tools.lambdas import load_function
+from tools.sweep import EdgeList, Sweep, largest_faces
+
+ledger = load_function("match_faces", module="ledger")
+
+
+def test_largest_faces_are_the_s3_images_of_the_ledger():
+    store = ledger.InMemoryLedgerStore()
+    store.put("images/alice_0001.jpg#etag", {"status": "done", "face_ids": ["a", "b"]})
+    store.put("images/bob_0001.jpg#etag", {"status": "done", "face_ids": []})
+    # (a local file indexed by the backfill)
+    store.put("file:/photos/carol_0001.jpg#md5", {"status": "done", "face_ids": ["c"]})
+    assert largest_faces(store) == {
+        "a": {"S3Object": {"Bucket": "images", "Name": "alice_0001.jpg"}}
+    }
+
+
+def test_users_are_not_swept(match_faces, tmp_path):
+    fn = match_faces(SEARCH_MODE="users").fn
+    with pytest.raises(ValueError):
+        Sweep(fn, EdgeList(str(tmp_path / "edges.tsv")))
@@ -0,0 +1,66 @@
+"""Association of the indexed faces with the users of the customers"""
+
+import pytest
+
+from tools.rekognition_emulator import _raise
+
+
+@pytest.fixture
+def app(match_faces):
+    return match_faces(SEARCH_MODE="users", LOG_LEVEL="ERROR")
+
+
+def indexed_faces(app):
+    return sum(
+        len(app.reko.list_faces(CollectionId=shard)["Faces"]) for shard in app.fn.shards
+    )
+
+
+@pytest.mark.parametrize(
+    "failure",
+    [
+        # a customer ID that doesn't fit in a UserId
+        "customer_id",
+        # (the user is deleted again between the two associations)
+        "ResourceNotFoundException",
+        # (still throttled after the retries)
+        "ThrottlingException",
+    ],
+)
+def test_association_failures_keep_the_indexed_faces(app, failure, monkeypatch):
+    reko = app.reko
+    # (no waiting between the retries)
+    monkeypatch.setattr(app.fn.associate_faces_retry.retry, "sleep", lambda _: None)
+    customer_id = "alice"
+    if failure == "customer_id":
+        customer_id = "é" * 100
+    else:
+        error = getattr(reko.exceptions, failure)
+
+        def associate_faces(**kwargs):
+            _raise(error, "AssociateFaces", failure)
+
+        monkeypatch.setattr(reko, "associate_faces", associate_faces)
+
+    key = f"{customer_id}_0001.jpg"
+    app.upload(key)
+    app.process(key)
+    assert indexed_faces(app) == 1
+    assert app.metrics.values["UnassociatedFaces"] == [1]
+
+
+def test_failed_images_are_not_indexed_again(app, monkeypatch):
+    reko = app.reko
+    associate_faces = reko.associate_faces
+
+    def fail_once(**kwargs):
+        monkeypatch.setattr(reko, "associate_faces", associate_faces)
+        raise RuntimeError("lost connection")
+
+    monkeypatch.setattr(reko, "associate_faces", fail_once)
+    app.upload("alice_0001.jpg")
+    with pytest.raises(RuntimeError):
+        app.process("alice_0001.jpg")
+    app.process("alice_0001.jpg")
+    assert indexed_faces(app) == 1
+    assert reko.calls["IndexFaces"] == 1
@@ -0,0 +1,98 @@
+"""Long-running queue worker of `match_faces`, on a local queue"""
+
+import json
+import os
+import signal
+import threading
+import time
+from types import SimpleNamespace
+
+from tools.lambdas import load_function
+from tools.local_aws import LocalSQS
+
+from face_match.metrics import LocalSink, StageMetrics  # isort: skip
+
+worker = load_function("match_faces", module="worker")
+
+
+def function(process_message, max_workers=1):
+    """A stand-in for the `match_faces` module, processing the messages with
+    `process_message(record)`"""
+    return SimpleNamespace(
+        max_workers=max_workers,
+        batched_outputs=False,
+        process_message=process_message,
+        stage_metrics=StageMetrics(LocalSink()),
+    )
+
+
+def queue_with(sqs, *bodies):
+    url = sqs.create_queue(QueueName="images")["QueueUrl"]
+    for body in bodies:
+        sqs.send_message(QueueUrl=url, MessageBody=json.dumps(body))
+    return url
+
+
+def visible(sqs, url):
+    attributes = sqs.get_queue_attributes(QueueUrl=url)["Attributes"]
+    return int(attributes["ApproximateNumberOfMessages"])
+
+
+def test_slow_messages_are_kept_invisible():
+    sqs = LocalSQS()
+    url = queue_with(sqs, {"image": 1})
+    processed = []
+
+    def slow(record):
+        # (longer than the visibility timeout)
+        time.sleep(1.5)
+        processed.append(record["messageId"])
+        return []
+
+    fn = function(slow, max_workers=2)
+    qw = worker.QueueWorker(fn, sqs, url, visibility_timeout=1, wait_time=0.2)
+    # (redeliveries would keep the worker busy)
+    deadline = threading.Timer(10, qw.stop)
+    deadline.start()
+    qw.run(idle_timeout=0.5)
+    deadline.cancel()
+    assert len(processed) == 1
+    assert qw.processed == 1 and qw.failed == 0
+    assert sum(fn.stage_metrics.sink.values["VisibilityExtensions"]) >= 1
+    assert sqs.queues[url] == {}
+
+
+def test_sigterm_returns_the_messages_not_started():
+    sqs = LocalSQS()
+    url = queue_with(sqs, {"image": 1}, {"image": 2}, {"image": 3})
+    started, release = threading.Event(), threading.Event()
+
+    def blocking(record):
+        started.set()
+        release.wait(10)
+        return []
+
+    # (2 messages in flight: one in progress, one waiting for the worker)
+    qw = worker.QueueWorker(function(blocking), sqs, url, visibility_timeout=60)
+
+    def terminate():
+        started.wait(10)
+        while len(qw._in_flight) < 2:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+        # (the message in progress finishes after the signal)
+        time.sleep(0.3)
+        release.set()
+
+    previous = signal.signal(signal.SIGTERM, qw.stop)
+    try:
+        thread = threading.Thread(target=terminate)
+        thread.start()
+        qw.run()
+        thread.join()
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    assert qw.processed == 1
+    # the message not started is visible again at once, despite its timeout
+    assert visible(sqs, url) == 2
+    assert len(sqs.queues[url]) == 2
@@ -0,0 +1,6 @@
+"""Local tooling for the face matching pipeline.
+
+The modules in this package run the lambda functions and the surrounding AWS
+services offline, so that the pipeline can be exercised (and measured) without
+an AWS account.
+"""
@@ -0,0 +1,414 @@
+"""Bulk backfill of an existing corpus of images into the collection.
+
+Uploading a corpus to the images bucket sends one event per object through SQS to
+a function with a few concurrent executions. The backfill instead lists the
+images, an S3 prefix or a local directory laid out like `data/lfw`
+(`<person>/<person>_NNNN.jpg`), and processes them with the code of the
+`match_faces` function, in a bounded pool of workers: the S3 images exactly as
+the function processes their upload events, with its ingestion ledger,
+near-duplicate index and identity graph (`--ledger-table`, `--image-hash-table`,
+`--identity-graph-table`). The reports are written in newline-delimited batches
+to the output bucket, where they are read like the ones of the function (and
+trigger the notifications).
+
+Images are paced by the same token buckets as the function when
+`--rate-limit-table` is given, so that a backfill and the live pipeline share the
+Rekognition TPS quotas.
+
+The keys of the images whose report was written are appended to a checkpoint
+file: a backfill started again with the same checkpoint skips them. The images
+indexed since the last batch of reports are in the ledger, and are only searched
+again: without a ledger table, the ledger is kept in a journal file next to the
+checkpoint (`<checkpoint>.ledger`).
+
+Usage:
+    python -m tools.backfill s3://my-images-bucket/images/ \
+        --collection TestCollection --bucket-out my-output-bucket \
+        --checkpoint backfill.ckpt --workers 16
+    python -m tools.backfill data/lfw --collection TestCollection \
+        --bucket-out my-output-bucket --checkpoint lfw.ckpt
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from tools.lambdas import load_function
+
+logger = logging.getLogger(__name__)
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+
+# An image to backfill: the key recorded in the checkpoint, the source and name
+# written in the report, and where to read it from (an S3 object, with its ETag,
+# or a file)
+Image = namedtuple(
+    "Image", ["key", "source", "image_id", "bucket", "path", "etag"], defaults=[None]
+)
+
+
+def list_s3(s3, bucket, prefix=""):
+    """The images under an S3 prefix, in key order"""
+    token = None
+    while True:
+        kwargs = {"Bucket": bucket, "Prefix": prefix}
+        if token:
+            kwargs["ContinuationToken"] = token
+        response = s3.list_objects_v2(**kwargs)
+        for obj in response.get("Contents", []):
+            key = obj["Key"]
+            if key.lower().endswith(IMAGE_SUFFIXES):
+                yield Image(
+                    f"s3://{bucket}/{key}",
+                    f"{bucket}/{key}",
+                    key.split("/")[-1],
+                    bucket,
+                    key,
+                    obj.get("ETag"),
+                )
+        if not response.get("IsTruncated"):
+            return
+        token = response["NextContinuationToken"]
+
+
+def list_local(root):
+    """The images under a local directory, in path order"""
+    root = Path(root)
+    for path in sorted(root.rglob("*")):
+        if path.suffix.lower() in IMAGE_SUFFIXES and path.is_file():
+            yield Image(str(path), str(path), path.name, None, str(path))
+
+
+def event_record(image):
+    """The S3 notification record of the upload of an S3 image"""
+    s3_object = {"key": urllib.parse.quote_plus(image.path)}
+    if image.etag:
+        s3_object["eTag"] = image.etag.strip('"')
+    return {"s3": {"bucket": {"name": image.bucket}, "object": s3_object}}
+
+
+class Checkpoint:
+    """Append-only file of the keys of the images already backfilled"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.done.update(line.rstrip("\n") for line in f if line.strip())
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def record(self, keys):
+        self.done.update(keys)
+        if self.path and keys:
+            with open(self.path, "a") as f:
+                f.writelines(f"{key}\n" for key in keys)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class LedgerJournal:
+    """Ledger store of the entries in memory, journaled to a file.
+
+    Every write is appended to the file before returning, and the file is read
+    back when the backfill starts again, so that the images indexed before it
+    stopped are not indexed again. The claims are not read back: they belonged
+    to the backfill that stopped.
+
+    Args:
+        store: in-memory ledger store, without a limit of entries.
+        path: journal file.
+    """
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        item = record.get("item")
+                        if item is None or item["status"] == "claimed":
+                            store.delete(record["key"])
+                        else:
+                            store.put(record["key"], item)
+
+    def _append(self, record):
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def put(self, key, item, **conditions):
+        self.store.put(key, item, **conditions)
+        self._append({"key": key, "item": item})
+
+    def delete(self, key, **conditions):
+        self.store.delete(key, **conditions)
+        self._append({"key": key})
+
+    def scan(self):
+        return self.store.scan()
+
+
+class Progress:
+    """Counters of the backfill, logged every `interval` seconds"""
+
+    def __init__(self, interval=10.0, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.counts = {"images": 0, "reports": 0, "failed": 0, "skipped": 0}
+        self._last_images = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counts[name] += count
+
+    def maybe_log(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last < self.interval:
+            return
+        with self._lock:
+            recent = (self.counts["images"] - self._last_images) / max(
+                now - self.last, 1e-9
+            )
+            self._last_images = self.counts["images"]
+            self.last = now
+            counts = dict(self.counts)
+        overall = counts["images"] / max(now - self.start, 1e-9)
+        print(
+            f"[{now - self.start:8.1f}s] {counts['images']} images "
+            f"({recent:.1f}/s now, {overall:.1f}/s overall), "
+            f"{counts['reports']} reports, {counts['failed']} failed, "
+            f"{counts['skipped']} skipped",
+            file=self.stream,
+            flush=True,
+        )
+
+
+class Backfill:
+    """Index and search images with the `match_faces` code, in bulk.
+
+    Args:
+        fn: the `match_faces` module, as loaded by `tools.lambdas.load_function`,
+            in "batch" output mode (`OUTPUT_MODE`).
+        checkpoint: `Checkpoint` of the images already done.
+        workers: images processed concurrently.
+        flush_size: reports written per output object.
+    """
+
+    def __init__(
+        self,
+        fn,
+        checkpoint=None,
+        workers=16,
+        flush_size=500,
+        progress=None,
+    ):
+        self.fn = fn
+        self.checkpoint = checkpoint or Checkpoint()
+        self.workers = workers
+        self.flush_size = flush_size
+        self.progress = progress or Progress()
+        self.run_id = uuid.uuid4().hex[:8]
+        self._batches = 0
+        self._reports = []
+        self._keys = []
+
+    def process(self, image):
+        """Process the image like the function, returns its `Ingested` result
+        (None if there is nothing to report, or if it was already done)"""
+        if image.bucket is not None:
+            return self.fn.process_s3_record(event_record(image))
+        return self.process_file(image)
+
+    def process_file(self, image):
+        """Index the faces of a local image and search them, with the ledger of
+        the function, keyed by the path and the MD5 of the file"""
+        fn = self.fn
+        with open(image.path, "rb") as f:
+            body = f.read()
+        rekognition_image = {"Bytes": body}
+        ledger_key = fn.ledger.key("file:", image.path, hashlib.md5(body).hexdigest())
+        entry = fn.ledger.begin(ledger_key)
+        if entry is not None and entry["status"] == "done":
+            return None
+        home = fn.shard_of(image.image_id)
+        try:
+            if entry is None:
+                face_ids, boxes = fn.index_faces_in_image(
+                    None,
+                    image.path,
+                    image.image_id,
+                    home,
+                    rekognition_image,
+                    ledger_key,
+                )
+            else:
+                face_ids, boxes = entry["face_ids"], entry.get("boxes")
+            face_matches = fn.search_faces_in_image(
+                face_ids, home, rekognition_image, boxes, body
+            )
+        except Exception:
+            if entry is None:
+                fn.ledger.release(ledger_key)
+            raise
+        if not face_matches:
+            fn.ledger.done(ledger_key, face_ids)
+            return None
+        report = fn.build_report(
+            image.source, image.image_id.rsplit("_", 1)[0], face_matches
+        )
+        fn.link_customers(report)
+        return fn.Ingested(ledger_key, face_ids, report)
+
+    def flush(self):
+        """Write the pending reports (and mark their images done in the ledger),
+        then checkpoint their images"""
+        if self._reports:
+            self._batches += 1
+            self.fn.write_outputs(
+                f"backfill-{self.run_id}-{self._batches:06d}", self._reports
+            )
+        self.checkpoint.record(self._keys)
+        self._reports, self._keys = [], []
+
+    def _collect(self, image, future):
+        try:
+            ingested = future.result()
+        except Exception:
+            logger.exception(f"Failed to backfill {image.key}")
+            self.progress.add("failed")
+            return
+        self.progress.add("images")
+        self._keys.append(image.key)
+        if ingested is not None:
+            self._reports.append(ingested)
+            self.progress.add("reports")
+        # (images without report are checkpointed in larger groups)
+        if (
+            len(self._reports) >= self.flush_size
+            or len(self._keys) >= 10 * self.flush_size
+        ):
+            self.flush()
+
+    def run(self, images):
+        """Backfill the images not in the checkpoint, returns the counters"""
+        # at most 2 images per worker are read ahead, so that listing a large
+        # prefix doesn't queue all of it in memory
+        max_pending = 2 * self.workers
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for image in images:
+                if image.key in self.checkpoint:
+                    self.progress.add("skipped")
+                    continue
+                pending[pool.submit(self.process, image)] = image
+                while len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._collect(pending.pop(future), future)
+                    self.progress.maybe_log()
+            for future in list(pending):
+                self._collect(pending.pop(future), future)
+                self.progress.maybe_log()
+        self.flush()
+        self.progress.maybe_log(force=True)
+        return dict(self.progress.counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="s3://bucket/prefix or a local directory")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--bucket-out", required=True)
+    parser.add_argument("--prefix-out", default="output")
+    parser.add_argument("--checkpoint", help="file of the images already done")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--flush-size", type=int, default=500)
+    parser.add_argument("--max-faces", type=int, default=5)
+    parser.add_argument("--index-tps", type=float, default=50)
+    parser.add_argument("--search-tps", type=float, default=50)
+    parser.add_argument(
+        "--rate-limit-table",
+        help="DynamoDB table of the token buckets shared with the function",
+    )
+    parser.add_argument("--ledger-table", help="ingestion ledger of the function")
+    parser.add_argument(
+        "--image-hash-table",
+        help="near-duplicate index of the function, to reuse the faces of copies",
+    )
+    parser.add_argument("--near-duplicate-distance", type=int, default=3)
+    parser.add_argument("--identity-graph-table", help="identity graph of the function")
+    parser.add_argument("--no-compress", action="store_true")
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    fn = load_function(
+        "match_faces",
+        env={
+            "COLLECTION_NAME": args.collection,
+            "BUCKET_OUT": args.bucket_out,
+            "PREFIX_OUT": args.prefix_out,
+            "MAX_FACE_INDEX": args.max_faces,
+            "MAX_FACE_SEARCH_WORKERS": args.max_faces,
+            "INDEX_FACES_TPS": args.index_tps,
+            "SEARCH_FACES_TPS": args.search_tps,
+            "RATE_LIMIT_TABLE": args.rate_limit_table or "",
+            "LEDGER_TABLE": args.ledger_table or "",
+            "NEAR_DUPLICATE_DISTANCE": (
+                args.near_duplicate_distance if args.image_hash_table else ""
+            ),
+            "IMAGE_HASH_TABLE": args.image_hash_table or "",
+            "IDENTITY_GRAPH_TABLE": args.identity_graph_table or "",
+            # the reports are written by `Backfill.flush`
+            "OUTPUT_MODE": "batch",
+            "OUTPUT_COMPRESSION": "" if args.no_compress else "gzip",
+            "LOG_LEVEL": "WARNING",
+        },
+    )
+    if not args.ledger_table and args.checkpoint:
+        fn.ledger.store = LedgerJournal(
+            fn.InMemoryLedgerStore(max_entries=0), f"{args.checkpoint}.ledger"
+        )
+    if args.source.startswith("s3://"):
+        bucket, _, prefix = args.source[len("s3://") :].partition("/")
+        images = list_s3(fn.s3, bucket, prefix)
+    else:
+        images = list_local(args.source)
+
+    backfill = Backfill(
+        fn,
+        Checkpoint(args.checkpoint),
+        workers=args.workers,
+        flush_size=args.flush_size,
+        progress=Progress(args.progress_interval),
+    )
+    counts = backfill.run(images)
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
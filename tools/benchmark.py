@@ -0,0 +1,842 @@
+"""End-to-end throughput benchmark of the face matching pipeline.
+
+The benchmark replays the upload of a sample of the LFW dataset (as listed in
+`demo/data_tree.txt`, keeping the skew of many images for some people) through the
+`match_faces` and `notify_matches` handlers, with local stand-ins for S3, SNS, SSM
+and Rekognition. The Rekognition collection is pre-populated with synthetic
+background faces to measure the effect of the collection size.
+
+Usage:
+    python -m tools.benchmark --images 200 --batch-sizes 1 5 10 \
+        --collection-sizes 0 10000 100000 --output bench.json
+
+With `--search-mode users`, the faces of every customer are associated with a
+Rekognition user and the matches are searched by user (distinct customers).
+
+With `--worker`, the messages go through a local queue processed by the
+long-running worker (`match_faces/worker.py`) instead of the lambda handler.
+
+With `--large-rate 0.2`, a fraction of the images are uploaded as large phone
+photos (16 MP, with an EXIF orientation, half of them over the 15 MB limit of
+Rekognition), whose processing time grows with their size; `--normalize 1920`
+downscales the images larger than 1920 pixels in the function first.
+
+With `--profile cprofile` (or `sample`), every invocation of both functions is
+profiled as in production (`face_match.profiling`), and the profiles of each run
+are added up in `--profile-dir`: `<run>-<function>.prof` (pstats) or
+`.folded` (flame graph), and `.json` (peak memory, top functions), to compare
+before and after a change. Profiling slows the functions down: the throughput of
+a profiled run is not comparable with an unprofiled one.
+
+The service times of the stand-ins are the typical round trips of the real
+services multiplied by `--latency-scale`, so that concurrency in the handlers is
+measured rather than the speed of the emulator.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+import numpy as np
+
+from tools.lambdas import ROOT, load_function
+from tools.local_aws import LocalS3, LocalSNS, LocalSQS, LocalSSM
+from tools.rekognition_emulator import RekognitionEmulator, customer_of
+
+# (importable once tools.lambdas has added the common layer to the path)
+from face_match.metrics import LocalSink  # isort: skip
+from face_match.profiling import (  # isort: skip
+    folded,
+    load_stats,
+    parse_folded,
+    top_functions,
+)
+from face_match.reports import decode_reports  # isort: skip
+
+DATA_TREE = ROOT / "demo" / "data_tree.txt"
+COLLECTION_ID = "BenchmarkCollection"
+BUCKET_IMAGES = "bucket-images"
+BUCKET_OUT = "bucket-out"
+TOPIC_ARN = "arn:aws:sns:local:000000000000:FaceMatchTopic"
+THRESHOLD_PARAM = "/RekognitionBatchDetect/NotificationThreshold"
+
+# typical round trips of the services, in seconds
+SERVICE_TIMES = {
+    "IndexFaces": 0.3,
+    "SearchFaces": 0.15,
+    "SearchFacesByImage": 0.3,
+    "SearchUsers": 0.15,
+    "SearchUsersByImage": 0.3,
+    "AssociateFaces": 0.1,
+    "CreateUser": 0.05,
+    "PutObject": 0.03,
+    "GetObject": 0.02,
+    "Publish": 0.02,
+    "GetParameters": 0.01,
+}
+# additional processing time of an image, in seconds per MB (an estimate)
+SERVICE_TIMES_PER_MB = {
+    "IndexFaces": 0.1,
+    "SearchFacesByImage": 0.1,
+    "SearchUsersByImage": 0.1,
+}
+# size of the large phone photos
+PHOTO_SIZE = (4624, 3472)
+# default TPS quota of IndexFaces and SearchFaces
+TPS_QUOTA = 50
+
+
+def read_corpus(path=DATA_TREE):
+    """List the (person, image name) pairs in the `tree` output of the dataset"""
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            name = line.rstrip().rsplit(" ", 1)[-1]
+            if name.endswith(".jpg"):
+                corpus.append((name.rsplit("_", 1)[0], name))
+    return corpus
+
+
+def sample_images(corpus, n_images, seed=0):
+    """Sample whole people until there are `n_images` images, in upload order.
+
+    Taking all the images of the sampled people keeps the distribution of images
+    per person of the dataset, and hence the share of same-customer matches.
+    """
+    rng = random.Random(seed)
+    by_person = {}
+    for person, name in corpus:
+        by_person.setdefault(person, []).append(name)
+    people = sorted(by_person)
+    rng.shuffle(people)
+    images = []
+    for person in people:
+        if len(images) >= n_images:
+            break
+        images.extend((person, name) for name in by_person[person])
+    images = images[:n_images]
+    rng.shuffle(images)
+    return images
+
+
+def background_names(corpus, n_faces, seed=0):
+    """Names of synthetic images, with the same images-per-person skew as the corpus"""
+    rng = np.random.default_rng(seed)
+    counts = np.array(list(Counter(person for person, _ in corpus).values()))
+    names, i = [], 0
+    while len(names) < n_faces:
+        for k in range(int(rng.choice(counts))):
+            names.append(f"Background_{i}_{k + 1:04d}.jpg")
+        i += 1
+    return names[:n_faces]
+
+
+def with_duplicates(images, duplicate_rate, seed=0):
+    """Append re-uploads of a `duplicate_rate` fraction of the images.
+
+    Half of the copies are uploaded by the same person, the others by someone
+    else. Returns the images, and the name of the original of every copy.
+    """
+    rng = random.Random(seed)
+    people = sorted({person for person, _ in images})
+    images, originals = list(images), {}
+    for k, (person, name) in enumerate(list(images)):
+        if rng.random() < duplicate_rate:
+            owner = person if rng.random() < 0.5 else rng.choice(people)
+            copy = f"{owner}_{9001 + k:04d}.jpg"
+            images.append((owner, copy))
+            originals[copy] = name
+    return images, originals
+
+
+def synthetic_image(name, size=250, quality=90):
+    """JPEG of a smooth random picture, the same for the same name"""
+    from PIL import Image
+
+    rng = np.random.default_rng(int(hashlib.md5(name.encode()).hexdigest()[:8], 16))
+    pixels = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels).resize((size, size), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def photo_image(name, noise):
+    """JPEG of a large phone photo of the picture of `synthetic_image`, stored
+    sideways with an EXIF orientation (as phones do). Its size grows with the
+    `noise` (sensor noise, which doesn't compress)"""
+    from PIL import Image
+
+    seed = int(hashlib.md5(name.encode()).hexdigest()[:8], 16)
+    picture = Image.open(io.BytesIO(synthetic_image(name))).resize(
+        PHOTO_SIZE, Image.BILINEAR
+    )
+    rng = np.random.default_rng(seed)
+    pixels = np.asarray(picture, dtype=np.int16) + rng.normal(
+        0, noise, (PHOTO_SIZE[1], PHOTO_SIZE[0], 3)
+    ).astype(np.int16)
+    # (the orientation 6 is displayed rotated by 90 degrees clockwise)
+    photo = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).transpose(
+        Image.ROTATE_90
+    )
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buffer = io.BytesIO()
+    photo.save(buffer, format="JPEG", quality=95, exif=exif)
+    return buffer.getvalue()
+
+
+def sqs_batches(
+    images,
+    batch_size,
+    bucket=BUCKET_IMAGES,
+    redelivery_rate=0.0,
+    screening_rate=0.0,
+    seed=0,
+):
+    """SQS events as delivered to the lambda, one S3 notification per message.
+
+    A `redelivery_rate` fraction of the messages is delivered a second time, later
+    in the stream, as SQS at-least-once delivery does. A `screening_rate` fraction
+    of the images is screened (searched without being indexed).
+    """
+    keys = [f"images/{person}/{name}" for person, name in images]
+    rng = random.Random(seed)
+    redelivered = [k for k in keys if rng.random() < redelivery_rate]
+    screened = {k for k in keys if rng.random() < screening_rate}
+    messages = [
+        {
+            "messageId": str(uuid.uuid4()),
+            "receiptHandle": str(uuid.uuid4()),
+            "body": json.dumps(
+                {
+                    "Records": [
+                        LocalS3.event_record(
+                            bucket, key, etag=hashlib.md5(key.encode()).hexdigest()
+                        )
+                    ]
+                }
+            ),
+            "attributes": {"ApproximateReceiveCount": "1"},
+            "messageAttributes": (
+                {"Mode": {"stringValue": "screen", "dataType": "String"}}
+                if key in screened
+                else {}
+            ),
+            "eventSource": "aws:sqs",
+        }
+        for key in keys + redelivered
+    ]
+    return [
+        {"Records": messages[i : i + batch_size]}
+        for i in range(0, len(messages), batch_size)
+    ]
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def _timed(latencies, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+class Pipeline:
+    """The two lambda functions wired to a fresh set of local services"""
+
+    def __init__(
+        self,
+        collection_size,
+        corpus,
+        latency_scale=0.1,
+        alias_rate=0.05,
+        alias_pool=10,
+        extra_face_rate=0.0,
+        output_mode="object",
+        match_store=False,
+        near_duplicates=False,
+        collection_shards=1,
+        max_workers=10,
+        search_mode="faces",
+        profile_mode="",
+        normalize_max_dimension=0,
+    ):
+        scaled = {k: v * latency_scale for k, v in SERVICE_TIMES.items()}
+        self.s3 = LocalS3(latency=scaled)
+        # the images uploaded, by perceptual hash, to recognize their copies
+        self.image_hashes = {}
+        # the crops of the sharded searches around the other faces of the images,
+        # by perceptual hash, to recognize the faces they are crops of
+        self.crop_hashes = {}
+        self.reko = RekognitionEmulator(
+            alias_rate=alias_rate,
+            alias_pool=alias_pool,
+            extra_face_rate=extra_face_rate,
+            latency=scaled,
+            latency_per_mb={
+                k: v * latency_scale for k, v in SERVICE_TIMES_PER_MB.items()
+            },
+            s3=self.s3,
+            identify_bytes=self.identify,
+        )
+        self.sns = LocalSNS(latency=scaled)
+        self.ssm = LocalSSM({THRESHOLD_PARAM: "90"}, latency=scaled)
+
+        self.match_faces = load_function(
+            "match_faces",
+            env={
+                "COLLECTION_NAME": COLLECTION_ID,
+                "COLLECTION_SHARDS": collection_shards,
+                "BUCKET_OUT": BUCKET_OUT,
+                "PREFIX_OUT": "output",
+                "MAX_WORKERS": max_workers,
+                "MAX_FACE_INDEX": 5,
+                "MAX_FACE_SEARCH_WORKERS": 5,
+                # the clock of the stand-ins runs 1 / latency_scale times faster
+                "INDEX_FACES_TPS": TPS_QUOTA / latency_scale if latency_scale else 0,
+                "SEARCH_FACES_TPS": TPS_QUOTA / latency_scale if latency_scale else 0,
+                "SEARCH_FACES_BY_IMAGE_TPS": (
+                    TPS_QUOTA / latency_scale if latency_scale else 0
+                ),
+                "SEARCH_USERS_TPS": TPS_QUOTA / latency_scale if latency_scale else 0,
+                "SEARCH_USERS_BY_IMAGE_TPS": (
+                    TPS_QUOTA / latency_scale if latency_scale else 0
+                ),
+                "ASSOCIATE_FACES_TPS": (
+                    TPS_QUOTA / latency_scale if latency_scale else 0
+                ),
+                "SEARCH_MODE": search_mode,
+                "PROFILING_MODE": profile_mode,
+                "PROFILING_RATE": 1,
+                "OUTPUT_MODE": output_mode,
+                "OUTPUT_COMPRESSION": "gzip" if output_mode == "batch" else "",
+                "MATCH_STORE_PREFIX": "matches" if match_store else "",
+                "NEAR_DUPLICATE_DISTANCE": 3 if near_duplicates else "",
+                "NORMALIZE_MAX_DIMENSION": normalize_max_dimension or "",
+                "LOG_LEVEL": "WARNING",
+            },
+            reko=self.reko,
+            s3=self.s3,
+        )
+
+        # the background faces are spread across the shards like the function does
+        by_shard = {shard: [] for shard in self.match_faces.shards}
+        for name in background_names(corpus, collection_size):
+            by_shard[self.match_faces.shard_of(name)].append(name)
+        for shard, names in by_shard.items():
+            self.reko.create_collection(CollectionId=shard)
+            if names:
+                self.reko.bulk_index_faces(CollectionId=shard, ExternalImageIds=names)
+            if search_mode == "users":
+                self.reko.bulk_associate_faces(
+                    CollectionId=shard,
+                    user_id=lambda name: self.match_faces.user_id_of(customer_of(name)),
+                )
+        # don't count the set-up
+        self.reko.calls.clear()
+
+        self.notify_matches = load_function(
+            "notify_matches",
+            env={
+                "BUCKET_OUT": BUCKET_OUT,
+                "PREFIX_OUT": "output",
+                "NOTIFICATION_THRESHOLD": THRESHOLD_PARAM,
+                "TOPIC_ARN": TOPIC_ARN,
+                "PROFILING_MODE": profile_mode,
+                "PROFILING_RATE": 1,
+                "LOG_LEVEL": "WARNING",
+            },
+            s3=self.s3,
+            ssm=self.ssm,
+            sns=self.sns,
+        )
+        # the stage metrics of both functions are collected in memory
+        self.metrics = LocalSink()
+        self.match_faces.stage_metrics.sink = self.metrics
+        self.notify_matches.stage_metrics.sink = self.metrics
+        self.notifications = []
+        self.s3.subscribe(self.notifications.append, prefix="output/")
+        # the profiles are kept aside, not to count their writes in the results
+        self.profiles = {}
+        for fn in (self.match_faces, self.notify_matches):
+            fn.profiler.put = self.profiles.__setitem__
+
+    def upload(self, images, originals, photos=None):
+        """Put the images in the bucket, the copies re-encoded from their original,
+        and the `photos` (name -> noise) as large phone photos"""
+        photos = photos or {}
+        for person, name in images:
+            if name in photos:
+                body = photo_image(name, photos[name])
+            elif name in originals:
+                body = synthetic_image(originals[name], quality=70)
+            else:
+                body = synthetic_image(name)
+            key = f"images/{person}/{name}"
+            image_key = f"{BUCKET_IMAGES}/{key}"
+            self.image_hashes[self.match_faces.dhash(body)] = image_key
+            if len(self.match_faces.shards) > 1:
+                for i in range(1, len(self.reko.detect(image_key))):
+                    box = self.reko._describe_face(None, image_key, i, None)
+                    crop = self.match_faces.crop_faces(body, [box["BoundingBox"]])[0]
+                    self.crop_hashes[self.match_faces.dhash(crop)] = (image_key, i)
+            self.s3.objects[(BUCKET_IMAGES, key)] = {
+                "Body": body,
+                "ETag": f'"{hashlib.md5(body).hexdigest()}"',
+                "LastModified": time.time(),
+                "Metadata": {},
+            }
+
+    def identify(self, body):
+        """The image uploaded that `body` is a copy of (or the image and face it is
+        a crop around), by perceptual hash"""
+        try:
+            image_hash = self.match_faces.dhash(body)
+        except OSError:
+            return None
+        if image_hash in self.crop_hashes:
+            return self.crop_hashes[image_hash]
+        if image_hash in self.image_hashes:
+            return self.image_hashes[image_hash]
+        distance, key = min(
+            (
+                (bin(image_hash ^ h).count("1"), key)
+                for h, key in self.image_hashes.items()
+            ),
+            default=(None, None),
+        )
+        return key if distance is not None and distance <= 8 else None
+
+    def reports(self):
+        """The reports written by the function"""
+        return [
+            report
+            for (bucket, key), obj in list(self.s3.objects.items())
+            if bucket == BUCKET_OUT and key.startswith("output/")
+            for report in decode_reports(obj["Body"], key)
+        ]
+
+    def api_calls(self):
+        return sum(
+            sum(service.calls.values())
+            for service in (self.reko, self.s3, self.sns, self.ssm)
+        )
+
+
+def write_profiles(pipeline, directory, run_name):
+    """Add up the profiles of the invocations of each function into files of
+    `directory`, returns their summary"""
+    os.makedirs(directory, exist_ok=True)
+    summaries = {}
+    for fn in (pipeline.match_faces, pipeline.notify_matches):
+        name = fn.profiler.function
+        objects = {
+            key: body
+            for key, body in pipeline.profiles.items()
+            if key.split("/")[1] == name
+        }
+        invocations = [
+            json.loads(body) for key, body in objects.items() if key.endswith(".json")
+        ]
+        if not invocations:
+            continue
+        path = os.path.join(directory, f"{run_name}-{name}")
+        profiles = [body for key, body in objects.items() if key.endswith(".prof")]
+        if profiles:
+            stats = load_stats(profiles)
+            stats.dump_stats(f"{path}.prof")
+            top = top_functions(stats)
+        else:
+            stacks = Counter()
+            for key, body in objects.items():
+                if key.endswith(".folded"):
+                    stacks.update(parse_folded(body.decode("UTF-8")))
+            with open(f"{path}.folded", "w") as f:
+                f.write(folded(stacks))
+            top = top_functions(stacks)
+        summaries[name] = {
+            "invocations": len(invocations),
+            "seconds": sum(i["seconds"] for i in invocations),
+            "peak_memory_bytes": max(i["peak_memory_bytes"] for i in invocations),
+            "top_functions": top,
+        }
+        with open(f"{path}.json", "w") as f:
+            json.dump(summaries[name], f, indent=1)
+    return summaries
+
+
+def run_worker(pipeline, batches):
+    """Process the messages with the worker, through a local queue.
+
+    Returns the number of messages that failed, once all were processed.
+    """
+    sqs = LocalSQS()
+    queue_url = sqs.create_queue(QueueName="FaceMatchQueue")["QueueUrl"]
+    messages = [record for event in batches for record in event["Records"]]
+    for record in messages:
+        sqs.send_message(
+            QueueUrl=queue_url,
+            MessageBody=record["body"],
+            # (the API uses PascalCase keys, e.g. "StringValue")
+            MessageAttributes={
+                name: {k[0].upper() + k[1:]: v for k, v in attribute.items()}
+                for name, attribute in record["messageAttributes"].items()
+            },
+        )
+    worker_module = load_function("match_faces", module="worker")
+    worker = worker_module.QueueWorker(
+        pipeline.match_faces, sqs, queue_url, wait_time=0.1, output_interval=0.5
+    )
+
+    def stop_when_done():
+        while worker.processed + worker.failed < len(messages):
+            time.sleep(0.005)
+        worker.stop()
+
+    threading.Thread(target=stop_when_done, daemon=True).start()
+    worker.run()
+    return worker.failed
+
+
+def run(
+    images,
+    batch_size,
+    collection_size,
+    corpus,
+    redelivery_rate=0.0,
+    screening_rate=0.0,
+    duplicate_rate=0.0,
+    worker=False,
+    profile_dir=None,
+    large_rate=0.0,
+    **pipeline_kwargs,
+):
+    """Replay `images` through the pipeline and measure it"""
+    pipeline = Pipeline(collection_size, corpus, **pipeline_kwargs)
+    images, originals = with_duplicates(images, duplicate_rate)
+    # the large photos: with little noise (~8 MB), or a lot (over 15 MB)
+    rng = random.Random(0)
+    photos = {
+        name: rng.choice([10, 60])
+        for _, name in images
+        if name not in originals and rng.random() < large_rate
+    }
+    if (
+        pipeline_kwargs.get("near_duplicates")
+        or pipeline_kwargs.get("normalize_max_dimension")
+        or pipeline_kwargs.get("collection_shards", 1) > 1
+        or photos
+    ):
+        pipeline.upload(images, originals, photos)
+
+    record_latencies = []
+    pipeline.match_faces.process_message = _timed(
+        record_latencies, pipeline.match_faces.process_message
+    )
+    # the latencies and failures of the messages of the large photos
+    photo_latencies, photo_failures = [], []
+    process_message = pipeline.match_faces.process_message
+
+    def process_timed(record):
+        key = json.loads(record["body"])["Records"][0]["s3"]["object"]["key"]
+        if key.split("/")[-1] not in photos:
+            return process_message(record)
+        start = time.perf_counter()
+        try:
+            return process_message(record)
+        except Exception:
+            photo_failures.append(key)
+            raise
+        finally:
+            photo_latencies.append(time.perf_counter() - start)
+
+    pipeline.match_faces.process_message = process_timed
+    failed = 0
+    start = time.perf_counter()
+    batches = sqs_batches(
+        images,
+        batch_size,
+        redelivery_rate=redelivery_rate,
+        screening_rate=screening_rate,
+    )
+    if worker:
+        failed = run_worker(pipeline, batches)
+    for event in [] if worker else batches:
+        response = pipeline.match_faces.handler(event, None)
+        failed += len((response or {}).get("batchItemFailures", []))
+    match_time = time.perf_counter() - start
+    reko_calls = sum(pipeline.reko.calls.values())
+
+    # S3 invokes the notification function with one record per event
+    notify_latencies = []
+    start = time.perf_counter()
+    for record in list(pipeline.notifications):
+        t0 = time.perf_counter()
+        pipeline.notify_matches.handler({"Records": [record]}, None)
+        notify_latencies.append(time.perf_counter() - t0)
+    notify_time = time.perf_counter() - start
+
+    n = len(images)
+    reports = pipeline.reports()
+    runner = "worker" if worker else "lambda"
+    output_mode = pipeline_kwargs.get("output_mode", "object")
+    profiles = {}
+    if pipeline_kwargs.get("profile_mode"):
+        profiles = write_profiles(
+            pipeline,
+            profile_dir,
+            f"{runner}-{output_mode}-{collection_size}-{batch_size}",
+        )
+    return {
+        "images": n,
+        "messages": len(record_latencies),
+        "batch_size": batch_size,
+        "collection_size": collection_size,
+        "output_mode": output_mode,
+        "search_mode": pipeline_kwargs.get("search_mode", "faces"),
+        "runner": runner,
+        "failed_records": failed,
+        "records_per_sec": n / match_time,
+        "record_latency_ms": percentiles(record_latencies),
+        "normalize_max_dimension": pipeline_kwargs.get("normalize_max_dimension"),
+        "large_photos": len(photos),
+        "large_photo_latency_ms": percentiles(photo_latencies),
+        "large_photo_failures": len(photo_failures),
+        "rekognition_calls_per_image": reko_calls / n,
+        "api_calls_per_image": pipeline.api_calls() / n,
+        "api_calls": {
+            f"{name}:{op}": count
+            for name, service in (
+                ("rekognition", pipeline.reko),
+                ("s3", pipeline.s3),
+                ("sns", pipeline.sns),
+                ("ssm", pipeline.ssm),
+            )
+            for op, count in sorted(service.calls.items())
+        },
+        # (with face matches, several matches can be the same customer)
+        "matches_per_report": (
+            sum(len(r["Matches"]) for r in reports) / len(reports) if reports else 0
+        ),
+        "matched_customers_per_report": (
+            sum(len({m["CustomerId"] for m in r["Matches"]}) for r in reports)
+            / len(reports)
+            if reports
+            else 0
+        ),
+        "bytes_written_per_image": pipeline.s3.bytes_written / n,
+        "objects_written_per_image": pipeline.s3.calls["PutObject"] / n,
+        "notify_events": len(notify_latencies),
+        "notify_events_per_sec": (
+            len(notify_latencies) / notify_time if notify_time else None
+        ),
+        "notify_latency_ms": percentiles(notify_latencies),
+        "alerts_sent": len(pipeline.sns.messages),
+        "stage_latency_ms": {
+            name[: -len("Latency")]: percentiles([v / 1000 for v in values])
+            for name, values in sorted(pipeline.metrics.values.items())
+            if name.endswith("Latency")
+        },
+        "counters": {
+            name: sum(values)
+            for name, values in sorted(pipeline.metrics.values.items())
+            if not name.endswith("Latency")
+        },
+        "profiles": profiles,
+    }
+
+
+def print_results(results):
+    header = (
+        f"{'runner':>6} {'output':>6} {'collection':>10} {'batch':>5} {'rec/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'calls/img':>9} {'B/img':>8} {'failed':>6}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        lat = r["record_latency_ms"]
+        print(
+            f"{r['runner']:>6} {r['output_mode']:>6} {r['collection_size']:>10} {r['batch_size']:>5} "
+            f"{r['records_per_sec']:>8.1f} {lat['p50']:>8.1f} {lat['p95']:>8.1f} "
+            f"{lat['p99']:>8.1f} {r['api_calls_per_image']:>9.2f} "
+            f"{r['bytes_written_per_image']:>8.0f} {r['failed_records']:>6}"
+        )
+    print()
+    for r in results:
+        stages = ", ".join(
+            f"{stage} {lat['p99']:.1f}" for stage, lat in r["stage_latency_ms"].items()
+        )
+        print(
+            f"{r['runner']} / {r['output_mode']} / {r['collection_size']} / {r['batch_size']}: "
+            f"p99 ms {stages}"
+        )
+        print(
+            f"    {r['search_mode']} search: {r['matches_per_report']:.1f} matches, "
+            f"{r['matched_customers_per_report']:.1f} customers per report"
+        )
+        if r["large_photos"]:
+            lat = r["large_photo_latency_ms"]
+            print(
+                f"    {r['large_photos']} large photos "
+                f"(normalized to {r['normalize_max_dimension'] or '-'}): "
+                f"p50 {lat['p50']:.1f} ms, p95 {lat['p95']:.1f} ms, "
+                f"{r['large_photo_failures']} failed attempts"
+            )
+        for name, profile in r["profiles"].items():
+            top = profile["top_functions"][:5]
+            print(
+                f"    {name} profile: {profile['invocations']} invocations, "
+                f"peak memory {profile['peak_memory_bytes'] / 2**20:.1f} MiB, top "
+                + ", ".join(t["function"] for t in top)
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument(
+        "--collection-sizes", type=int, nargs="+", default=[0, 10000, 100000]
+    )
+    parser.add_argument("--latency-scale", type=float, default=0.1)
+    parser.add_argument("--alias-rate", type=float, default=0.05)
+    parser.add_argument("--alias-pool", type=int, default=10)
+    parser.add_argument(
+        "--extra-face-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the images with a second face",
+    )
+    parser.add_argument(
+        "--output-modes", nargs="+", default=["object"], choices=["object", "batch"]
+    )
+    parser.add_argument(
+        "--match-store", action="store_true", help="also write the Parquet match store"
+    )
+    parser.add_argument(
+        "--redelivery-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the messages delivered twice",
+    )
+    parser.add_argument(
+        "--screening-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the images screened instead of enrolled",
+    )
+    parser.add_argument(
+        "--duplicate-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the images uploaded again, re-encoded",
+    )
+    parser.add_argument(
+        "--near-duplicates",
+        action="store_true",
+        help="reuse the faces of near-duplicate images",
+    )
+    parser.add_argument(
+        "--collection-shards",
+        type=int,
+        default=1,
+        help="collections the faces are spread across",
+    )
+    parser.add_argument(
+        "--search-mode",
+        choices=["faces", "users"],
+        default="faces",
+        help="search faces, or users (customers)",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="process the messages with the long-running worker",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=10,
+        help="record workers of the function (threads of the worker)",
+    )
+    parser.add_argument(
+        "--large-rate",
+        type=float,
+        default=0.0,
+        help="fraction of the images uploaded as large phone photos",
+    )
+    parser.add_argument(
+        "--normalize",
+        type=int,
+        default=0,
+        help="downscale the images larger than this (pixels) in the function",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "sample"],
+        default="",
+        help="profile every invocation of the functions",
+    )
+    parser.add_argument("--profile-dir", default="profiles")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    corpus = read_corpus()
+    images = sample_images(corpus, args.images, seed=args.seed)
+    results = []
+    for output_mode in args.output_modes:
+        for collection_size in args.collection_sizes:
+            for batch_size in args.batch_sizes:
+                results.append(
+                    run(
+                        images,
+                        batch_size,
+                        collection_size,
+                        corpus,
+                        latency_scale=args.latency_scale,
+                        alias_rate=args.alias_rate,
+                        alias_pool=args.alias_pool,
+                        extra_face_rate=args.extra_face_rate,
+                        output_mode=output_mode,
+                        match_store=args.match_store,
+                        redelivery_rate=args.redelivery_rate,
+                        screening_rate=args.screening_rate,
+                        duplicate_rate=args.duplicate_rate,
+                        near_duplicates=args.near_duplicates,
+                        collection_shards=args.collection_shards,
+                        worker=args.worker,
+                        max_workers=args.workers,
+                        search_mode=args.search_mode,
+                        profile_mode=args.profile,
+                        profile_dir=args.profile_dir,
+                        large_rate=args.large_rate,
+                        normalize_max_dimension=args.normalize,
+                    )
+                )
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
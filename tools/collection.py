@@ -0,0 +1,428 @@
+"""Inventory of the face collection, and eviction of stale faces.
+
+`snapshot` lists every face of the collection (or of all its shards, in
+parallel, page after page) into a local SQLite index of FaceId,
+ExternalImageId, customer ID, user and index time. The counts and the faces of
+a customer are then answered from the index, without listing the collection
+again. Rekognition doesn't return the index time of the faces: it is the time
+of the ledger entry of their image when `--ledger-table` is given (read by a
+parallel scan), otherwise the first snapshot the face was seen in.
+
+`evict` deletes the faces selected by the policies from the snapshot, in
+batches of `DeleteFaces`, after disassociating them from their users, and
+removes them from the ingestion artifacts:
+
+- the ledger entries of their images, so that a new upload of an image is
+  indexed again instead of reusing the deleted faces,
+- the entries of their images in the near-duplicate index, for the same reason.
+
+The reports already written, and the identity graph, are history and are kept.
+Without `--apply`, `evict` only prints what it would delete.
+
+Usage:
+    python -m tools.collection --index faces.db snapshot --collection TestCollection \
+        --shards 4 --ledger-table <LedgerTable>
+    python -m tools.collection --index faces.db count --top 20
+    python -m tools.collection --index faces.db customer Hans_Blix
+    python -m tools.collection --index faces.db evict --older-than-days 365 \
+        --customers-file deleted.txt --max-faces-per-customer 50 \
+        --ledger-table <LedgerTable> --image-hash-table <ImageHashTable> --apply
+
+The table names are exported to SSM by the stack (`/<stack name>/...`).
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.lambdas import load_function
+
+# the largest pages and batches of the APIs
+LIST_FACES_PAGE = 4096
+DELETE_FACES_BATCH = 4096
+DISASSOCIATE_FACES_BATCH = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS faces (
+    face_id TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    external_image_id TEXT,
+    customer_id TEXT,
+    user_id TEXT,
+    indexed_at REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS faces_customer ON faces (customer_id);
+CREATE INDEX IF NOT EXISTS faces_indexed_at ON faces (indexed_at);
+CREATE TABLE IF NOT EXISTS snapshots (
+    collection TEXT PRIMARY KEY,
+    taken_at REAL NOT NULL
+);
+"""
+FACE_COLUMNS = [
+    "face_id",
+    "collection",
+    "external_image_id",
+    "customer_id",
+    "user_id",
+    "indexed_at",
+]
+
+
+def customer_of(external_image_id):
+    """Customer ID of an image, as parsed by the match_faces function"""
+    return external_image_id.rsplit("_", 1)[0] if external_image_id else None
+
+
+class FaceIndex:
+    """Local index of the faces of the collection, in a SQLite file"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def replace(self, collection, faces, taken_at):
+        """Replace the faces of a collection (or shard) by a new snapshot"""
+        with self._lock, self.db:
+            self.db.execute("DELETE FROM faces WHERE collection = ?", (collection,))
+            self.db.executemany(
+                f"INSERT INTO faces VALUES ({', '.join('?' * len(FACE_COLUMNS))})",
+                ([face[c] for c in FACE_COLUMNS] for face in faces),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO snapshots VALUES (?, ?)",
+                (collection, taken_at),
+            )
+
+    def indexed_at(self, collection):
+        """Index time of the faces of the last snapshot of a collection"""
+        with self._lock:
+            return dict(
+                self.db.execute(
+                    "SELECT face_id, indexed_at FROM faces WHERE collection = ?",
+                    (collection,),
+                )
+            )
+
+    def _rows(self, query, params=()):
+        with self._lock:
+            cursor = self.db.execute(query, params)
+            columns = [d[0] for d in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    def counts(self, top=10):
+        """Faces and customers, by collection, and the customers with most faces"""
+        return {
+            "snapshots": self._rows("SELECT * FROM snapshots ORDER BY collection"),
+            "collections": self._rows(
+                "SELECT collection, count(*) AS faces, "
+                "count(DISTINCT customer_id) AS customers, "
+                "min(indexed_at) AS oldest, max(indexed_at) AS newest "
+                "FROM faces GROUP BY collection ORDER BY collection"
+            ),
+            "faces": self._rows("SELECT count(*) AS n FROM faces")[0]["n"],
+            "customers": self._rows(
+                "SELECT count(DISTINCT customer_id) AS n FROM faces"
+            )[0]["n"],
+            "top_customers": self._rows(
+                "SELECT customer_id, count(*) AS faces FROM faces "
+                "GROUP BY customer_id ORDER BY faces DESC LIMIT ?",
+                (top,),
+            ),
+        }
+
+    def customer(self, customer_id):
+        """The faces of a customer"""
+        return self._rows(
+            "SELECT * FROM faces WHERE customer_id = ? ORDER BY indexed_at",
+            (customer_id,),
+        )
+
+    def select(self, older_than=None, customers=(), max_per_customer=None):
+        """The faces selected by any of the policies: indexed before `older_than`
+        (a timestamp), of one of `customers`, or beyond the `max_per_customer`
+        most recent faces of their customer"""
+        with self._lock:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS evicted (id TEXT)")
+            self.db.execute("DELETE FROM evicted")
+            self.db.executemany(
+                "INSERT INTO evicted VALUES (?)", ((c,) for c in customers)
+            )
+        return self._rows(
+            "SELECT * FROM ("
+            "  SELECT *, row_number() OVER ("
+            "    PARTITION BY customer_id ORDER BY indexed_at DESC, face_id"
+            "  ) AS rank FROM faces"
+            ") WHERE indexed_at < ? OR customer_id IN (SELECT id FROM evicted) "
+            "OR rank > ? ORDER BY collection, user_id",
+            (
+                older_than if older_than is not None else float("-inf"),
+                max_per_customer if max_per_customer is not None else 1 << 62,
+            ),
+        )
+
+    def remove(self, face_ids):
+        with self._lock, self.db:
+            self.db.executemany(
+                "DELETE FROM faces WHERE face_id = ?", ((f,) for f in face_ids)
+            )
+
+
+def list_collection(reko, collection_id):
+    """All the faces of a collection, page after page"""
+    faces = []
+    kwargs = {"CollectionId": collection_id, "MaxResults": LIST_FACES_PAGE}
+    while True:
+        response = reko.list_faces(**kwargs)
+        faces.extend(response["Faces"])
+        if not response.get("NextToken"):
+            return faces
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def ledger_times(ledger_store):
+    """Index time (the last update of the ledger entry) of every face"""
+    return {
+        face_id: entry["updated"]
+        for _, entry in ledger_store.scan()
+        for face_id in entry["face_ids"]
+    }
+
+
+def snapshot(reko, collections, index, ledger_store=None, workers=8):
+    """List the collections (shards) in parallel into the index.
+
+    Returns the number of faces of every collection.
+    """
+    now = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # (the ledger is scanned while the collections are listed)
+        times = pool.submit(ledger_times, ledger_store) if ledger_store else None
+        listed = dict(
+            zip(
+                collections,
+                pool.map(lambda c: list_collection(reko, c), collections),
+            )
+        )
+        times = times.result() if times else {}
+    counts = {}
+    for collection, faces in listed.items():
+        seen = index.indexed_at(collection)
+        index.replace(
+            collection,
+            [
+                {
+                    "face_id": f["FaceId"],
+                    "collection": collection,
+                    "external_image_id": f.get("ExternalImageId"),
+                    "customer_id": customer_of(f.get("ExternalImageId")),
+                    "user_id": f.get("UserId"),
+                    "indexed_at": times.get(f["FaceId"])
+                    or seen.get(f["FaceId"])
+                    or now,
+                }
+                for f in faces
+            ],
+            now,
+        )
+        counts[collection] = len(faces)
+    return counts
+
+
+def chunks(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class Evictor:
+    """Deletion of faces from the collection, and from the ingestion artifacts.
+
+    Args:
+        reko: Rekognition client.
+        index: `FaceIndex` the faces were selected from, updated as they are
+            deleted.
+        ledger_store: store of the ingestion ledger, e.g. `DynamoDBLedgerStore`.
+        hash_index: near-duplicate index, e.g. `HashIndex(DynamoDBHashStore(...))`.
+        workers: concurrent `DeleteFaces` (and `DisassociateFaces`) calls.
+    """
+
+    def __init__(self, reko, index, ledger_store=None, hash_index=None, workers=4):
+        self.reko = reko
+        self.index = index
+        self.ledger_store = ledger_store
+        self.hash_index = hash_index
+        self.workers = workers
+
+    def evict(self, faces):
+        """Delete the faces (rows of the index), returns statistics"""
+        stats = Counter(selected=len(faces))
+        by_collection = {}
+        for face in faces:
+            by_collection.setdefault(face["collection"], []).append(face)
+        deleted = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for collection, collection_faces in by_collection.items():
+                self._disassociate(pool, collection, collection_faces, stats)
+                batches = chunks(
+                    [f["face_id"] for f in collection_faces], DELETE_FACES_BATCH
+                )
+                for response in pool.map(
+                    lambda batch: self.reko.delete_faces(
+                        CollectionId=collection, FaceIds=batch
+                    ),
+                    batches,
+                ):
+                    deleted.extend(response["DeletedFaces"])
+                    stats["failed"] += len(
+                        response.get("UnsuccessfulFaceDeletions", [])
+                    )
+        stats["deleted"] = len(deleted)
+        self.index.remove(deleted)
+        self._delete_empty_users(by_collection, stats)
+        self._clean_artifacts(set(deleted), stats)
+        return dict(stats)
+
+    def _disassociate(self, pool, collection, faces, stats):
+        """Faces associated with a user can't be deleted, they are disassociated
+        first"""
+        by_user = {}
+        for face in faces:
+            if face["user_id"]:
+                by_user.setdefault(face["user_id"], []).append(face["face_id"])
+        calls = [
+            (user_id, batch)
+            for user_id, face_ids in by_user.items()
+            for batch in chunks(face_ids, DISASSOCIATE_FACES_BATCH)
+        ]
+        for response in pool.map(
+            lambda call: self.reko.disassociate_faces(
+                CollectionId=collection, UserId=call[0], FaceIds=call[1]
+            ),
+            calls,
+        ):
+            stats["disassociated"] += len(response["DisassociatedFaces"])
+
+    def _delete_empty_users(self, by_collection, stats):
+        """Delete the users left without faces (e.g. deleted customers)"""
+        for collection, faces in by_collection.items():
+            for user_id in {f["user_id"] for f in faces if f["user_id"]}:
+                # (asked to the collection: faces may have been associated since
+                # the snapshot)
+                remaining = self.reko.list_faces(
+                    CollectionId=collection, UserId=user_id, MaxResults=1
+                )
+                if not remaining["Faces"]:
+                    self.reko.delete_user(CollectionId=collection, UserId=user_id)
+                    stats["deleted_users"] += 1
+
+    def _clean_artifacts(self, deleted, stats):
+        if not deleted:
+            return
+        if self.ledger_store is not None:
+            keys = [
+                key
+                for key, entry in self.ledger_store.scan()
+                if not deleted.isdisjoint(entry["face_ids"])
+            ]
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(self.ledger_store.delete, keys))
+            stats["ledger_entries"] = len(keys)
+        if self.hash_index is not None:
+            stats["image_hashes"] = self.hash_index.remove_faces(deleted)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--index", default="faces.db", help="SQLite file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    snap = commands.add_parser("snapshot", help="list the collection into the index")
+    snap.add_argument("--collection", required=True)
+    snap.add_argument("--shards", type=int, default=1)
+    snap.add_argument("--ledger-table", help="read the index times from the ledger")
+    snap.add_argument("--workers", type=int, default=8)
+    count = commands.add_parser("count", help="counts of faces and customers")
+    count.add_argument("--top", type=int, default=10)
+    customer = commands.add_parser("customer", help="faces of a customer")
+    customer.add_argument("customer_id")
+    evict = commands.add_parser("evict", help="delete the faces selected")
+    evict.add_argument("--older-than-days", type=float)
+    evict.add_argument("--customers", nargs="*", default=[], help="deleted customers")
+    evict.add_argument("--customers-file", help="deleted customers, one per line")
+    evict.add_argument("--max-faces-per-customer", type=int)
+    evict.add_argument("--ledger-table")
+    evict.add_argument("--image-hash-table")
+    evict.add_argument("--workers", type=int, default=4)
+    evict.add_argument("--apply", action="store_true", help="delete the faces")
+    args = parser.parse_args(argv)
+
+    index = FaceIndex(args.index)
+    ledger_table = getattr(args, "ledger_table", None)
+    ledger_store = None
+    if ledger_table:
+        ledger = load_function("match_faces", module="ledger")
+        ledger_store = ledger.DynamoDBLedgerStore(ledger_table)
+
+    if args.command == "snapshot":
+        import boto3
+
+        collections = (
+            [f"{args.collection}-{i}" for i in range(args.shards)]
+            if args.shards > 1
+            else [args.collection]
+        )
+        result = snapshot(
+            boto3.client("rekognition"),
+            collections,
+            index,
+            ledger_store,
+            workers=args.workers,
+        )
+    elif args.command == "count":
+        result = index.counts(args.top)
+    elif args.command == "customer":
+        result = index.customer(args.customer_id)
+    else:
+        customers = set(args.customers)
+        if args.customers_file:
+            with open(args.customers_file) as f:
+                customers.update(line.strip() for line in f if line.strip())
+        faces = index.select(
+            older_than=(
+                time.time() - args.older_than_days * 86400
+                if args.older_than_days is not None
+                else None
+            ),
+            customers=customers,
+            max_per_customer=args.max_faces_per_customer,
+        )
+        result = {
+            "selected": len(faces),
+            "customers": len({f["customer_id"] for f in faces}),
+        }
+        if args.apply and faces:
+            import boto3
+
+            hash_index = None
+            if args.image_hash_table:
+                near_duplicates = load_function("match_faces", module="near_duplicates")
+                # (only scanned, whatever its bands)
+                hash_index = near_duplicates.HashIndex(
+                    near_duplicates.DynamoDBHashStore(args.image_hash_table, 3)
+                )
+            evictor = Evictor(
+                boto3.client("rekognition"),
+                index,
+                ledger_store,
+                hash_index,
+                workers=args.workers,
+            )
+            result = evictor.evict(faces)
+    print(json.dumps(result, indent=2, default=str))
+    return result
+
+
+if __name__ == "__main__":
+    main()
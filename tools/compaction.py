@@ -0,0 +1,192 @@
+"""Compact the match reports of the output bucket, or measure the compaction.
+
+`run` compacts the closed windows of a bucket, as the scheduled function of the
+`MonitoringStack` does. `simulate` writes synthetic reports over a few days to the
+S3 stand-in, and measures the compaction ratio and the time to scan all the
+reports before and after (with a service time per GET, which is what dominates
+the scan of many small objects):
+
+Usage:
+    python -m tools.compaction simulate --reports 20000 --days 7
+    python -m tools.compaction run --bucket <OutBucket> \
+        --database face_match_output_db --table face_match_compacted
+"""
+
+import argparse
+import datetime
+import io
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tools.lambdas  # noqa: F401 (makes the common layer importable)
+from face_match.compaction import Compactor, GlueCatalog
+from face_match.reports import decode_reports, encode_report, report_key
+from tools.local_aws import LocalS3
+
+BUCKET_OUT = "bucket-out"
+
+
+def synthetic_report(rng, i, customers=2000):
+    customer_id = f"Customer_{rng.randrange(customers)}"
+    face_id = f"{i:08d}-face"
+    matches = []
+    for k in range(rng.choice([0, 0, 0, 1, 2, 5])):
+        matched = f"Customer_{rng.randrange(customers)}"
+        matches.append(
+            {
+                "Similarity": rng.uniform(50, 100),
+                "Face": {
+                    "FaceId": f"{i:08d}-{k}",
+                    "BoundingBox": {
+                        "Width": 0.3,
+                        "Height": 0.4,
+                        "Left": 0.3,
+                        "Top": 0.2,
+                    },
+                    "ImageId": f"{i:08d}-image",
+                    "ExternalImageId": f"{matched}_{k + 1:04d}.jpg",
+                    "Confidence": 99.9,
+                },
+                "CustomerId": matched,
+                "SearchedFaceId": face_id,
+            }
+        )
+    return {
+        "Source": f"bucket-images/images/{customer_id}/{customer_id}_{i:06d}.jpg",
+        "CustomerID": customer_id,
+        "Matches": matches,
+        "Faces": [
+            {
+                "FaceId": face_id,
+                "Matches": [
+                    {"FaceId": m["Face"]["FaceId"], "Similarity": m["Similarity"]}
+                    for m in matches
+                ],
+            }
+        ],
+    }
+
+
+def scan(s3, prefix, workers=16):
+    """Read every report under the prefix, like a full scan of its table.
+
+    Returns the number of reports and the seconds it took.
+    """
+    import pyarrow.parquet as pq
+
+    start = time.perf_counter()
+    keys = []
+    kwargs = {"Bucket": BUCKET_OUT, "Prefix": prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        # (Athena skips the files starting with an underscore, e.g. the manifests)
+        keys.extend(
+            obj["Key"]
+            for obj in response.get("Contents", [])
+            if not obj["Key"].rsplit("/", 1)[-1].startswith("_")
+        )
+        if not response.get("IsTruncated"):
+            break
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def read(key):
+        body = s3.get_object(Bucket=BUCKET_OUT, Key=key)["Body"].read()
+        if key.endswith(".parquet"):
+            return pq.read_table(io.BytesIO(body)).num_rows
+        return len(decode_reports(body, key))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        n_reports = sum(pool.map(read, keys))
+    return n_reports, time.perf_counter() - start
+
+
+def simulate(n_reports, days, get_latency, window="day", seed=0):
+    rng = random.Random(seed)
+    s3 = LocalS3(latency={"GetObject": get_latency})
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # the reports of the last `days` days, the current day is still being written
+    first = now - datetime.timedelta(days=days)
+    for i in range(n_reports):
+        body = encode_report(synthetic_report(rng, i))
+        written = first + (now - first) * (i / n_reports)
+        s3.objects[(BUCKET_OUT, report_key("output", f"{i:08d}.jpg"))] = {
+            "Body": body,
+            "ETag": f'"{i}"',
+            "LastModified": written.timestamp(),
+            "Metadata": {},
+        }
+    objects_before = len(s3.objects)
+    bytes_before = sum(len(o["Body"]) for o in s3.objects.values())
+    reports_before, scan_before = scan(s3, "output/")
+
+    compactor = Compactor(s3, BUCKET_OUT, window=window)
+    start = time.perf_counter()
+    stats = compactor.run(now=now)
+    compaction_time = time.perf_counter() - start
+
+    objects_after = len(s3.objects)
+    bytes_after = sum(len(o["Body"]) for o in s3.objects.values())
+    compacted, scan_compacted = scan(s3, "compacted/")
+    remaining, scan_remaining = scan(s3, "output/")
+    result = {
+        "reports": reports_before,
+        "windows_compacted": len(stats),
+        "objects_before": objects_before,
+        "objects_after": objects_after,
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "compaction_seconds": compaction_time,
+        "scan_seconds_before": scan_before,
+        "scan_seconds_after": scan_compacted + scan_remaining,
+        "reports_after": compacted + remaining,
+    }
+    result["object_ratio"] = objects_before / objects_after
+    result["scan_speedup"] = (
+        result["scan_seconds_before"] / result["scan_seconds_after"]
+    )
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    sim = commands.add_parser("simulate", help="measure on synthetic reports")
+    sim.add_argument("--reports", type=int, default=20000)
+    sim.add_argument("--days", type=int, default=7)
+    sim.add_argument("--get-latency", type=float, default=0.01, help="seconds per GET")
+    sim.add_argument("--window", choices=["day", "hour"], default="day")
+    run = commands.add_parser("run", help="compact the reports of a bucket")
+    run.add_argument("--bucket", required=True)
+    run.add_argument("--database", default="face_match_output_db")
+    run.add_argument("--table", default="face_match_compacted")
+    run.add_argument("--window", choices=["day", "hour"], default="day")
+    run.add_argument("--grace", type=int, default=3600, help="seconds")
+    run.add_argument(
+        "--archive-prefix",
+        default="archive",
+        help='copy the originals there first ("" to only delete them)',
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "simulate":
+        result = simulate(args.reports, args.days, args.get_latency, args.window)
+    else:
+        import boto3
+
+        compactor = Compactor(
+            boto3.client("s3"),
+            args.bucket,
+            GlueCatalog(boto3.client("glue"), args.database, args.table),
+            window=args.window,
+            grace=args.grace,
+            archive_prefix=args.archive_prefix,
+        )
+        result = compactor.run()
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
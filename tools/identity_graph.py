@@ -0,0 +1,38 @@
+"""Query the duplicate-identity graph maintained by the `match_faces` function.
+
+Usage:
+    python -m tools.identity_graph --table <IdentityGraphTable> cluster Hans_Blix
+    python -m tools.identity_graph --table <IdentityGraphTable> top -k 20
+
+The table name is exported to SSM as `/<stack name>/IdentityGraphTable`.
+"""
+
+import argparse
+import json
+
+import tools.lambdas  # noqa: F401 (makes the common layer importable)
+from face_match.identity_graph import DynamoDBGraphStore, IdentityGraph
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--table", required=True)
+    commands = parser.add_subparsers(dest="command", required=True)
+    cluster = commands.add_parser("cluster", help="cluster of a customer ID")
+    cluster.add_argument("customer_id")
+    top = commands.add_parser("top", help="largest clusters")
+    top.add_argument("-k", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    graph = IdentityGraph(DynamoDBGraphStore(args.table))
+    if args.command == "cluster":
+        result = graph.cluster(args.customer_id)
+        result["edges"] = graph.edges(args.customer_id)
+    else:
+        result = graph.top_clusters(args.k)
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Load the lambda functions of the stack as regular Python modules.
+
+The handlers live in `lambdas/fns/<name>/lambda.py`, which can't be imported by
+name (`lambda` is a keyword) and read their configuration from the environment at
+import time. `load_function` imports a fresh copy with the given environment, and
+replaces its module-level AWS clients with local stand-ins. The shared code of
+the `common` layer is made importable, as it is in the lambda runtime.
+"""
+
+import importlib.util
+import os
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+FNS_DIR = ROOT / "lambdas" / "fns"
+LAYER_DIRS = [ROOT / "lambdas" / "layers" / "common"]
+
+for _layer_dir in LAYER_DIRS:
+    if str(_layer_dir) not in sys.path:
+        sys.path.append(str(_layer_dir))
+
+
+@contextmanager
+def _environment(env):
+    saved = dict(os.environ)
+    # boto3 needs a region to create the clients at import time
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.update({k: str(v) for k, v in env.items()})
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def load_function(name, env=None, module="lambda", **clients):
+    """Import the handler module of the function `name`.
+
+    Args:
+        name: directory of the function in `lambdas/fns`, e.g. "match_faces".
+        env: environment variables, as set by the stack on the function.
+        module: module of the function to import, e.g. "worker".
+        clients: module attributes to replace after the import, e.g.
+            `reko=RekognitionEmulator()`.
+    """
+    fn_dir = FNS_DIR / name
+    spec = importlib.util.spec_from_file_location(
+        f"{name}_{module}", fn_dir / f"{module}.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.path.insert(0, str(fn_dir))
+    try:
+        with _environment(env or {}):
+            spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(fn_dir))
+    for attr, client in clients.items():
+        setattr(module, attr, client)
+    return module
@@ -0,0 +1,471 @@
+"""In-memory stand-ins for the AWS services used around the face matching pipeline.
+
+Each class implements the subset of the boto3 client methods called by the lambda
+functions, counts the calls per operation (in `calls`) and can simulate a service
+time per call (`latency`, in seconds, either a number or a dict keyed by operation).
+"""
+
+import datetime
+import hashlib
+import io
+import threading
+import time
+import uuid
+from collections import Counter
+
+from botocore.exceptions import ClientError
+
+
+class _Service:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.RLock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        delay = (
+            self.latency.get(operation, 0.0)
+            if isinstance(self.latency, dict)
+            else self.latency
+        )
+        if delay:
+            time.sleep(delay)
+
+
+def _client_error(code, operation, message):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class LocalS3(_Service):
+    """Object store keyed by (bucket, key).
+
+    Listeners registered with `subscribe` are called with an S3 event record every
+    time an object is created, like an S3 event notification.
+    """
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.objects = {}
+        self.bytes_written = 0
+        self._listeners = []
+
+    def subscribe(self, listener, prefix=""):
+        self._listeners.append((prefix, listener))
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._call("PutObject")
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+        body = bytes(Body)
+        etag = hashlib.md5(body).hexdigest()
+        with self._lock:
+            self.objects[(Bucket, Key)] = {
+                "Body": body,
+                "ETag": f'"{etag}"',
+                "LastModified": time.time(),
+                "Metadata": kwargs.get("Metadata", {}),
+            }
+            self.bytes_written += len(body)
+        for prefix, listener in self._listeners:
+            if Key.startswith(prefix):
+                listener(self.event_record(Bucket, Key, len(body), etag))
+        return {"ETag": f'"{etag}"'}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self._call("GetObject")
+        try:
+            obj = self.objects[(Bucket, Key)]
+        except KeyError:
+            raise _client_error("NoSuchKey", "GetObject", f"{Bucket}/{Key}")
+        body = obj["Body"]
+        response = {"ETag": obj["ETag"], "Metadata": obj["Metadata"]}
+        if kwargs.get("Range"):
+            # (only the "bytes=<first>-<last>" form)
+            first, last = kwargs["Range"][len("bytes=") :].split("-")
+            part = body[int(first) : int(last) + 1]
+            response["ContentRange"] = (
+                f"bytes {first}-{int(first) + len(part) - 1}/{len(body)}"
+            )
+            body = part
+        response.update({"Body": io.BytesIO(body), "ContentLength": len(body)})
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call("HeadObject")
+        try:
+            obj = self.objects[(Bucket, Key)]
+        except KeyError:
+            raise _client_error("404", "HeadObject", "Not Found")
+        return {
+            "ContentLength": len(obj["Body"]),
+            "ETag": obj["ETag"],
+            "Metadata": obj["Metadata"],
+        }
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call("DeleteObject")
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._call("DeleteObjects")
+        if len(Delete["Objects"]) > 1000:
+            raise _client_error(
+                "MalformedXML", "DeleteObjects", "At most 1000 keys per request"
+            )
+        with self._lock:
+            for obj in Delete["Objects"]:
+                self.objects.pop((Bucket, obj["Key"]), None)
+        return {} if Delete.get("Quiet") else {"Deleted": Delete["Objects"]}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self._call("CopyObject")
+        try:
+            source = self.objects[(CopySource["Bucket"], CopySource["Key"])]
+        except KeyError:
+            raise _client_error("NoSuchKey", "CopyObject", str(CopySource))
+        with self._lock:
+            self.objects[(Bucket, Key)] = {**source, "LastModified": time.time()}
+        return {"CopyObjectResult": {"ETag": source["ETag"]}}
+
+    def list_objects_v2(
+        self, Bucket, Prefix="", ContinuationToken=None, MaxKeys=1000, **kwargs
+    ):
+        self._call("ListObjectsV2")
+        with self._lock:
+            keys = sorted(
+                k for b, k in self.objects if b == Bucket and k.startswith(Prefix)
+            )
+        if ContinuationToken:
+            keys = [k for k in keys if k > ContinuationToken]
+        page = keys[:MaxKeys]
+        response = {
+            "KeyCount": len(page),
+            "Contents": [
+                {
+                    "Key": k,
+                    "Size": len(self.objects[(Bucket, k)]["Body"]),
+                    "ETag": self.objects[(Bucket, k)]["ETag"],
+                    "LastModified": datetime.datetime.fromtimestamp(
+                        self.objects[(Bucket, k)]["LastModified"],
+                        datetime.timezone.utc,
+                    ),
+                }
+                for k in page
+            ],
+            "IsTruncated": len(keys) > MaxKeys,
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def Object(self, bucket_name, key):
+        """Minimal equivalent of `boto3.resource("s3").Object`"""
+        return _LocalS3Object(self, bucket_name, key)
+
+    @staticmethod
+    def event_record(bucket, key, size=None, etag=None):
+        """S3 notification record for an object creation"""
+        s3_object = {"key": key, "size": size}
+        if etag:
+            s3_object["eTag"] = etag.strip('"')
+        return {
+            "eventSource": "aws:s3",
+            "eventName": "ObjectCreated:Put",
+            "s3": {"bucket": {"name": bucket}, "object": s3_object},
+        }
+
+
+class _LocalS3Object:
+    def __init__(self, s3, bucket_name, key):
+        self._s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+
+    def get(self, **kwargs):
+        return self._s3.get_object(Bucket=self.bucket_name, Key=self.key, **kwargs)
+
+    def put(self, **kwargs):
+        return self._s3.put_object(Bucket=self.bucket_name, Key=self.key, **kwargs)
+
+
+class LocalSNS(_Service):
+    """Topic stand-in that keeps every published message in `messages`"""
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.messages = []
+
+    def publish(self, TopicArn, Message, **kwargs):
+        self._call("Publish")
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            self.messages.append({"TopicArn": TopicArn, "Message": Message})
+        return {"MessageId": message_id}
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries, **kwargs):
+        self._call("PublishBatch")
+        if not 1 <= len(PublishBatchRequestEntries) <= 10:
+            raise _client_error(
+                "TooManyEntriesInBatchRequest",
+                "PublishBatch",
+                "The batch request contains more entries than permissible",
+            )
+        successful = []
+        with self._lock:
+            for entry in PublishBatchRequestEntries:
+                self.messages.append(
+                    {"TopicArn": TopicArn, "Message": entry["Message"]}
+                )
+                successful.append({"Id": entry["Id"], "MessageId": str(uuid.uuid4())})
+        return {"Successful": successful, "Failed": []}
+
+
+class LocalSSM(_Service):
+    """Parameter store stand-in, initialised with a dict of name -> value"""
+
+    def __init__(self, parameters=None, latency=0.0):
+        super().__init__(latency)
+        self.parameters = dict(parameters or {})
+
+    def get_parameters(self, Names, **kwargs):
+        self._call("GetParameters")
+        return {
+            "Parameters": [
+                {"Name": name, "Type": "String", "Value": self.parameters[name]}
+                for name in Names
+                if name in self.parameters
+            ],
+            "InvalidParameters": [n for n in Names if n not in self.parameters],
+        }
+
+    def get_parameter(self, Name, **kwargs):
+        self._call("GetParameter")
+        try:
+            value = self.parameters[Name]
+        except KeyError:
+            raise _client_error("ParameterNotFound", "GetParameter", Name)
+        return {"Parameter": {"Name": Name, "Type": "String", "Value": value}}
+
+
+class LocalSQS(_Service):
+    """Standard queues with visibility timeouts, keyed by queue URL.
+
+    A message received is invisible for the visibility timeout (of the call, or
+    of the queue), and delivered again unless it is deleted before; its receipt
+    handle changes with every delivery. `receive_message` long-polls up to
+    `WaitTimeSeconds` for messages.
+    """
+
+    def __init__(self, visibility_timeout=30, latency=0.0):
+        super().__init__(latency)
+        self.visibility_timeout = visibility_timeout
+        self.queues = {}
+        self.deleted = 0
+        self._available = threading.Condition(self._lock)
+
+    def create_queue(self, QueueName, Attributes=None, **kwargs):
+        url = f"https://sqs.local/000000000000/{QueueName}"
+        with self._lock:
+            self.queues.setdefault(url, {})
+        return {"QueueUrl": url}
+
+    def get_queue_url(self, QueueName, **kwargs):
+        url = f"https://sqs.local/000000000000/{QueueName}"
+        if url not in self.queues:
+            raise _client_error(
+                "AWS.SimpleQueueService.NonExistentQueue", "GetQueueUrl", QueueName
+            )
+        return {"QueueUrl": url}
+
+    def _queue(self, url, operation):
+        try:
+            return self.queues[url]
+        except KeyError:
+            raise _client_error(
+                "AWS.SimpleQueueService.NonExistentQueue", operation, url
+            )
+
+    def send_message(
+        self, QueueUrl, MessageBody, MessageAttributes=None, DelaySeconds=0, **kwargs
+    ):
+        self._call("SendMessage")
+        message_id = str(uuid.uuid4())
+        with self._available:
+            self._queue(QueueUrl, "SendMessage")[message_id] = {
+                "MessageId": message_id,
+                "Body": MessageBody,
+                "MessageAttributes": dict(MessageAttributes or {}),
+                "ReceiveCount": 0,
+                "ReceiptHandle": None,
+                "VisibleAt": time.monotonic() + DelaySeconds,
+            }
+            self._available.notify_all()
+        return {"MessageId": message_id}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        self._check_batch(Entries, "SendMessageBatch")
+        return {
+            "Successful": [
+                {
+                    "Id": entry["Id"],
+                    **self.send_message(
+                        QueueUrl,
+                        entry["MessageBody"],
+                        entry.get("MessageAttributes"),
+                        entry.get("DelaySeconds", 0),
+                    ),
+                }
+                for entry in Entries
+            ],
+            "Failed": [],
+        }
+
+    def receive_message(
+        self,
+        QueueUrl,
+        MaxNumberOfMessages=1,
+        WaitTimeSeconds=0,
+        VisibilityTimeout=None,
+        **kwargs,
+    ):
+        self._call("ReceiveMessage")
+        timeout = (
+            self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+        )
+        deadline = time.monotonic() + WaitTimeSeconds
+        with self._available:
+            queue = self._queue(QueueUrl, "ReceiveMessage")
+            while True:
+                now = time.monotonic()
+                visible = [m for m in queue.values() if m["VisibleAt"] <= now]
+                if visible or now >= deadline:
+                    break
+                # (woken up by new messages, or when the next one becomes visible)
+                next_visible = min(
+                    (m["VisibleAt"] for m in queue.values()), default=deadline
+                )
+                self._available.wait(max(0.0, min(deadline, next_visible) - now))
+            messages = []
+            for m in visible[:MaxNumberOfMessages]:
+                m["ReceiveCount"] += 1
+                m["ReceiptHandle"] = f"{m['MessageId']}#{uuid.uuid4().hex}"
+                m["VisibleAt"] = now + timeout
+                messages.append(
+                    {
+                        "MessageId": m["MessageId"],
+                        "ReceiptHandle": m["ReceiptHandle"],
+                        "Body": m["Body"],
+                        "Attributes": {
+                            "ApproximateReceiveCount": str(m["ReceiveCount"])
+                        },
+                        "MessageAttributes": m["MessageAttributes"],
+                    }
+                )
+        return {"Messages": messages} if messages else {}
+
+    def _received(self, queue, receipt_handle):
+        message = queue.get(receipt_handle.split("#", 1)[0])
+        if message is None or message["ReceiptHandle"] != receipt_handle:
+            return None
+        return message
+
+    @staticmethod
+    def _check_batch(entries, operation):
+        if not 1 <= len(entries) <= 10:
+            raise _client_error(
+                "AWS.SimpleQueueService.TooManyEntriesInBatchRequest",
+                operation,
+                "Maximum number of entries per request are 10",
+            )
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self._call("DeleteMessageBatch")
+        self._check_batch(Entries, "DeleteMessageBatch")
+        successful, failed = [], []
+        with self._lock:
+            queue = self._queue(QueueUrl, "DeleteMessageBatch")
+            for entry in Entries:
+                message = self._received(queue, entry["ReceiptHandle"])
+                if message is None:
+                    failed.append(
+                        {
+                            "Id": entry["Id"],
+                            "Code": "ReceiptHandleIsInvalid",
+                            "SenderFault": True,
+                        }
+                    )
+                    continue
+                del queue[message["MessageId"]]
+                self.deleted += 1
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        response = self.delete_message_batch(
+            QueueUrl, [{"Id": "0", "ReceiptHandle": ReceiptHandle}]
+        )
+        if response["Failed"]:
+            raise _client_error(
+                "ReceiptHandleIsInvalid", "DeleteMessage", ReceiptHandle
+            )
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        self._call("ChangeMessageVisibilityBatch")
+        self._check_batch(Entries, "ChangeMessageVisibilityBatch")
+        successful, failed = [], []
+        with self._available:
+            queue = self._queue(QueueUrl, "ChangeMessageVisibilityBatch")
+            for entry in Entries:
+                message = self._received(queue, entry["ReceiptHandle"])
+                if message is None:
+                    failed.append(
+                        {
+                            "Id": entry["Id"],
+                            "Code": "ReceiptHandleIsInvalid",
+                            "SenderFault": True,
+                        }
+                    )
+                    continue
+                message["VisibleAt"] = time.monotonic() + entry["VisibilityTimeout"]
+                successful.append({"Id": entry["Id"]})
+            self._available.notify_all()
+        return {"Successful": successful, "Failed": failed}
+
+    def change_message_visibility(
+        self, QueueUrl, ReceiptHandle, VisibilityTimeout, **kwargs
+    ):
+        response = self.change_message_visibility_batch(
+            QueueUrl,
+            [
+                {
+                    "Id": "0",
+                    "ReceiptHandle": ReceiptHandle,
+                    "VisibilityTimeout": VisibilityTimeout,
+                }
+            ],
+        )
+        if response["Failed"]:
+            raise _client_error(
+                "ReceiptHandleIsInvalid", "ChangeMessageVisibility", ReceiptHandle
+            )
+        return {}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+        self._call("GetQueueAttributes")
+        with self._lock:
+            now = time.monotonic()
+            queue = self._queue(QueueUrl, "GetQueueAttributes")
+            visible = sum(m["VisibleAt"] <= now for m in queue.values())
+        return {
+            "Attributes": {
+                "ApproximateNumberOfMessages": str(visible),
+                "ApproximateNumberOfMessagesNotVisible": str(len(queue) - visible),
+            }
+        }
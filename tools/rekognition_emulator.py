@@ -0,0 +1,906 @@
+"""Offline stand-in for the Rekognition face collection (and user) APIs.
+
+`RekognitionEmulator` exposes the subset of the boto3 Rekognition client used by
+the lambda functions and the demo utilities. Faces are synthetic: each image gets a
+deterministic embedding derived from the customer ID in its name (the
+`<customer_id>_<n>.jpg` convention of the LFW dataset), so that images of the same
+customer are similar to each other and dissimilar from everybody else.
+
+The embeddings are kept in a NumPy matrix, and searches are a batched top-k cosine
+similarity over it, which keeps the emulator usable with collections of hundreds of
+thousands of faces.
+
+Example:
+    reko = RekognitionEmulator(alias_rate=0.05)
+    reko.create_collection(CollectionId="TestCollection")
+    reko.bulk_index_faces(CollectionId="TestCollection", ExternalImageIds=names)
+    match_faces.reko = reko
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from collections import Counter
+
+import numpy as np
+from botocore.exceptions import ClientError, ParamValidationError
+
+FACE_MODEL_VERSION = "6.0"
+LIST_FACES_MAX_RESULTS = 4096
+DELETE_FACES_MAX_IDS = 4096
+ASSOCIATE_FACES_MAX_IDS = 100
+MAX_USER_FACES = 100
+# the largest images accepted, from S3 and as bytes
+S3_OBJECT_MAX_BYTES = 15 * 2**20
+IMAGE_BYTES_MAX_BYTES = 5 * 2**20
+# range of the width and height of the faces, relative to the image
+FACE_SIZES = (0.3, 0.5)
+BYSTANDER_SIZES = (0.1, 0.25)
+
+
+def _make_exception(name):
+    return type(name, (ClientError,), {})
+
+
+class _Exceptions:
+    """Mirror of `client.exceptions`, so that callers can catch the same names"""
+
+    ResourceAlreadyExistsException = _make_exception("ResourceAlreadyExistsException")
+    ResourceNotFoundException = _make_exception("ResourceNotFoundException")
+    InvalidParameterException = _make_exception("InvalidParameterException")
+    InvalidImageFormatException = _make_exception("InvalidImageFormatException")
+    ImageTooLargeException = _make_exception("ImageTooLargeException")
+    ProvisionedThroughputExceededException = _make_exception(
+        "ProvisionedThroughputExceededException"
+    )
+    ThrottlingException = _make_exception("ThrottlingException")
+    ConflictException = _make_exception("ConflictException")
+    ServiceQuotaExceededException = _make_exception("ServiceQuotaExceededException")
+
+
+def _raise(exception, operation, message):
+    raise exception(
+        {"Error": {"Code": exception.__name__, "Message": message}}, operation
+    )
+
+
+def _check_type(name, value, types, operation):
+    # botocore validates the parameters client-side, before sending the request
+    if not isinstance(value, types) or isinstance(value, bool):
+        raise ParamValidationError(
+            report=f"Invalid type for parameter {name} of {operation}, value: "
+            f"{value!r}, type: {type(value)}"
+        )
+
+
+def _digest(*parts):
+    return hashlib.blake2b(":".join(map(str, parts)).encode(), digest_size=16).digest()
+
+
+def _seed(*parts):
+    return int.from_bytes(_digest(*parts)[:8], "little")
+
+
+def _fraction(*parts):
+    return _seed(*parts) / 2**64
+
+
+def customer_of(name):
+    """Customer ID encoded in an image name, as parsed by the match_faces lambda"""
+    return name.split("/")[-1].rsplit("_", 1)[0]
+
+
+class _Collection:
+    def __init__(self, collection_id, dim, capacity=1024):
+        self.collection_id = collection_id
+        self.created = time.time()
+        self.embeddings = np.zeros((capacity, dim), dtype=np.float32)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.faces = []  # face descriptions, aligned with the rows of the matrix
+        self.rows = {}  # FaceId -> row
+        self.size = 0
+        self.users = {}  # UserId -> FaceIds associated with the user
+        self.face_users = {}  # FaceId -> UserId
+        self.user_vectors = {}  # UserId -> user vector, reset on changes
+        self.user_matrix = None  # (UserIds, user vectors), reset on changes
+
+    def append(self, vectors, faces):
+        n = len(faces)
+        if self.size + n > len(self.active):
+            capacity = max(2 * len(self.active), self.size + n)
+            embeddings = np.zeros((capacity, self.embeddings.shape[1]), np.float32)
+            embeddings[: self.size] = self.embeddings[: self.size]
+            active = np.zeros(capacity, dtype=bool)
+            active[: self.size] = self.active[: self.size]
+            self.embeddings, self.active = embeddings, active
+        self.embeddings[self.size : self.size + n] = vectors
+        self.active[self.size : self.size + n] = True
+        for i, face in enumerate(faces):
+            self.rows[face["FaceId"]] = self.size + i
+        self.faces.extend(faces)
+        self.size += n
+
+
+class RekognitionEmulator:
+    """In-memory Rekognition client for face collections.
+
+    Args:
+        dim: size of the synthetic embeddings.
+        seed: seed of every random draw, two emulators with the same arguments
+            return the same faces and the same similarities.
+        intra_class_noise: spread of the images of one identity around the identity
+            centroid. The default gives same-identity similarities around 96%.
+        alias_rate: fraction of customer IDs that are the same person as another
+            customer ID (the duplicates the pipeline is meant to find).
+        alias_pool: number of identities shared by the aliased customer IDs.
+        no_face_rate: fraction of images where no face is detected.
+        extra_face_rate: fraction of images that contain a second (bystander) face.
+        latency: simulated service time in seconds, either a number applied to every
+            call or a dict keyed by operation name (e.g. `{"SearchFaces": 0.1}`).
+        latency_per_mb: additional service time per MB of the image, for the
+            operations that take one, a number or a dict like `latency`.
+        s3: `LocalS3` the `S3Object` images are read from, to check their size
+            (without it, their size is unknown and free).
+        identify_bytes: `identify_bytes(body)` returns the "<bucket>/<key>" of the
+            image that bytes are a copy of (e.g. downscaled), or a
+            ("<bucket>/<key>", face_index) pair for a crop around one of its
+            faces, or None. The bytes of unknown images are their own image.
+    """
+
+    exceptions = _Exceptions
+
+    def __init__(
+        self,
+        dim=128,
+        seed=0,
+        intra_class_noise=0.2,
+        alias_rate=0.0,
+        alias_pool=100,
+        no_face_rate=0.0,
+        extra_face_rate=0.0,
+        latency=0.0,
+        latency_per_mb=0.0,
+        s3=None,
+        identify_bytes=None,
+    ):
+        self.dim = dim
+        self.seed = seed
+        self.intra_class_noise = intra_class_noise
+        self.alias_rate = alias_rate
+        self.alias_pool = alias_pool
+        self.no_face_rate = no_face_rate
+        self.extra_face_rate = extra_face_rate
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        self.s3 = s3
+        self.identify_bytes = identify_bytes
+        self.calls = Counter()
+        self._collections = {}
+        self._identities = {}
+        self._lock = threading.RLock()
+
+    # ------------------------------------------------------------------ helpers
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        delay = (
+            self.latency.get(operation, 0.0)
+            if isinstance(self.latency, dict)
+            else self.latency
+        )
+        if delay:
+            time.sleep(delay)
+
+    def _collection(self, collection_id, operation):
+        try:
+            return self._collections[collection_id]
+        except KeyError:
+            _raise(
+                self.exceptions.ResourceNotFoundException,
+                operation,
+                f"The collection id: {collection_id} does not exist",
+            )
+
+    def identity(self, customer_id):
+        """Canonical identity of a customer, shared by aliased customers"""
+        if (
+            self.alias_rate
+            and _fraction(self.seed, "alias", customer_id) < self.alias_rate
+        ):
+            return f"alias-{_seed(self.seed, 'pool', customer_id) % self.alias_pool}"
+        return customer_id
+
+    def _identity_vector(self, identity):
+        vector = self._identities.get(identity)
+        if vector is None:
+            rng = np.random.default_rng(_seed(self.seed, "identity", identity))
+            vector = rng.standard_normal(self.dim).astype(np.float32)
+            vector /= np.linalg.norm(vector)
+            self._identities[identity] = vector
+        return vector
+
+    def _face_vector(self, identity, image_key, face_index):
+        rng = np.random.default_rng(_seed(self.seed, "face", image_key, face_index))
+        noise = rng.standard_normal(self.dim).astype(np.float32)
+        noise *= self.intra_class_noise / np.sqrt(self.dim)
+        vector = self._identity_vector(identity) + noise
+        return vector / np.linalg.norm(vector)
+
+    def _image_key(self, image, operation):
+        """Key of an image, after the checks and the processing time of its size"""
+        return self._image(image, operation)[0]
+
+    def _image(self, image, operation):
+        """Key of an image and index of its largest face (not 0 for a crop around
+        another face), after the checks and the processing time of its size"""
+        if "S3Object" in image:
+            s3_object = image["S3Object"]
+            key = f"{s3_object['Bucket']}/{s3_object['Name']}"
+            obj = (
+                self.s3.objects.get((s3_object["Bucket"], s3_object["Name"]))
+                if self.s3 is not None
+                else None
+            )
+            self._process_image(
+                len(obj["Body"]) if obj else 0, S3_OBJECT_MAX_BYTES, operation
+            )
+            return key, 0
+        if "Bytes" in image:
+            body = bytes(image["Bytes"])
+            self._process_image(len(body), IMAGE_BYTES_MAX_BYTES, operation)
+            key = self.identify_bytes(body) if self.identify_bytes else None
+            if isinstance(key, tuple):
+                return key
+            # otherwise the content is used as the key
+            return key or hashlib.sha1(body).hexdigest(), 0
+        _raise(self.exceptions.InvalidParameterException, operation, "Invalid image")
+
+    def _process_image(self, size, max_size, operation):
+        if size > max_size:
+            _raise(
+                self.exceptions.ImageTooLargeException,
+                operation,
+                f"Image size is too large: {size} bytes, at most {max_size}",
+            )
+        per_mb = (
+            self.latency_per_mb.get(operation, 0.0)
+            if isinstance(self.latency_per_mb, dict)
+            else self.latency_per_mb
+        )
+        if per_mb and size:
+            time.sleep(per_mb * size / 2**20)
+
+    def detect(self, image_key):
+        """Faces detected in an image, as a list of (identity, face_key) pairs.
+
+        The first face is the customer in the image name, and the largest one (the
+        face searched by `SearchFacesByImage`), the others are smaller bystanders
+        with identities of their own.
+        """
+        if _fraction(self.seed, "noface", image_key) < self.no_face_rate:
+            return []
+        faces = [(self.identity(customer_of(image_key)), image_key)]
+        if _fraction(self.seed, "extra", image_key) < self.extra_face_rate:
+            faces.append((f"bystander-{image_key}", image_key))
+        return faces
+
+    def _describe_face(self, face_id, image_key, face_index, external_image_id):
+        rng = np.random.default_rng(_seed(self.seed, "box", image_key, face_index))
+        # the customer's face is larger than the bystanders'
+        width, height = rng.uniform(
+            *(FACE_SIZES if face_index == 0 else BYSTANDER_SIZES), size=2
+        )
+        face = {
+            "FaceId": face_id,
+            "BoundingBox": {
+                "Width": float(width),
+                "Height": float(height),
+                "Left": float(rng.uniform(0, 1 - width)),
+                "Top": float(rng.uniform(0, 1 - height)),
+            },
+            "ImageId": str(uuid.UUID(bytes=_digest(self.seed, "image", image_key))),
+            "Confidence": float(rng.uniform(99.0, 100.0)),
+            "IndexFacesModelVersion": FACE_MODEL_VERSION,
+        }
+        if external_image_id is not None:
+            face["ExternalImageId"] = external_image_id
+        return face
+
+    def _new_face_id(self, collection, image_key, face_index):
+        # unique even when the same image is indexed twice, like the real service
+        return str(
+            uuid.UUID(
+                bytes=_digest(
+                    self.seed,
+                    collection.collection_id,
+                    image_key,
+                    face_index,
+                    collection.size,
+                )
+            )
+        )
+
+    # -------------------------------------------------------------- collections
+    def create_collection(self, CollectionId, **kwargs):
+        self._call("CreateCollection")
+        with self._lock:
+            if CollectionId in self._collections:
+                _raise(
+                    self.exceptions.ResourceAlreadyExistsException,
+                    "CreateCollection",
+                    f"The collection id: {CollectionId} already exists",
+                )
+            self._collections[CollectionId] = _Collection(CollectionId, self.dim)
+        return {
+            "StatusCode": 200,
+            "CollectionArn": f"aws:rekognition:local:000000000000:collection/{CollectionId}",
+            "FaceModelVersion": FACE_MODEL_VERSION,
+        }
+
+    def delete_collection(self, CollectionId, **kwargs):
+        self._call("DeleteCollection")
+        with self._lock:
+            self._collection(CollectionId, "DeleteCollection")
+            del self._collections[CollectionId]
+        return {"StatusCode": 200}
+
+    def list_collections(self, **kwargs):
+        self._call("ListCollections")
+        ids = sorted(self._collections)
+        return {
+            "CollectionIds": ids,
+            "FaceModelVersions": [FACE_MODEL_VERSION] * len(ids),
+        }
+
+    def describe_collection(self, CollectionId, **kwargs):
+        self._call("DescribeCollection")
+        collection = self._collection(CollectionId, "DescribeCollection")
+        return {
+            "FaceCount": len(collection.rows),
+            "FaceModelVersion": FACE_MODEL_VERSION,
+            "CollectionARN": f"aws:rekognition:local:000000000000:collection/{CollectionId}",
+            "CreationTimestamp": collection.created,
+        }
+
+    # -------------------------------------------------------------------- faces
+    def index_faces(
+        self,
+        CollectionId,
+        Image,
+        ExternalImageId=None,
+        MaxFaces=None,
+        QualityFilter="AUTO",
+        DetectionAttributes=None,
+        **kwargs,
+    ):
+        if MaxFaces is not None:
+            _check_type("MaxFaces", MaxFaces, int, "IndexFaces")
+        self._call("IndexFaces")
+        collection = self._collection(CollectionId, "IndexFaces")
+        image_key = self._image_key(Image, "IndexFaces")
+        detected = self.detect(image_key)
+        limit = MaxFaces if MaxFaces is not None else 100
+        indexed, unindexed = detected[:limit], detected[limit:]
+
+        vectors = [
+            self._face_vector(identity, key, i)
+            for i, (identity, key) in enumerate(indexed)
+        ]
+        with self._lock:
+            faces = []
+            for i, _ in enumerate(indexed):
+                face_id = self._new_face_id(collection, image_key, i)
+                faces.append(
+                    self._describe_face(face_id, image_key, i, ExternalImageId)
+                )
+            if faces:
+                collection.append(np.stack(vectors), faces)
+        return {
+            "FaceRecords": [{"Face": dict(face), "FaceDetail": {}} for face in faces],
+            "FaceModelVersion": FACE_MODEL_VERSION,
+            "UnindexedFaces": [
+                {"Reasons": ["EXCEEDS_MAX_FACES"], "FaceDetail": {}} for _ in unindexed
+            ],
+        }
+
+    def bulk_index_faces(self, CollectionId, ExternalImageIds, Bucket="local"):
+        """Index one face per image name in a single vectorised step.
+
+        This is not a Rekognition API (and not counted as calls), it is meant to
+        pre-populate large collections quickly. The faces follow the same identity
+        rules as `index_faces`, with the per-image noise drawn in one batch: the
+        result is deterministic for a given list of names.
+        """
+        collection = self._collection(CollectionId, "IndexFaces")
+        names = [name for name in ExternalImageIds if self.detect(f"{Bucket}/{name}")]
+        if not names:
+            return []
+        centroids = np.stack(
+            [self._identity_vector(self.identity(customer_of(name))) for name in names]
+        )
+        rng = np.random.default_rng(
+            _seed(self.seed, "bulk", CollectionId, *names[:1], len(names))
+        )
+        noise = rng.standard_normal(centroids.shape).astype(np.float32)
+        vectors = centroids + noise * (self.intra_class_noise / np.sqrt(self.dim))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        sizes = rng.uniform(*FACE_SIZES, size=(len(names), 2))
+        offsets = rng.uniform(0.0, 1.0, size=(len(names), 2)) * (1 - sizes)
+        confidences = rng.uniform(99.0, 100.0, size=len(names))
+
+        with self._lock:
+            faces = []
+            for j, name in enumerate(names):
+                image_key = f"{Bucket}/{name}"
+                faces.append(
+                    {
+                        "FaceId": str(
+                            uuid.UUID(
+                                bytes=_digest(
+                                    self.seed,
+                                    CollectionId,
+                                    image_key,
+                                    0,
+                                    collection.size + j,
+                                )
+                            )
+                        ),
+                        "BoundingBox": {
+                            "Width": float(sizes[j, 0]),
+                            "Height": float(sizes[j, 1]),
+                            "Left": float(offsets[j, 0]),
+                            "Top": float(offsets[j, 1]),
+                        },
+                        "ImageId": str(
+                            uuid.UUID(bytes=_digest(self.seed, "image", image_key))
+                        ),
+                        "ExternalImageId": name,
+                        "Confidence": float(confidences[j]),
+                        "IndexFacesModelVersion": FACE_MODEL_VERSION,
+                    }
+                )
+            collection.append(vectors, faces)
+        return [face["FaceId"] for face in faces]
+
+    def list_faces(
+        self, CollectionId, NextToken=None, MaxResults=1000, UserId=None, **kwargs
+    ):
+        _check_type("MaxResults", MaxResults, int, "ListFaces")
+        self._call("ListFaces")
+        collection = self._collection(CollectionId, "ListFaces")
+        max_results = min(MaxResults, LIST_FACES_MAX_RESULTS)
+        start = int(NextToken) if NextToken else 0
+        with self._lock:
+            rows = np.flatnonzero(collection.active[start : collection.size]) + start
+            if UserId is not None:
+                user_rows = {
+                    collection.rows[f] for f in collection.users.get(UserId, [])
+                }
+                rows = np.array([r for r in rows if r in user_rows], dtype=np.int64)
+            page = rows[:max_results]
+            faces = [dict(collection.faces[row]) for row in page]
+            for face in faces:
+                if face["FaceId"] in collection.face_users:
+                    face["UserId"] = collection.face_users[face["FaceId"]]
+            more = len(rows) > max_results
+        response = {"Faces": faces, "FaceModelVersion": FACE_MODEL_VERSION}
+        if more:
+            response["NextToken"] = str(int(page[-1]) + 1)
+        return response
+
+    def delete_faces(self, CollectionId, FaceIds, **kwargs):
+        self._call("DeleteFaces")
+        if not 1 <= len(FaceIds) <= DELETE_FACES_MAX_IDS:
+            _raise(
+                self.exceptions.InvalidParameterException,
+                "DeleteFaces",
+                f"FaceIds must contain between 1 and {DELETE_FACES_MAX_IDS} items",
+            )
+        collection = self._collection(CollectionId, "DeleteFaces")
+        deleted = []
+        unsuccessful = []
+        with self._lock:
+            for face_id in FaceIds:
+                if face_id in collection.face_users:
+                    # like the service, the faces must be disassociated first
+                    unsuccessful.append(
+                        {
+                            "FaceId": face_id,
+                            "UserId": collection.face_users[face_id],
+                            "Reasons": ["ASSOCIATED_TO_AN_EXISTING_USER"],
+                        }
+                    )
+                    continue
+                row = collection.rows.pop(face_id, None)
+                if row is not None:
+                    collection.active[row] = False
+                    deleted.append(face_id)
+        response = {"DeletedFaces": deleted}
+        if unsuccessful:
+            response["UnsuccessfulFaceDeletions"] = unsuccessful
+        return response
+
+    # -------------------------------------------------------------------- users
+    def create_user(self, CollectionId, UserId, **kwargs):
+        self._call("CreateUser")
+        collection = self._collection(CollectionId, "CreateUser")
+        with self._lock:
+            if UserId in collection.users:
+                _raise(
+                    self.exceptions.ConflictException,
+                    "CreateUser",
+                    f"The user id: {UserId} already exists",
+                )
+            collection.users[UserId] = []
+        return {}
+
+    def delete_user(self, CollectionId, UserId, **kwargs):
+        self._call("DeleteUser")
+        collection = self._collection(CollectionId, "DeleteUser")
+        with self._lock:
+            for face_id in collection.users.pop(UserId, []):
+                collection.face_users.pop(face_id, None)
+            collection.user_vectors.pop(UserId, None)
+            collection.user_matrix = None
+        return {}
+
+    def list_users(self, CollectionId, NextToken=None, MaxResults=500, **kwargs):
+        self._call("ListUsers")
+        collection = self._collection(CollectionId, "ListUsers")
+        start = int(NextToken) if NextToken else 0
+        with self._lock:
+            user_ids = sorted(collection.users)
+        response = {
+            "Users": [
+                {"UserId": u, "UserStatus": "ACTIVE"}
+                for u in user_ids[start : start + MaxResults]
+            ]
+        }
+        if start + MaxResults < len(user_ids):
+            response["NextToken"] = str(start + MaxResults)
+        return response
+
+    def associate_faces(
+        self, CollectionId, UserId, FaceIds, UserMatchThreshold=75.0, **kwargs
+    ):
+        """Associate faces with a user, if they are similar enough to the faces
+        already associated with it (the user vector)"""
+        _check_type(
+            "UserMatchThreshold", UserMatchThreshold, (int, float), "AssociateFaces"
+        )
+        self._call("AssociateFaces")
+        if not 1 <= len(FaceIds) <= ASSOCIATE_FACES_MAX_IDS:
+            _raise(
+                self.exceptions.InvalidParameterException,
+                "AssociateFaces",
+                f"FaceIds must contain between 1 and {ASSOCIATE_FACES_MAX_IDS} items",
+            )
+        collection = self._collection(CollectionId, "AssociateFaces")
+        associated, unsuccessful = [], []
+        with self._lock:
+            if UserId not in collection.users:
+                _raise(
+                    self.exceptions.ResourceNotFoundException,
+                    "AssociateFaces",
+                    f"The user id: {UserId} does not exist",
+                )
+            faces = collection.users[UserId]
+            new = [f for f in FaceIds if f not in faces]
+            if len(faces) + len(new) > MAX_USER_FACES:
+                _raise(
+                    self.exceptions.ServiceQuotaExceededException,
+                    "AssociateFaces",
+                    f"A user can have at most {MAX_USER_FACES} faces",
+                )
+            user_vector = self._user_vector(collection, UserId)
+            for face_id in new:
+                row = collection.rows.get(face_id)
+                reason = None
+                if row is None:
+                    reason = "FACE_NOT_FOUND"
+                elif collection.face_users.get(face_id, UserId) != UserId:
+                    reason = "ASSOCIATED_TO_A_DIFFERENT_USER"
+                elif user_vector is not None:
+                    similarity = float(collection.embeddings[row] @ user_vector) * 100
+                    if similarity < UserMatchThreshold:
+                        reason = "LOW_MATCH_CONFIDENCE"
+                if reason:
+                    unsuccessful.append(
+                        {"FaceId": face_id, "UserId": UserId, "Reasons": [reason]}
+                    )
+                    continue
+                faces.append(face_id)
+                collection.face_users[face_id] = UserId
+                collection.user_vectors.pop(UserId, None)
+                collection.user_matrix = None
+                associated.append({"FaceId": face_id})
+        return {
+            "AssociatedFaces": associated,
+            "UnsuccessfulFaceAssociations": unsuccessful,
+            "UserStatus": "ACTIVE",
+        }
+
+    def disassociate_faces(self, CollectionId, UserId, FaceIds, **kwargs):
+        self._call("DisassociateFaces")
+        if not 1 <= len(FaceIds) <= ASSOCIATE_FACES_MAX_IDS:
+            _raise(
+                self.exceptions.InvalidParameterException,
+                "DisassociateFaces",
+                f"FaceIds must contain between 1 and {ASSOCIATE_FACES_MAX_IDS} items",
+            )
+        collection = self._collection(CollectionId, "DisassociateFaces")
+        disassociated, unsuccessful = [], []
+        with self._lock:
+            if UserId not in collection.users:
+                _raise(
+                    self.exceptions.ResourceNotFoundException,
+                    "DisassociateFaces",
+                    f"The user id: {UserId} does not exist",
+                )
+            for face_id in FaceIds:
+                if collection.face_users.get(face_id) != UserId:
+                    unsuccessful.append(
+                        {
+                            "FaceId": face_id,
+                            "UserId": UserId,
+                            "Reasons": ["FACE_NOT_FOUND"],
+                        }
+                    )
+                    continue
+                del collection.face_users[face_id]
+                collection.users[UserId].remove(face_id)
+                disassociated.append({"FaceId": face_id})
+            collection.user_vectors.pop(UserId, None)
+            collection.user_matrix = None
+        return {
+            "DisassociatedFaces": disassociated,
+            "UnsuccessfulFaceDisassociations": unsuccessful,
+            "UserStatus": "ACTIVE",
+        }
+
+    def bulk_associate_faces(self, CollectionId, user_id=customer_of):
+        """Associate every face of the collection with the user of its
+        `ExternalImageId`, creating the users.
+
+        This is not a Rekognition API (and not counted as calls), it is meant to
+        pre-populate the users of large collections quickly, without checking
+        the similarity of the faces.
+        """
+        collection = self._collection(CollectionId, "AssociateFaces")
+        with self._lock:
+            for face_id, row in collection.rows.items():
+                name = collection.faces[row].get("ExternalImageId")
+                if name is None or face_id in collection.face_users:
+                    continue
+                faces = collection.users.setdefault(user_id(name), [])
+                if len(faces) < MAX_USER_FACES:
+                    faces.append(face_id)
+                    collection.face_users[face_id] = user_id(name)
+            collection.user_vectors.clear()
+            collection.user_matrix = None
+
+    def _user_vector(self, collection, user_id):
+        """Mean of the embeddings of the faces of the user, normalized"""
+        vector = collection.user_vectors.get(user_id)
+        if vector is None:
+            rows = [collection.rows[f] for f in collection.users.get(user_id, [])]
+            if not rows:
+                return None
+            vector = collection.embeddings[rows].mean(axis=0)
+            vector /= np.linalg.norm(vector)
+            collection.user_vectors[user_id] = vector
+        return vector
+
+    def _search_users(self, collection, query, max_users, threshold):
+        with self._lock:
+            if collection.user_matrix is None:
+                user_ids = [u for u, faces in collection.users.items() if faces]
+                vectors = np.stack(
+                    [self._user_vector(collection, u) for u in user_ids]
+                    or [np.zeros(self.dim, np.float32)]
+                )
+                collection.user_matrix = (user_ids, vectors)
+            user_ids, vectors = collection.user_matrix
+        if not user_ids:
+            return []
+        scores = np.clip(vectors @ query, 0.0, 1.0) * 100.0
+        candidates = np.flatnonzero(scores >= threshold)
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [
+            {
+                "Similarity": float(scores[i]),
+                "User": {"UserId": user_ids[i], "UserStatus": "ACTIVE"},
+            }
+            for i in candidates[:max_users]
+        ]
+
+    def search_users(
+        self,
+        CollectionId,
+        UserId=None,
+        FaceId=None,
+        UserMatchThreshold=80.0,
+        MaxUsers=None,
+        **kwargs,
+    ):
+        _check_type(
+            "UserMatchThreshold", UserMatchThreshold, (int, float), "SearchUsers"
+        )
+        if MaxUsers is not None:
+            _check_type("MaxUsers", MaxUsers, int, "SearchUsers")
+        self._call("SearchUsers")
+        collection = self._collection(CollectionId, "SearchUsers")
+        with self._lock:
+            if FaceId is not None:
+                if FaceId not in collection.rows:
+                    _raise(
+                        self.exceptions.ResourceNotFoundException,
+                        "SearchUsers",
+                        f"Face {FaceId} not found in collection {CollectionId}",
+                    )
+                query = collection.embeddings[collection.rows[FaceId]].copy()
+            else:
+                query = self._user_vector(collection, UserId)
+                if query is None:
+                    _raise(
+                        self.exceptions.ResourceNotFoundException,
+                        "SearchUsers",
+                        f"The user id: {UserId} does not exist or has no face",
+                    )
+        matches = self._search_users(
+            collection, query, MaxUsers or 100, UserMatchThreshold
+        )
+        if UserId is not None:
+            # a user doesn't match itself
+            matches = [m for m in matches if m["User"]["UserId"] != UserId]
+        response = {"UserMatches": matches, "FaceModelVersion": FACE_MODEL_VERSION}
+        if FaceId is not None:
+            response["SearchedFace"] = {"FaceId": FaceId}
+        else:
+            response["SearchedUser"] = {"UserId": UserId}
+        return response
+
+    def search_users_by_image(
+        self, CollectionId, Image, UserMatchThreshold=80.0, MaxUsers=None, **kwargs
+    ):
+        _check_type(
+            "UserMatchThreshold",
+            UserMatchThreshold,
+            (int, float),
+            "SearchUsersByImage",
+        )
+        self._call("SearchUsersByImage")
+        collection = self._collection(CollectionId, "SearchUsersByImage")
+        image_key, face_index = self._image(Image, "SearchUsersByImage")
+        detected = self.detect(image_key)[face_index:]
+        if not detected:
+            _raise(
+                self.exceptions.InvalidParameterException,
+                "SearchUsersByImage",
+                "There are no faces in the image. Should be at least 1.",
+            )
+        # like the service, only the largest face in the image is searched
+        identity, key = detected[0]
+        query = self._face_vector(identity, key, face_index)
+        box = self._describe_face(None, image_key, face_index, None)
+        return {
+            "UserMatches": self._search_users(
+                collection, query, MaxUsers or 100, UserMatchThreshold
+            ),
+            "FaceModelVersion": FACE_MODEL_VERSION,
+            "SearchedFace": {
+                "FaceDetail": {
+                    "BoundingBox": box["BoundingBox"],
+                    "Confidence": box["Confidence"],
+                }
+            },
+            "UnsearchedFaces": [],
+        }
+
+    # ------------------------------------------------------------------- search
+    def search_faces(
+        self, CollectionId, FaceId, MaxFaces=80, FaceMatchThreshold=80.0, **kwargs
+    ):
+        self._call("SearchFaces")
+        return self.search_faces_batch(
+            CollectionId,
+            [FaceId],
+            MaxFaces=MaxFaces,
+            FaceMatchThreshold=FaceMatchThreshold,
+        )[0]
+
+    def search_faces_batch(
+        self,
+        CollectionId,
+        FaceIds,
+        MaxFaces=80,
+        FaceMatchThreshold=80.0,
+        chunk_size=256,
+    ):
+        """`search_faces` for many FaceIds at once, with one matrix product per chunk.
+
+        Not a Rekognition API (and not counted as calls), it is the engine of
+        `search_faces` and a fast path for sweeps over the whole collection.
+        """
+        _check_type("MaxFaces", MaxFaces, int, "SearchFaces")
+        _check_type(
+            "FaceMatchThreshold", FaceMatchThreshold, (int, float), "SearchFaces"
+        )
+        collection = self._collection(CollectionId, "SearchFaces")
+        with self._lock:
+            try:
+                query_rows = np.array(
+                    [collection.rows[f] for f in FaceIds], dtype=np.int64
+                )
+            except KeyError as e:
+                _raise(
+                    self.exceptions.InvalidParameterException,
+                    "SearchFaces",
+                    f"Face {e.args[0]} not found in collection {CollectionId}",
+                )
+            size = collection.size
+            embeddings = collection.embeddings
+            active = collection.active[:size].copy()
+
+        responses = []
+        for start in range(0, len(FaceIds), chunk_size):
+            rows = query_rows[start : start + chunk_size]
+            similarity = embeddings[rows] @ embeddings[:size].T
+            np.clip(similarity, 0.0, 1.0, out=similarity)
+            similarity *= 100.0
+            similarity[:, ~active] = -1.0
+            similarity[np.arange(len(rows)), rows] = -1.0  # a face doesn't match itself
+            for face_id, scores in zip(FaceIds[start : start + chunk_size], similarity):
+                responses.append(
+                    self._matches(
+                        collection, face_id, scores, MaxFaces, FaceMatchThreshold
+                    )
+                )
+        return responses
+
+    def search_faces_by_image(
+        self, CollectionId, Image, MaxFaces=80, FaceMatchThreshold=80.0, **kwargs
+    ):
+        _check_type("MaxFaces", MaxFaces, int, "SearchFacesByImage")
+        self._call("SearchFacesByImage")
+        collection = self._collection(CollectionId, "SearchFacesByImage")
+        image_key, face_index = self._image(Image, "SearchFacesByImage")
+        detected = self.detect(image_key)[face_index:]
+        if not detected:
+            _raise(
+                self.exceptions.InvalidParameterException,
+                "SearchFacesByImage",
+                "There are no faces in the image. Should be at least 1.",
+            )
+        # like the service, only the largest face in the image is searched
+        identity, key = detected[0]
+        query = self._face_vector(identity, key, face_index)
+        with self._lock:
+            size = collection.size
+            embeddings = collection.embeddings
+            active = collection.active[:size].copy()
+        scores = np.clip(embeddings[:size] @ query, 0.0, 1.0) * 100.0
+        scores[~active] = -1.0
+        response = self._matches(collection, None, scores, MaxFaces, FaceMatchThreshold)
+        del response["SearchedFaceId"]
+        box = self._describe_face(None, image_key, face_index, None)
+        response["SearchedFaceBoundingBox"] = box["BoundingBox"]
+        response["SearchedFaceConfidence"] = box["Confidence"]
+        return response
+
+    @staticmethod
+    def _matches(collection, face_id, scores, max_faces, threshold):
+        candidates = np.flatnonzero(scores >= threshold)
+        if len(candidates) > max_faces:
+            top = np.argpartition(scores[candidates], -max_faces)[-max_faces:]
+            candidates = candidates[top]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return {
+            "SearchedFaceId": face_id,
+            "FaceMatches": [
+                {"Similarity": float(scores[row]), "Face": dict(collection.faces[row])}
+                for row in candidates
+            ],
+            "FaceModelVersion": FACE_MODEL_VERSION,
+        }
@@ -0,0 +1,196 @@
+"""Cold-start benchmark of the lambda functions.
+
+Every run starts a fresh Python process (as a new lambda instance does), and
+measures, for each function:
+
+- `import_ms`: import of the handler module, with the environment of the stack,
+- `clients_ms`: creation of the AWS clients the function uses (no call is made),
+- `first_invocation_ms` and `warm_invocation_ms`: a first and a second invocation
+  of the handler, on a sample event, with local stand-ins of the services.
+
+Usage:
+    python -m tools.startup_benchmark --runs 10 --output startup.json
+    python -m tools.startup_benchmark --baseline startup.json --tolerance 0.25
+
+With `--baseline`, the medians are compared with the ones of an earlier run, and
+the command fails if any of them regressed by more than `--tolerance` (and at
+least `--min-regression-ms`, to ignore the noise of the fastest steps).
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from tools.lambdas import ROOT
+
+STEPS = ["import_ms", "clients_ms", "first_invocation_ms", "warm_invocation_ms"]
+
+# services called by every function, created by `clients_ms`
+SERVICES = {
+    "match_faces": ["rekognition", "s3", "dynamodb"],
+    "notify_matches": ["s3", "ssm", "sns"],
+}
+
+
+def _measure(name):
+    """Measure the start of a function in this (fresh) process"""
+    from tools.lambdas import load_function
+    from tools.local_aws import LocalS3, LocalSNS, LocalSSM
+    from tools.rekognition_emulator import RekognitionEmulator
+
+    s3 = LocalS3()
+    if name == "match_faces":
+        env = {
+            "COLLECTION_NAME": "StartupCollection",
+            "BUCKET_OUT": "bucket-out",
+            "MAX_FACE_INDEX": 5,
+            "LOG_LEVEL": "WARNING",
+        }
+        reko = RekognitionEmulator()
+        reko.create_collection(CollectionId="StartupCollection")
+        stand_ins = {"reko": reko, "s3": s3}
+        event = {
+            "Records": [
+                {
+                    "messageId": "1",
+                    "body": json.dumps(
+                        {
+                            "Records": [
+                                LocalS3.event_record("bucket-images", key, etag=str(i))
+                            ]
+                        }
+                    ),
+                }
+                for i, key in enumerate(
+                    ["images/A/A_0001.jpg", "images/B/B_0001.jpg"], start=1
+                )
+            ]
+        }
+    else:
+        env = {
+            "BUCKET_OUT": "bucket-out",
+            "NOTIFICATION_THRESHOLD": "/Startup/NotificationThreshold",
+            "TOPIC_ARN": "arn:aws:sns:local:000000000000:Startup",
+            "LOG_LEVEL": "WARNING",
+        }
+        report = {"Source": "bucket-images/images/A/A_0001.jpg", "CustomerID": "A"}
+        report["Matches"] = [
+            {"Similarity": 99.0, "Face": {"ExternalImageId": "B_0001.jpg"}}
+        ]
+        s3.put_object(
+            Bucket="bucket-out", Key="output/A_0001.jpg.json", Body=json.dumps(report)
+        )
+        stand_ins = {
+            "s3": s3,
+            "ssm": LocalSSM({"/Startup/NotificationThreshold": "90"}),
+            "sns": LocalSNS(),
+        }
+        event = {
+            "Records": [LocalS3.event_record("bucket-out", "output/A_0001.jpg.json")]
+        }
+
+    # (set in the lambda runtime)
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    result = {}
+    start = time.perf_counter()
+    fn = load_function(name, env=env)
+    result["import_ms"] = (time.perf_counter() - start) * 1000
+
+    # the functions share their clients through the common layer
+    from face_match import clients
+
+    start = time.perf_counter()
+    for service in SERVICES[name]:
+        clients.get(service)
+    result["clients_ms"] = (time.perf_counter() - start) * 1000
+
+    for attr, stand_in in stand_ins.items():
+        setattr(fn, attr, stand_in)
+    for step in ("first_invocation_ms", "warm_invocation_ms"):
+        start = time.perf_counter()
+        fn.handler(event, None)
+        result[step] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def run(name, runs):
+    """Start a function in `runs` fresh processes, returns the median of every step"""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-m", "tools.startup_benchmark", "--child", name],
+            cwd=ROOT,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        step: {
+            "median": statistics.median(s[step] for s in samples),
+            "max": max(s[step] for s in samples),
+        }
+        for step in STEPS
+    }
+
+
+def regressions(results, baseline, tolerance, min_regression_ms):
+    found = []
+    for name, steps in results.items():
+        for step, values in steps.items():
+            before = baseline.get(name, {}).get(step, {}).get("median")
+            if before is None:
+                continue
+            after = values["median"]
+            if after > before * (1 + tolerance) and after - before > min_regression_ms:
+                found.append(f"{name} {step}: {before:.1f} ms -> {after:.1f} ms")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--functions", nargs="+", default=list(SERVICES), choices=list(SERVICES)
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-regression-ms", type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(_measure(args.child)))
+        return 0
+
+    results = {name: run(name, args.runs) for name in args.functions}
+    print(f"{'function':<16}" + "".join(f"{step:>22}" for step in STEPS))
+    for name, steps in results.items():
+        print(
+            f"{name:<16}"
+            + "".join(
+                f"{steps[step]['median']:>12.1f} ({steps[step]['max']:>6.1f})"
+                for step in STEPS
+            )
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(
+                results, json.load(f), args.tolerance, args.min_regression_ms
+            )
+        for regression in found:
+            print(f"Regression: {regression}")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""Cross-match sweep of the faces already in the collection.
+
+Re-uploading images to recompute their matches (after a change of
+`FACE_MATCHING_THRESHOLD`, or to screen a new customer segment) indexes their
+faces again. The sweep instead lists the faces of the collection (all its
+shards) and searches each of them by FaceId with `SearchFaces`, so that a full
+re-screen only costs one search per face, in a time known in advance (the
+number of faces divided by the search TPS, printed when it starts).
+
+The searches run in a bounded pool of workers, with the retries of the
+`match_faces` function and its token buckets (shared with the function when
+`--rate-limit-table` is given). A FaceId can only be searched in its own
+collection: with sharded collections, the other shards are searched by image
+for the largest face of every image of the ledger (`--ledger-table`), as the
+function does, otherwise only the pairs within a shard are found.
+
+The sweep pairs faces, so the function is always loaded in the "faces" search
+mode: the users of a collection associated with users (`SEARCH_MODE=users`) are
+not matched, their faces are.
+
+The output is an edge list of the pairs of faces of different customers, one
+per line (tab separated: FaceId, FaceId, customer ID, customer ID, similarity).
+A pair is found from both of its faces, and only written once. The FaceIds
+searched are appended to a checkpoint file after their edges are written: a
+sweep started again with the same checkpoint and output skips them, and reads
+the pairs already written back from the output.
+
+Usage:
+    python -m tools.sweep --collection TestCollection --shards 4 \
+        --threshold 90 --output edges.tsv --checkpoint sweep.ckpt \
+        --ledger-table <LedgerTable> --rate-limit-table <RateLimitTable>
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import boto3
+
+from tools.backfill import Checkpoint
+from tools.collection import customer_of, list_collection
+from tools.lambdas import load_function
+
+logger = logging.getLogger(__name__)
+
+EDGE_COLUMNS = ["face_a", "face_b", "customer_a", "customer_b", "similarity"]
+
+
+def largest_faces(ledger_store):
+    """The image (an `S3Object`) of the largest face of every image of the ledger.
+
+    The local files indexed by `tools.backfill` are left out: their ledger keys
+    ("file:/<path>#<MD5>") are not S3 objects that Rekognition can read.
+    """
+    images = {}
+    files = 0
+    for key, entry in ledger_store.scan():
+        if not entry["face_ids"]:
+            continue
+        if key.startswith("file:"):
+            files += 1
+            continue
+        # the key of an entry is "<bucket>/<object key>#<ETag>"
+        bucket, _, object_key = key.rpartition("#")[0].partition("/")
+        images[entry["face_ids"][0]] = {
+            "S3Object": {"Bucket": bucket, "Name": object_key}
+        }
+    if files:
+        logger.warning(f"{files} local files are only searched in their own shard")
+    return images
+
+
+class EdgeList:
+    """Append-only file of the pairs of faces of different customers, each pair
+    written once"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pairs = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if fields[0] != EDGE_COLUMNS[0] and len(fields) > 1:
+                        self.pairs.add(self.pair(fields[0], fields[1]))
+        else:
+            with open(path, "w") as f:
+                f.write("\t".join(EDGE_COLUMNS) + "\n")
+
+    @staticmethod
+    def pair(face_a, face_b):
+        return (face_a, face_b) if face_a < face_b else (face_b, face_a)
+
+    def add(self, edges):
+        """Write the edges of pairs not written yet, returns how many"""
+        lines = []
+        for face_a, face_b, customer_a, customer_b, similarity in edges:
+            pair = self.pair(face_a, face_b)
+            if pair in self.pairs:
+                continue
+            self.pairs.add(pair)
+            if pair[0] != face_a:
+                customer_a, customer_b = customer_b, customer_a
+            fields = [*pair, customer_a, customer_b, f"{similarity:.3f}"]
+            lines.append("\t".join(fields) + "\n")
+        if lines:
+            with open(self.path, "a") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        return len(lines)
+
+
+class Sweep:
+    """Search every face of the collection with the `match_faces` code.
+
+    Args:
+        fn: the `match_faces` module, as loaded by `tools.lambdas.load_function`.
+        edges: `EdgeList` the cross-customer pairs are written to.
+        checkpoint: `Checkpoint` of the FaceIds already searched.
+        images: image of the largest faces, to search the other shards with.
+        workers: faces searched concurrently.
+        flush_size: faces searched between two writes of the edges and checkpoint.
+
+    Raises:
+        ValueError: if `fn` searches users (`SEARCH_MODE=users`), not faces.
+    """
+
+    def __init__(
+        self,
+        fn,
+        edges,
+        checkpoint=None,
+        images=None,
+        workers=16,
+        flush_size=1000,
+        progress_interval=10.0,
+        stream=sys.stderr,
+    ):
+        if fn.search_mode != "faces":
+            raise ValueError(f"The sweep pairs faces, not {fn.search_mode}")
+        self.fn = fn
+        self.edges = edges
+        self.checkpoint = checkpoint or Checkpoint()
+        self.images = images or {}
+        self.workers = workers
+        self.flush_size = flush_size
+        self.progress_interval = progress_interval
+        self.stream = stream
+        self.counts = {"faces": 0, "edges": 0, "failed": 0, "skipped": 0}
+        self._edges = []
+        self._done = []
+
+    def search(self, face, collection_id):
+        """The cross-customer edges of a face"""
+        fn = self.fn
+        matches = fn.search_faces_retry(
+            CollectionId=collection_id,
+            FaceId=face["FaceId"],
+            FaceMatchThreshold=fn.threshold,
+            MaxFaces=fn.max_faces_match,
+        )["FaceMatches"]
+        image = self.images.get(face["FaceId"])
+        if image is not None:
+            for shard in fn.shards:
+                if shard != collection_id:
+                    # (the same search as the function's, None without a face)
+                    matches = matches + (fn.search_image(image, shard) or [])
+        customer_id = customer_of(face.get("ExternalImageId"))
+        edges = []
+        for m in matches:
+            matched_customer = customer_of(m["Face"].get("ExternalImageId"))
+            if matched_customer != customer_id:
+                edges.append(
+                    (
+                        face["FaceId"],
+                        m["Face"]["FaceId"],
+                        customer_id,
+                        matched_customer,
+                        m["Similarity"],
+                    )
+                )
+        return edges
+
+    def flush(self):
+        """Write the pending edges, then checkpoint their faces"""
+        self.counts["edges"] += self.edges.add(self._edges)
+        self.checkpoint.record(self._done)
+        self._edges, self._done = [], []
+
+    def _collect(self, face_id, future):
+        try:
+            edges = future.result()
+        except Exception:
+            logger.exception(f"Failed to search {face_id}")
+            self.counts["failed"] += 1
+            return
+        self.counts["faces"] += 1
+        self._edges.extend(edges)
+        self._done.append(face_id)
+        if len(self._done) >= self.flush_size:
+            self.flush()
+
+    def log(self, start, total):
+        elapsed = time.perf_counter() - start
+        rate = self.counts["faces"] / max(elapsed, 1e-9)
+        left = total - self.counts["faces"] - self.counts["failed"]
+        print(
+            f"[{elapsed:8.1f}s] {self.counts['faces']}/{total} faces "
+            f"({rate:.1f}/s, {left / max(rate, 1e-9):.0f}s left), "
+            f"{self.counts['edges'] + len(self._edges)} edges, "
+            f"{self.counts['failed']} failed",
+            file=self.stream,
+            flush=True,
+        )
+
+    def run(self, faces, search_tps=None):
+        """Search the faces ((face, collection) pairs) not in the checkpoint,
+        returns the counters"""
+        todo = []
+        for face, collection_id in faces:
+            if face["FaceId"] in self.checkpoint:
+                self.counts["skipped"] += 1
+            else:
+                todo.append((face, collection_id))
+        if search_tps:
+            by_image = sum(1 for face, _ in todo if face["FaceId"] in self.images)
+            calls = len(todo) + by_image * (len(self.fn.shards) - 1)
+            print(
+                f"{len(todo)} faces to search ({self.counts['skipped']} done), "
+                f"{calls} searches, at least {calls / search_tps:.0f}s "
+                f"at {search_tps:g} TPS",
+                file=self.stream,
+                flush=True,
+            )
+        start = last = time.perf_counter()
+        # at most 2 faces per worker are queued
+        max_pending = 2 * self.workers
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for face, collection_id in todo:
+                future = pool.submit(self.search, face, collection_id)
+                pending[future] = face["FaceId"]
+                while len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._collect(pending.pop(future), future)
+                if time.perf_counter() - last >= self.progress_interval:
+                    self.log(start, len(todo))
+                    last = time.perf_counter()
+            for future in list(pending):
+                self._collect(pending.pop(future), future)
+        self.flush()
+        self.log(start, len(todo))
+        return dict(self.counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--threshold", type=float, default=50)
+    parser.add_argument("--max-faces", type=int, default=100, help="per search")
+    parser.add_argument("--output", required=True, help="edge list file")
+    parser.add_argument("--checkpoint", help="file of the FaceIds already searched")
+    parser.add_argument(
+        "--ledger-table",
+        help="ledger of the function, to search the other shards by image",
+    )
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--flush-size", type=int, default=1000)
+    parser.add_argument("--search-tps", type=float, default=50)
+    parser.add_argument(
+        "--rate-limit-table",
+        help="DynamoDB table of the token buckets shared with the function",
+    )
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    fn = load_function(
+        "match_faces",
+        env={
+            "COLLECTION_NAME": args.collection,
+            "COLLECTION_SHARDS": args.shards,
+            "SEARCH_MODE": "faces",
+            "FACE_MATCHING_THRESHOLD": args.threshold,
+            "MAX_FACE_MATCH": args.max_faces,
+            "SEARCH_FACES_TPS": args.search_tps,
+            "SEARCH_FACES_BY_IMAGE_TPS": args.search_tps,
+            "RATE_LIMIT_TABLE": args.rate_limit_table or "",
+            "LOG_LEVEL": "WARNING",
+        },
+    )
+    images = {}
+    if args.ledger_table and len(fn.shards) > 1:
+        ledger = load_function("match_faces", module="ledger")
+        images = largest_faces(ledger.DynamoDBLedgerStore(args.ledger_table))
+    elif len(fn.shards) > 1:
+        logger.warning("Without --ledger-table, pairs across shards are not found")
+    # (the client of the function only retries through the function's calls)
+    reko = boto3.client("rekognition")
+    with ThreadPoolExecutor(max_workers=len(fn.shards)) as pool:
+        listed = pool.map(lambda c: list_collection(reko, c), fn.shards)
+        faces = [(f, c) for c, shard in zip(fn.shards, listed) for f in shard]
+
+    sweep = Sweep(
+        fn,
+        EdgeList(args.output),
+        Checkpoint(args.checkpoint),
+        images=images,
+        workers=args.workers,
+        flush_size=args.flush_size,
+        progress_interval=args.progress_interval,
+    )
+    counts = sweep.run(faces, search_tps=args.search_tps)
+    print(counts)
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())